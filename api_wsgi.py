@@ -0,0 +1,123 @@
+"""
+Lean WSGI application serving the JSON API endpoints (/api/tag, /api/tagtt, /api/tagpt, /api/token).
+
+It is mounted ahead of the Flask application through DispatcherMiddleware (see API_FAST_PATH in config.dist.py),
+so the machine-to-machine traffic doesn't go through Flask routing, context processors and request proxies.
+The responses are byte-for-byte identical to the ones produced by the Flask routes: the requests which Flask
+answers with an HTML page (unknown sub-paths, 404 Not Found of a route) are passed on to the fallback application.
+"""
+
+import json
+from typing import Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qsl
+
+from werkzeug.exceptions import BadRequest, BadRequestKeyError, HTTPException, NotFound
+from werkzeug.http import HTTP_STATUS_CODES
+
+HEADERS_JSON = "application/json"
+
+
+class QueryArgs(dict):
+    """
+    Query arguments with the first value of each key (like request.args.get()),
+    raising BadRequest on missing keys (like request.args[...]).
+    """
+    def __missing__(self, key):
+        raise BadRequestKeyError(key)
+
+
+def parse_query_string(query_string: str) -> QueryArgs:
+    args = QueryArgs()
+
+    for key, value in parse_qsl(query_string, keep_blank_values=True):
+        args.setdefault(key, value)
+
+    return args
+
+
+def json_body(obj) -> bytes:
+    # same output as jsonify()
+    return (json.dumps(obj, separators=(",", ":"), sort_keys=True) + "\n").encode('utf-8')
+
+
+def json_error_response(err: HTTPException, environ, start_response):
+    """
+    WSGI response with the HTTP error as JSON (same output as jsonify({"error": str(err)}), err.code),
+    including the headers of the error (e.g. Retry-After)
+    """
+    body = json_body({"error": str(err)})
+    headers = [("Content-Type", HEADERS_JSON), ("Content-Length", str(len(body)))]
+    headers.extend(header for header in err.get_headers(environ) if header[0] != "Content-Type")
+    start_response(f"{err.code} {HTTP_STATUS_CODES[err.code].upper()}", headers)
+    return [body]
+
+
+# handler(args, environ) -> JSON-serializable dict
+Handler = Callable[[QueryArgs, dict], dict]
+
+
+class APIApplication:
+    def __init__(self,
+                 routes: Dict[str, Tuple[Handler, Optional[int]]],
+                 token_cookie: Optional[Callable[[str], str]] = None,
+                 fallback=None):
+        """
+        WSGI application for the JSON API
+        :param routes: path -> (handler, status code used for BadRequest or None to use the code of HTTPException)
+        :param token_cookie: builds Set-Cookie header value for the verification token (if enabled)
+        :param fallback: WSGI application serving unknown paths and NotFound raised by the handlers
+                         (None = JSON 404 response)
+        """
+        self.routes = routes
+        self.token_cookie = token_cookie
+        self.fallback = fallback
+
+    def endpoint(self, path: str):
+        """
+        WSGI application serving a single route, to be mounted at its exact path through DispatcherMiddleware
+        (SCRIPT_NAME may carry an additional prefix, e.g. of the tenant).
+        """
+        def application(environ, start_response):
+            # undo the mount, the fallback routes the full path
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '')[:-len(path)]
+            environ['PATH_INFO'] = path + environ.get('PATH_INFO', '')
+            return self.serve(environ['PATH_INFO'], environ, start_response)
+
+        return application
+
+    def __call__(self, environ, start_response):
+        return self.serve(environ.get('PATH_INFO', ''), environ, start_response)
+
+    def serve(self, path: Optional[str], environ, start_response):
+        route = self.routes.get(path)
+        # added after Content-Type and Content-Length, in the order of the Flask responses
+        headers = []
+
+        if route is None:
+            if self.fallback is not None:
+                return self.fallback(environ, start_response)
+
+            code = 404
+            body = json_body({"error": str(NotFound())})
+        else:
+            handler, error_code = route
+
+            try:
+                result = handler(parse_query_string(environ.get('QUERY_STRING', '')), environ)
+                code = 200
+                body = json_body(result)
+
+                if self.token_cookie is not None and result.get("token"):
+                    headers.append(("Set-Cookie", self.token_cookie(result["token"])))
+            except HTTPException as err:
+                if isinstance(err, NotFound) and self.fallback is not None:
+                    return self.fallback(environ, start_response)
+
+                code = error_code if error_code and isinstance(err, BadRequest) else err.code
+                body = json_body({"error": str(err)})
+                # e.g. Retry-After
+                headers.extend(header for header in err.get_headers(environ) if header[0] != "Content-Type")
+
+        start_response(f"{code} {HTTP_STATUS_CODES[code].upper()}",
+                       [("Content-Type", HEADERS_JSON), ("Content-Length", str(len(body)))] + headers)
+        return [body]
@@ -1,41 +1,295 @@
 # pylint: disable=unused-import
 
 import argparse
-import binascii
-import io
+import hashlib
+import hmac
 
-from flask import Flask, jsonify, render_template, request
-from werkzeug.exceptions import BadRequest
+from flask import Flask, jsonify, make_response, render_template, request
+from werkzeug.exceptions import BadRequest, Forbidden, NotFound, TooManyRequests
+from werkzeug.http import dump_cookie, parse_cookie
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
 
+import config
+from api_wsgi import APIApplication
 from config import (
-    CTR_PARAM,
-    ENC_FILE_DATA_PARAM,
-    ENC_PICC_DATA_PARAM,
-    REQUIRE_LRP,
-    SDMMAC_PARAM,
-    MASTER_KEY,
-    UID_PARAM,
-    DERIVE_MODE,
+    ADMISSION_CONTROL,
+    ADMISSION_INTERVAL,
+    ADMISSION_MAX_IN_FLIGHT,
+    ADMISSION_RETRY_AFTER,
+    ADMISSION_TARGET_DELAY,
+    ALLOC_PROFILE,
+    API_FAST_PATH,
+    COUNTER_STORE_COMPACT_EVERY,
+    COUNTER_STORE_DIR,
+    COUNTER_STORE_FSYNC,
+    COUNTER_STORE_SLOTS,
+    COUNTER_SYNC,
+    COUNTER_SYNC_BIND,
+    COUNTER_SYNC_DIR,
+    COUNTER_SYNC_INTERVAL,
+    COUNTER_SYNC_KEY,
+    COUNTER_SYNC_MAX_BATCHES,
+    COUNTER_SYNC_PEERS,
+    COUNTER_SYNC_WORKERS,
+    CPU_PROFILE_DIR,
+    CPU_PROFILE_EVERY,
+    CPU_PROFILE_INTERVAL,
+    DEBUG_TOKEN,
+    EVENT_LOG_BATCH_RECORDS,
+    EVENT_LOG_DIR,
+    EVENT_LOG_FLUSH_INTERVAL,
+    EVENT_LOG_SEGMENT_RECORDS,
+    EVENT_SINK,
+    EVENT_SINK_BATCH_SIZE,
+    EVENT_SINK_FLUSH_INTERVAL,
+    EVENT_SINK_MAX_RETRIES,
+    EVENT_SINK_OVERFLOW,
+    EVENT_SINK_QUEUE_SIZE,
+    EVENT_SINK_SPILL_DIR,
+    HEAVY_HITTERS,
+    HEAVY_HITTERS_DEPTH,
+    HEAVY_HITTERS_HALF_LIFE,
+    HEAVY_HITTERS_SLOTS,
+    HEAVY_HITTERS_TOP,
+    HEAVY_HITTERS_WIDTH,
+    METRICS,
+    METRICS_DIR,
+    PLAIN_MAC_PRECOMPUTE,
+    PLAIN_MAC_PRECOMPUTE_SIZE,
+    RATE_LIMIT_DIR,
+    RATE_LIMIT_IP_BURST,
+    RATE_LIMIT_IP_RATE,
+    RATE_LIMIT_SLOTS,
+    RATE_LIMIT_UID_BURST,
+    RATE_LIMIT_UID_RATE,
+    REPLAY_PROTECTION,
+    RESULT_CACHE_REJECTIONS,
+    RESULT_CACHE_SIZE,
+    RESULT_CACHE_TTL,
+    SERVER_TIMING,
+    SHARED_KEY_CACHE_DIR,
+    SHARED_KEY_CACHE_SLOTS,
+    TOKEN_COOKIE,
+    TOKEN_KEY,
+    TOKEN_TTL,
+    TRACE_BACKUP_COUNT,
+    TRACE_DIR,
+    TRACE_MAX_BYTES,
+    TRACE_SAMPLE_RATE,
+    TRACE_SLOW_THRESHOLD,
+    WARMUP,
+    WARMUP_PRELOAD_KEYS,
 )
-
-if DERIVE_MODE == "legacy":
-    from libsdm.legacy_derive import derive_tag_key, derive_undiversified_key
-elif DERIVE_MODE == "standard":
-    from libsdm.derive import derive_tag_key, derive_undiversified_key
-else:
-    raise RuntimeError("Invalid DERIVE_MODE.")
-
 from libsdm.sdm import (
     EncMode,
     InvalidMessage,
     ParamMode,
-    decrypt_sun_message,
-    validate_plain_sun,
+    calculate_plain_sdmmac,
 )
+from libsdm.stages import annotate, stage
+from server.admission import AdmissionControl, AdmissionMiddleware
+from server.alloc_profile import AllocationMiddleware, AllocationProfiler
+from server.counter_store import CounterStore, ReplayedMessage
+from server.counter_sync import CounterSync, DirectoryTransport, UDPTransport, parse_address
+from server.cpu_profile import CPUProfileMiddleware, SampledProfiler
+from server.event_log import EventLog
+from server.event_sink import EventSink, SinkStats, open_transport
+from server.heavy_hitters import HeavyHitters
+from server.instrument import Instrumentation, InstrumentMiddleware, server_timing
+from server.key_cache import SharedKeyCache
+from server.mac_precompute import MacPrecomputer
+from server.metrics import MetricsStore, ProcessValues
+from server.rate_limit import RateLimitMiddleware, TokenBuckets
+from server.result_cache import ResultCache
+from server.sun_params import parse_parameters, parse_plain_parameters, tag_tamper_status
+from server.tenants import ENVIRON_KEY, TenantMiddleware, config_tenants
+from server.tokens import InvalidToken, TokenSigner
+from server.tracing import Tracer
+from server.warmup import warmup
 
 app = Flask(__name__)
 app.config['JSONIFY_PRETTYPRINT_REGULAR'] = True
 
+# derived keys are shared by the workers (and tenants, keyed by the master key and derivation mode)
+shared_key_cache = None
+
+if SHARED_KEY_CACHE_SLOTS:
+    shared_key_cache = SharedKeyCache("derived", slots=SHARED_KEY_CACHE_SLOTS, directory=SHARED_KEY_CACHE_DIR)
+
+tenants = config_tenants(config, shared_key_cache)
+default_tenant = tenants.default
+
+# NFC tag UIDs are globally unique, so the replay protection state is shared by all tenants
+counter_store = None
+
+if REPLAY_PROTECTION:
+    counter_store = CounterStore(directory=COUNTER_STORE_DIR,
+                                 slots=COUNTER_STORE_SLOTS,
+                                 compact_every=COUNTER_STORE_COMPACT_EVERY,
+                                 fsync=COUNTER_STORE_FSYNC)
+
+counter_sync = None
+
+if counter_store is not None and COUNTER_SYNC:
+    if not COUNTER_SYNC_KEY:
+        raise RuntimeError("COUNTER_SYNC requires COUNTER_SYNC_KEY.")
+
+    if COUNTER_SYNC == "udp":
+        counter_sync_transport = UDPTransport(bind=parse_address(COUNTER_SYNC_BIND),
+                                              peers=[parse_address(peer) for peer in COUNTER_SYNC_PEERS],
+                                              workers=COUNTER_SYNC_WORKERS)
+    elif COUNTER_SYNC == "dir":
+        counter_sync_transport = DirectoryTransport(directory=COUNTER_SYNC_DIR)
+    else:
+        raise RuntimeError("Invalid COUNTER_SYNC.")
+
+    counter_sync = CounterSync(counter_store, counter_sync_transport, COUNTER_SYNC_KEY,
+                               interval=COUNTER_SYNC_INTERVAL,
+                               max_batches=COUNTER_SYNC_MAX_BATCHES)
+    # started (in the background) by every worker on its first request, not in the uWSGI master (threads and sockets
+    # don't survive fork)
+    counter_store.listener = counter_sync.enqueue
+
+
+def setup_tenant(tenant):
+    """
+    Build the per-tenant verifier context (caches and token signer).
+    """
+    # a cached result would be served without the replay check, so the cache is disabled with the replay protection
+    if RESULT_CACHE_SIZE and counter_store is None:
+        tenant.result_cache = ResultCache(max_size=RESULT_CACHE_SIZE,
+                                          ttl=RESULT_CACHE_TTL,
+                                          cache_rejections=RESULT_CACHE_REJECTIONS,
+                                          rejection=InvalidMessage)
+
+    if PLAIN_MAC_PRECOMPUTE:
+        tenant.mac_precomputer = MacPrecomputer(derive_key=tenant.sdm_file_read_key,
+                                                calculate_mac=calculate_plain_sdmmac,
+                                                depth=PLAIN_MAC_PRECOMPUTE,
+                                                max_entries=PLAIN_MAC_PRECOMPUTE_SIZE)
+
+    if TOKEN_KEY:
+        # tokens issued for one tenant must not be accepted by the others
+        token_key = TOKEN_KEY if tenant is default_tenant \
+            else hmac.new(TOKEN_KEY, tenant.name.encode('utf-8'), hashlib.sha256).digest()
+        tenant.token_signer = TokenSigner(key=token_key, ttl=TOKEN_TTL)
+
+
+for registered_tenant in tenants.tenants.values():
+    setup_tenant(registered_tenant)
+
+
+SUN_ROUTES = ['/tag', '/tagtt', '/tagpt', '/api/tag', '/api/tagtt', '/api/tagpt']
+
+# stages of the SUN endpoints are recorded only if some consumer is enabled
+instrumentation = Instrumentation(paths=SUN_ROUTES)
+
+metrics_store = None
+
+if METRICS:
+    metrics_store = MetricsStore(directory=METRICS_DIR)
+
+    for tenant_index, registered_tenant in enumerate(tenants.tenants.values()):
+        if registered_tenant.result_cache is not None:
+            registered_tenant.result_cache.counters = ProcessValues(f"result_cache_{tenant_index}",
+                                                                    ("cached", "computed"),
+                                                                    directory=metrics_store.directory)
+
+        if registered_tenant.mac_precomputer is not None:
+            registered_tenant.mac_precomputer.counters = ProcessValues(f"mac_precompute_{tenant_index}",
+                                                                       ("hits", "misses", "mismatches"),
+                                                                       directory=metrics_store.directory)
+
+
+def observe_metrics(recorder, path):  # pylint: disable=unused-argument
+    metrics_store.observe_request(recorder)
+    return []
+
+
+if metrics_store is not None:
+    instrumentation.add_observer(observe_metrics)
+
+if SERVER_TIMING:
+    instrumentation.add_observer(server_timing)
+
+tracer = None
+
+if TRACE_DIR:
+    tracer = Tracer(directory=TRACE_DIR,
+                    sample_rate=TRACE_SAMPLE_RATE,
+                    slow_threshold=TRACE_SLOW_THRESHOLD,
+                    max_bytes=TRACE_MAX_BYTES,
+                    backup_count=TRACE_BACKUP_COUNT)
+    instrumentation.add_observer(tracer.observe)
+
+
+alloc_profiler = None
+
+if ALLOC_PROFILE:
+    alloc_profiler = AllocationProfiler(sample_rate=ALLOC_PROFILE, paths=SUN_ROUTES)
+
+cpu_profiler = None
+
+if CPU_PROFILE_EVERY:
+    cpu_profiler = SampledProfiler(every=CPU_PROFILE_EVERY,
+                                   paths=SUN_ROUTES,
+                                   directory=CPU_PROFILE_DIR,
+                                   interval=CPU_PROFILE_INTERVAL)
+
+event_log = None
+
+if EVENT_LOG_DIR:
+    event_log = EventLog(EVENT_LOG_DIR,
+                         segment_records=EVENT_LOG_SEGMENT_RECORDS,
+                         batch_records=EVENT_LOG_BATCH_RECORDS,
+                         flush_interval=EVENT_LOG_FLUSH_INTERVAL)
+
+event_sink = None
+
+if EVENT_SINK:
+    event_sink = EventSink(open_transport(EVENT_SINK),
+                           max_queue=EVENT_SINK_QUEUE_SIZE,
+                           batch_size=EVENT_SINK_BATCH_SIZE,
+                           flush_interval=EVENT_SINK_FLUSH_INTERVAL,
+                           overflow=EVENT_SINK_OVERFLOW,
+                           spill_dir=EVENT_SINK_SPILL_DIR,
+                           max_retries=EVENT_SINK_MAX_RETRIES,
+                           stats=SinkStats(directory=metrics_store.directory if metrics_store is not None else None))
+
+heavy_hitters = None
+
+if HEAVY_HITTERS:
+    heavy_hitters = HeavyHitters(k=HEAVY_HITTERS_TOP,
+                                 width=HEAVY_HITTERS_WIDTH,
+                                 depth=HEAVY_HITTERS_DEPTH,
+                                 half_life=HEAVY_HITTERS_HALF_LIFE,
+                                 slots=HEAVY_HITTERS_SLOTS)
+
+ip_rate_limit = None
+
+if RATE_LIMIT_IP_RATE:
+    ip_rate_limit = TokenBuckets("ip", rate=RATE_LIMIT_IP_RATE, burst=RATE_LIMIT_IP_BURST, slots=RATE_LIMIT_SLOTS,
+                                 directory=RATE_LIMIT_DIR)
+
+uid_rate_limit = None
+
+if RATE_LIMIT_UID_RATE:
+    uid_rate_limit = TokenBuckets("uid", rate=RATE_LIMIT_UID_RATE, burst=RATE_LIMIT_UID_BURST, slots=RATE_LIMIT_SLOTS,
+                                  directory=RATE_LIMIT_DIR)
+
+admission = None
+
+if ADMISSION_CONTROL:
+    admission = AdmissionControl(max_in_flight=ADMISSION_MAX_IN_FLIGHT,
+                                 target_delay=ADMISSION_TARGET_DELAY,
+                                 interval=ADMISSION_INTERVAL,
+                                 retry_after=ADMISSION_RETRY_AFTER,
+                                 stats_directory=metrics_store.directory if metrics_store is not None else None)
+
+
+def current_tenant():
+    return request.environ.get(ENVIRON_KEY, default_tenant)
+
 
 @app.errorhandler(400)
 def handler_bad_request(err):
@@ -47,6 +301,15 @@ def handler_forbidden(err):
     return render_template('error.html', code=403, msg=str(err)), 403
 
 
+@app.errorhandler(429)
+def handler_too_many_requests(err):
+    return render_template('error.html', code=429, msg=str(err)), 429, retry_after_headers(err)
+
+
+def retry_after_headers(err):
+    return [header for header in err.get_headers() if header[0] == "Retry-After"]
+
+
 @app.errorhandler(404)
 def handler_not_found(err):
     return render_template('error.html', code=404, msg=str(err)), 404
@@ -54,8 +317,7 @@ def handler_not_found(err):
 
 @app.context_processor
 def inject_demo_mode():
-    demo_mode = MASTER_KEY == (b"\x00" * 16)
-    return {"demo_mode": demo_mode}
+    return {"demo_mode": current_tenant().demo_mode}
 
 
 @app.route('/')
@@ -66,66 +328,36 @@ def sdm_main():
     return render_template('sdm_main.html')
 
 
-# pylint:  disable=too-many-branches
-def parse_parameters():
-    arg_e = request.args.get('e')
-    if arg_e:
-        param_mode = ParamMode.BULK
-
-        try:
-            e_b = binascii.unhexlify(arg_e)
-        except binascii.Error:
-            raise BadRequest("Failed to decode parameters.") from None
-
-        e_buf = io.BytesIO(e_b)
-
-        if (len(e_b) - 8) % 16 == 0:
-            # using AES (16 byte PICCEncData)
-            file_len = len(e_b) - 16 - 8
-            enc_picc_data_b = e_buf.read(16)
-
-            if file_len > 0:
-                enc_file_data_b = e_buf.read(file_len)
-            else:
-                enc_file_data_b = None
-
-            sdmmac_b = e_buf.read(8)
-        elif (len(e_b) - 8) % 16 == 8:
-            # using LRP (24 byte PICCEncData)
-            file_len = len(e_b) - 24 - 8
-            enc_picc_data_b = e_buf.read(24)
+def record_scan(route, outcome, uid=None, read_ctr=None, encryption_mode=None, tt_status=""):
+    if event_log is not None:
+        event_log.record(route, outcome, uid=uid, read_ctr=read_ctr, encryption_mode=encryption_mode,
+                         tt_status=tt_status)
 
-            if file_len > 0:
-                enc_file_data_b = e_buf.read(file_len)
-            else:
-                enc_file_data_b = None
+    if heavy_hitters is not None and outcome == "ok":
+        heavy_hitters.observe(uid, read_ctr)
 
-            sdmmac_b = e_buf.read(8)
-        else:
-            raise BadRequest("Incorrect length of the dynamic parameter.")
-    else:
-        param_mode = ParamMode.SEPARATED
-        enc_picc_data = request.args.get(ENC_PICC_DATA_PARAM)
-        enc_file_data = request.args.get(ENC_FILE_DATA_PARAM)
-        sdmmac = request.args.get(SDMMAC_PARAM)
-
-        if not enc_picc_data:
-            raise BadRequest(f"Parameter {ENC_PICC_DATA_PARAM} is required")
-
-        if not sdmmac:
-            raise BadRequest(f"Parameter {SDMMAC_PARAM} is required")
+    if event_sink is not None and outcome == "ok":
+        event_sink.enqueue({
+            "route": route,
+            "uid": uid.hex().upper(),
+            "read_ctr": read_ctr,
+            "encryption_mode": encryption_mode,
+            "tt_status": tt_status
+        })
 
-        try:
-            enc_file_data_b = None
-            enc_picc_data_b = binascii.unhexlify(enc_picc_data)
-            sdmmac_b = binascii.unhexlify(sdmmac)
 
-            if enc_file_data:
-                enc_file_data_b = binascii.unhexlify(enc_file_data)
-        except binascii.Error:
-            raise BadRequest("Failed to decode parameters.") from None
+def cached_result(tenant, key, compute):
+    """
+    Serve the verification result from the tenant's short-TTL cache (if enabled).
+    :param tenant: tenant which owns the keys
+    :param key: canonical (decoded) message parameters
+    :param compute: function performing the actual verification
+    :return: tuple (result, whether it was served from the cache)
+    """
+    if tenant.result_cache is None:
+        return compute(), False
 
-    return param_mode, enc_picc_data_b, enc_file_data_b, sdmmac_b
+    return tenant.result_cache.fetch(key, compute)
 
 
 @app.route('/tagpt')
@@ -145,39 +377,129 @@ def sdm_api_info_plain():
         return _internal_tagpt(force_json=True)
     except BadRequest as err:
         return jsonify({"error": str(err)}), 400
+    except TooManyRequests as err:
+        return jsonify({"error": str(err)}), 429, retry_after_headers(err)
 
 
 def _internal_tagpt(force_json=False):
-    try:
-        uid = binascii.unhexlify(request.args[UID_PARAM])
-        read_ctr = binascii.unhexlify(request.args[CTR_PARAM])
-        cmac = binascii.unhexlify(request.args[SDMMAC_PARAM])
-    except binascii.Error:
-        raise BadRequest("Failed to decode parameters.") from None
+    tenant = current_tenant()
+    res = verify_tagpt(request.args, tenant)
+
+    if request.args.get("output") == "json" or force_json:
+        result = tagpt_api_result(res, tenant)
+        return with_token_cookie(jsonify(result), result.get("token"))
+
+    with stage("render"):
+        response = make_response(render_template('sdm_info.html',
+                                                 encryption_mode=res['encryption_mode'].name,
+                                                 uid=res['uid'],
+                                                 read_ctr_num=res['read_ctr']))
+
+    return with_token_cookie(response, tagpt_token(res, tenant))
+
+
+def verify_tagpt(args, tenant=None):
+    """
+    Validate plaintext SUN message (UID and counter mirrored in clear).
+    :param args: mapping of query arguments (e.g. request.args)
+    :param tenant: tenant which owns the keys (default tenant if None)
+    :return: dict as returned by validate_plain_sun()
+    :raises:
+        BadRequest: if the message is malformed or invalid
+    """
+    if tenant is None:
+        tenant = default_tenant
+
+    mac_precomputer = tenant.mac_precomputer
+    annotate("derive_mode", tenant.derive_mode)
+    annotate("outcome", "bad_request")
+
+    with stage("parse"):
+        uid, read_ctr, cmac = parse_plain_parameters(args, tenant)
+
+    # before the MAC check (which derives the key), so a forged message with the UID of a tag is charged as well
+    if uid_rate_limit is not None:
+        uid_rate_limit.check(uid)
+
+    def compute():
+        if counter_sync is not None:
+            counter_sync.ensure_started()
+
+        if counter_store is not None:
+            counter_store.check(uid, int.from_bytes(read_ctr, 'big'))
+
+        # index of the master key which verified the tag
+        key_index = mac_precomputer.verify(uid, read_ctr, cmac) if mac_precomputer is not None else None
+
+        if key_index is None:
+            res = tenant.keys.validate_plain_sun(uid=uid, read_ctr=read_ctr, sdmmac=cmac)
+            key_index = res['key_index']
+        else:
+            res = {
+                "encryption_mode": EncMode.AES,
+                "uid": uid,
+                "read_ctr": int.from_bytes(read_ctr, 'big')
+            }
+
+        if counter_store is not None:
+            counter_store.update(res['uid'], res['read_ctr'])
+
+        if mac_precomputer is not None and len(read_ctr) == 3:
+            mac_precomputer.schedule(uid, res['read_ctr'], key_index)
+
+        return res
 
     try:
-        sdm_file_read_key = derive_tag_key(MASTER_KEY, uid, 2)
-        res = validate_plain_sun(uid=uid,
-                                 read_ctr=read_ctr,
-                                 sdmmac=cmac,
-                                 sdm_file_read_key=sdm_file_read_key)
+        with stage("verify"):
+            res, cached = cached_result(tenant, ("plain", uid, read_ctr, cmac), compute)
+    except ReplayedMessage:
+        annotate("outcome", "replayed")
+        record_scan("tagpt", "replayed", uid, int.from_bytes(read_ctr, 'big'))
+        raise BadRequest("Replayed message (read counter was already used).") from None
     except InvalidMessage:
+        annotate("outcome", "invalid")
+        record_scan("tagpt", "invalid", uid, int.from_bytes(read_ctr, 'big'))
         raise BadRequest("Invalid message (most probably wrong signature).") from None
 
-    if REQUIRE_LRP and res['encryption_mode'] != EncMode.LRP:
+    annotate("encryption_mode", res['encryption_mode'].name)
+
+    if tenant.require_lrp and res['encryption_mode'] != EncMode.LRP:
+        if not cached:
+            record_scan("tagpt", "bad_request", uid, res['read_ctr'], res['encryption_mode'].name)
+
         raise BadRequest("Invalid encryption mode, expected LRP.")
 
-    if request.args.get("output") == "json" or force_json:
-        return jsonify({
-            "uid": res['uid'].hex().upper(),
-            "read_ctr": res['read_ctr'],
-            "enc_mode": res['encryption_mode'].name
-        })
+    annotate("outcome", "ok")
+
+    # the same URL fetched again (served from the result cache) isn't a new scan of the tag
+    if not cached:
+        record_scan("tagpt", "ok", uid, res['read_ctr'], res['encryption_mode'].name)
+
+    return res
+
 
-    return render_template('sdm_info.html',
-                           encryption_mode=res['encryption_mode'].name,
-                           uid=res['uid'],
-                           read_ctr_num=res['read_ctr'])
+def tagpt_api_result(res, tenant=None):
+    result = {
+        "uid": res['uid'].hex().upper(),
+        "read_ctr": res['read_ctr'],
+        "enc_mode": res['encryption_mode'].name
+    }
+
+    token = tagpt_token(res, tenant)
+
+    if token is not None:
+        result["token"] = token
+
+    return result
+
+
+def tagpt_token(res, tenant=None):
+    token_signer = (tenant or default_tenant).token_signer
+
+    if token_signer is None:
+        return None
+
+    return token_signer.issue(res['uid'], res['read_ctr'], res['encryption_mode'])
 
 
 @app.route('/webnfc')
@@ -196,6 +518,8 @@ def sdm_api_info_tt():
         return _internal_sdm(with_tt=True, force_json=True)
     except BadRequest as err:
         return jsonify({"error": str(err)})
+    except TooManyRequests as err:
+        return jsonify({"error": str(err)}), 429, retry_after_headers(err)
 
 
 @app.route('/tag')
@@ -209,28 +533,109 @@ def sdm_api_info():
         return _internal_sdm(with_tt=False, force_json=True)
     except BadRequest as err:
         return jsonify({"error": str(err)})
+    except TooManyRequests as err:
+        return jsonify({"error": str(err)}), 429, retry_after_headers(err)
 
 
-# pylint:  disable=too-many-branches, too-many-statements, too-many-locals
 def _internal_sdm(with_tt=False, force_json=False):
     """
     SUN decrypting/validating endpoint.
     """
-    param_mode, enc_picc_data_b, enc_file_data_b, sdmmac_b = parse_parameters()
+    tenant = current_tenant()
+    res = verify_sdm(request.args, with_tt=with_tt, tenant=tenant)
+
+    if request.args.get("output") == "json" or force_json:
+        result = sdm_api_result(res, tenant)
+        return with_token_cookie(jsonify(result), result.get("token"))
+
+    with stage("render"):
+        response = make_response(render_template('sdm_info.html',
+                                                 encryption_mode=res['encryption_mode'],
+                                                 picc_data_tag=res['picc_data_tag'],
+                                                 uid=res['uid'],
+                                                 read_ctr_num=res['read_ctr_num'],
+                                                 file_data=res['file_data'],
+                                                 file_data_utf8=res['file_data_utf8'],
+                                                 tt_status=res['tt_status'],
+                                                 tt_color=res['tt_color']))
+
+    return with_token_cookie(response, sdm_token(res, tenant))
+
+
+def check_read_ctr(uid, read_ctr):
+    """
+    Called right after PICC decryption, before the key derivation and MAC calculation.
+    :raises:
+        TooManyRequests: if the UID exceeded its rate limit
+        ReplayedMessage: if the read counter was already used
+    """
+    if uid_rate_limit is not None:
+        uid_rate_limit.check(uid)
+
+    if counter_store is not None:
+        counter_store.check(uid, read_ctr)
+
+
+# pylint:  disable=too-many-branches, too-many-statements, too-many-locals
+def verify_sdm(args, with_tt=False, tenant=None):
+    """
+    Decrypt and validate encrypted SUN message.
+    :param args: mapping of query arguments (e.g. request.args)
+    :param with_tt: whether to interpret TagTamper status from the file data
+    :param tenant: tenant which owns the keys (default tenant if None)
+    :return: dict with the fields presented by sdm_info.html and the JSON API
+    :raises:
+        BadRequest: if the message is malformed or invalid
+    """
+    if tenant is None:
+        tenant = default_tenant
+
+    route = "tagtt" if with_tt else "tag"
+    annotate("derive_mode", tenant.derive_mode)
+    annotate("outcome", "bad_request")
+
+    with stage("parse"):
+        param_mode, enc_picc_data_b, enc_file_data_b, sdmmac_b = parse_parameters(args, tenant)
+
+    def compute():
+        if counter_sync is not None:
+            counter_sync.ensure_started()
+
+        res = tenant.keys.decrypt_sun_message(param_mode=param_mode,
+                                              picc_enc_data=enc_picc_data_b,
+                                              sdmmac=sdmmac_b,
+                                              enc_file_data=enc_file_data_b,
+                                              read_ctr_check=check_read_ctr,
+                                              sdmmac_param=tenant.sdmmac_param)
+
+        if counter_store is not None:
+            counter_store.update(res['uid'], res['read_ctr'])
+
+        return res
 
     try:
-        res = decrypt_sun_message(param_mode=param_mode,
-                                  sdm_meta_read_key=derive_undiversified_key(MASTER_KEY, 1),
-                                  sdm_file_read_key=lambda uid: derive_tag_key(MASTER_KEY, uid, 2),
-                                  picc_enc_data=enc_picc_data_b,
-                                  sdmmac=sdmmac_b,
-                                  enc_file_data=enc_file_data_b)
+        with stage("verify"):
+            res, cached = cached_result(tenant, ("sun", param_mode, enc_picc_data_b, enc_file_data_b, sdmmac_b),
+                                        compute)
+    except ReplayedMessage:
+        annotate("outcome", "replayed")
+        record_scan(route, "replayed")
+        raise BadRequest("Replayed message (read counter was already used).") from None
     except InvalidMessage:
+        annotate("outcome", "invalid")
+        record_scan(route, "invalid")
         raise BadRequest("Invalid message (most probably wrong signature).") from InvalidMessage
 
-    if REQUIRE_LRP and res['encryption_mode'] != EncMode.LRP:
+    annotate("encryption_mode", res['encryption_mode'].name)
+
+    if tenant.require_lrp and res['encryption_mode'] != EncMode.LRP:
+        if not cached:
+            record_scan(route, "bad_request", res['uid'], res['read_ctr'], res['encryption_mode'].name)
+
         raise BadRequest("Invalid encryption mode, expected LRP.")
 
+    annotate("outcome", "ok")
+
     picc_data_tag = res['picc_data_tag']
     uid = res['uid']
     read_ctr_num = res['read_ctr']
@@ -252,52 +657,261 @@ def _internal_sdm(with_tt=False, force_json=False):
         file_data_utf8 = file_data_unpacked.decode('utf-8', 'ignore')
 
         if with_tt:
-            tt_perm_status = file_data[0:1].decode('ascii', 'replace')
-            tt_cur_status = file_data[1:2].decode('ascii', 'replace')
-
-            if tt_perm_status == 'C' and tt_cur_status == 'C':
-                tt_status_api = 'secure'
-                tt_status = 'OK (not tampered)'
-                tt_color = 'green'
-            elif tt_perm_status == 'O' and tt_cur_status == 'C':
-                tt_status_api = 'tampered_closed'
-                tt_status = 'Tampered! (loop closed)'
-                tt_color = 'red'
-            elif tt_perm_status == 'O' and tt_cur_status == 'O':
-                tt_status_api = 'tampered_open'
-                tt_status = 'Tampered! (loop open)'
-                tt_color = 'red'
-            elif tt_perm_status == 'I' and tt_cur_status == 'I':
-                tt_status_api = 'not_initialized'
-                tt_status = 'Not initialized'
-                tt_color = 'orange'
-            elif tt_perm_status == 'N' and tt_cur_status == 'T':
-                tt_status_api = 'not_supported'
-                tt_status = 'Not supported by the tag'
-                tt_color = 'orange'
-            else:
-                tt_status_api = 'unknown'
-                tt_status = 'Unknown'
-                tt_color = 'orange'
+            tt_status_api, tt_status, tt_color = tag_tamper_status(file_data)
 
-    if request.args.get("output") == "json" or force_json:
-        return jsonify({
-            "uid": uid.hex().upper(),
-            "file_data": file_data.hex() if file_data else None,
-            "read_ctr": read_ctr_num,
-            "tt_status": tt_status_api,
-            "enc_mode": encryption_mode
-        })
+    # the same URL fetched again (served from the result cache) isn't a new scan of the tag
+    if not cached:
+        record_scan(route, "ok", uid, read_ctr_num, encryption_mode, tt_status_api)
+
+    return {
+        "encryption_mode": encryption_mode,
+        "picc_data_tag": picc_data_tag,
+        "uid": uid,
+        "read_ctr_num": read_ctr_num,
+        "file_data": file_data,
+        "file_data_utf8": file_data_utf8,
+        "tt_status_api": tt_status_api,
+        "tt_status": tt_status,
+        "tt_color": tt_color
+    }
+
+
+def sdm_api_result(res, tenant=None):
+    result = {
+        "uid": res['uid'].hex().upper(),
+        "file_data": res['file_data'].hex() if res['file_data'] else None,
+        "read_ctr": res['read_ctr_num'],
+        "tt_status": res['tt_status_api'],
+        "enc_mode": res['encryption_mode']
+    }
+
+    token = sdm_token(res, tenant)
+
+    if token is not None:
+        result["token"] = token
+
+    return result
+
+
+def sdm_token(res, tenant=None):
+    token_signer = (tenant or default_tenant).token_signer
+
+    if token_signer is None:
+        return None
+
+    return token_signer.issue(res['uid'], res['read_ctr_num'], EncMode[res['encryption_mode']], res['tt_status_api'])
+
+
+def render_cache_metrics():
+    """
+    :return: counters of the per-tenant caches in Prometheus text format
+    """
+    lines = ["# HELP sdm_result_cache_requests_total Verification results served from the cache or computed.",
+             "# TYPE sdm_result_cache_requests_total counter"]
+
+    for tenant in tenants.tenants.values():
+        if tenant.result_cache is not None and tenant.result_cache.counters is not None:
+            values = tenant.result_cache.counters.collect()
+
+            for result in ("cached", "computed"):
+                lines.append(f'sdm_result_cache_requests_total{{tenant="{tenant.name}",result="{result}"}} '
+                             f'{int(values[result])}')
+
+    lines += ["# HELP sdm_mac_precompute_lookups_total Plaintext SDMMACs looked up in the precomputed table.",
+              "# TYPE sdm_mac_precompute_lookups_total counter"]
+
+    for tenant in tenants.tenants.values():
+        if tenant.mac_precomputer is not None and tenant.mac_precomputer.counters is not None:
+            values = tenant.mac_precomputer.counters.collect()
+
+            for slot, result in (("hits", "hit"), ("misses", "miss"), ("mismatches", "mismatch")):
+                lines.append(f'sdm_mac_precompute_lookups_total{{tenant="{tenant.name}",result="{result}"}} '
+                             f'{int(values[slot])}')
+
+    return "\n".join(lines) + "\n"
+
+
+def render_metrics():
+    """
+    :return: stage histograms, cache, event sink and admission control metrics in Prometheus text format
+    """
+    body = metrics_store.render() + render_cache_metrics()
+
+    if event_sink is not None:
+        body += event_sink.stats.render()
+
+    if admission is not None:
+        body += admission.render()
+
+    return body
+
+
+@app.route('/metrics')
+def sdm_metrics():
+    """
+    Stage latency histograms in Prometheus text format (aggregated over all worker processes).
+    """
+    if metrics_store is None:
+        raise NotFound()
+
+    response = make_response(render_metrics())
+    response.headers["Content-Type"] = "text/plain; version=0.0.4; charset=utf-8"
+    return response
+
+
+def check_debug_token():
+    """
+    :raises:
+        Forbidden: if DEBUG_TOKEN is not configured or the request doesn't carry it in X-Debug-Token header
+    """
+    token = request.headers.get("X-Debug-Token", "")
+
+    if not DEBUG_TOKEN or not hmac.compare_digest(token.encode('utf-8'), DEBUG_TOKEN.encode('utf-8')):
+        raise Forbidden("Debug token is required.")
+
+
+@app.route('/debug/allocations')
+def sdm_debug_allocations():
+    """
+    Top allocating source lines per endpoint (of the worker process which handles this request).
+    """
+    if alloc_profiler is None:
+        raise NotFound()
+
+    check_debug_token()
+
+    try:
+        top = int(request.args.get("top", "25"))
+    except ValueError:
+        raise BadRequest("Invalid top parameter.") from None
+
+    return jsonify(alloc_profiler.report(top=top))
+
+
+@app.route('/debug/heavy-hitters')
+def sdm_debug_heavy_hitters():
+    """
+    Most scanned and suddenly hot tags of the worker process which handles this request: the statistics
+    aren't shared, so with N workers the report covers about 1/N of the scans.
+    """
+    if heavy_hitters is None:
+        raise NotFound()
+
+    check_debug_token()
+
+    try:
+        top = int(request.args.get("top", "25"))
+    except ValueError:
+        raise BadRequest("Invalid top parameter.") from None
+
+    return jsonify(heavy_hitters.report(top=top))
+
+
+@app.route('/api/token')
+def sdm_api_token():
+    """
+    Validate verification token issued by one of the endpoints above.
+    """
+    try:
+        return jsonify(token_api_result(verify_token(request.args, request.cookies, current_tenant())))
+    except Forbidden as err:
+        return jsonify({"error": str(err)}), 403
+
+
+def verify_token(args, cookies, tenant=None):
+    """
+    Validate verification token (passed as "token" argument or in a cookie).
+    :param args: mapping of query arguments (e.g. request.args)
+    :param cookies: mapping of cookies (e.g. request.cookies)
+    :param tenant: tenant which issued the token (default tenant if None)
+    :return: dict as returned by TokenSigner.verify()
+    :raises:
+        NotFound: if tokens are not enabled
+        Forbidden: if the token is missing or invalid
+    """
+    token_signer = (tenant or default_tenant).token_signer
+
+    if token_signer is None:
+        raise NotFound()
+
+    token = args.get("token") or cookies.get(TOKEN_COOKIE)
+
+    if not token:
+        raise Forbidden("Verification token is required.")
+
+    try:
+        return token_signer.verify(token)
+    except InvalidToken as err:
+        raise Forbidden(str(err)) from None
+
+
+def token_api_result(res):
+    return {
+        "uid": res['uid'].hex().upper(),
+        "read_ctr": res['read_ctr'],
+        "enc_mode": res['encryption_mode'].name,
+        "tt_status": res['tt_status'],
+        "expires": res['expires']
+    }
+
+
+def token_cookie_header(token):
+    return dump_cookie(TOKEN_COOKIE, token, max_age=TOKEN_TTL, httponly=True, samesite="Lax")
+
+
+def with_token_cookie(response, token):
+    if token:
+        response.headers.add("Set-Cookie", token_cookie_header(token))
+
+    return response
+
+
+def _api_sdm(args, environ, with_tt):
+    tenant = environ.get(ENVIRON_KEY)
+    return sdm_api_result(verify_sdm(args, with_tt=with_tt, tenant=tenant), tenant)
+
+
+def _api_tagpt(args, environ):
+    tenant = environ.get(ENVIRON_KEY)
+    return tagpt_api_result(verify_tagpt(args, tenant), tenant)
+
+
+def _api_token(args, environ):
+    return token_api_result(verify_token(args, parse_cookie(environ), environ.get(ENVIRON_KEY)))
+
+
+if API_FAST_PATH:
+    api_app = APIApplication(routes={
+        '/api/tag': (lambda args, environ: _api_sdm(args, environ, with_tt=False), 200),
+        '/api/tagtt': (lambda args, environ: _api_sdm(args, environ, with_tt=True), 200),
+        '/api/tagpt': (_api_tagpt, None),
+        '/api/token': (_api_token, None),
+    }, token_cookie=token_cookie_header, fallback=app.wsgi_app)
+    app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {route: api_app.endpoint(route) for route in api_app.routes})
+
+if instrumentation.enabled:
+    app.wsgi_app = InstrumentMiddleware(app.wsgi_app, instrumentation)
+
+if alloc_profiler is not None:
+    app.wsgi_app = AllocationMiddleware(app.wsgi_app, alloc_profiler)
+
+if cpu_profiler is not None:
+    app.wsgi_app = CPUProfileMiddleware(app.wsgi_app, cpu_profiler)
+
+if admission is not None:
+    app.wsgi_app = AdmissionMiddleware(app.wsgi_app, admission)
+
+if ip_rate_limit is not None:
+    app.wsgi_app = RateLimitMiddleware(app.wsgi_app, ip_rate_limit, SUN_ROUTES)
+
+if len(tenants.tenants) > 1:
+    app.wsgi_app = TenantMiddleware(app.wsgi_app, tenants)
 
-    return render_template('sdm_info.html',
-                           encryption_mode=encryption_mode,
-                           picc_data_tag=picc_data_tag,
-                           uid=uid,
-                           read_ctr_num=read_ctr_num,
-                           file_data=file_data,
-                           file_data_utf8=file_data_utf8,
-                           tt_status=tt_status,
-                           tt_color=tt_color)
+if WARMUP:
+    # the last thing before uWSGI forks the workers
+    warmup(app, tenants.tenants.values(),
+           preload_uids=counter_store.recent(WARMUP_PRELOAD_KEYS)
+           if counter_store is not None else ())
 
 
 if __name__ == '__main__':
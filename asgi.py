@@ -0,0 +1,339 @@
+"""
+ASGI variant of the SUN backend server.
+
+Connections are handled on the event loop, while the verification (key derivation,
+decryption, MAC calculation) and template rendering are offloaded to a bounded
+thread or process executor.
+
+Verification tokens are validated at /api/token directly on the event loop.
+
+Run with any ASGI server, e.g.:
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from flask import render_template
+from werkzeug.exceptions import BadRequest, HTTPException, NotFound, TooManyRequests
+from werkzeug.http import parse_cookie
+
+from api_wsgi import json_body, parse_query_string
+from app import (
+    admission,
+    app,
+    instrumentation,
+    ip_rate_limit,
+    metrics_store,
+    render_metrics,
+    sdm_api_result,
+    sdm_token,
+    tagpt_api_result,
+    tagpt_token,
+    tenants,
+    token_api_result,
+    token_cookie_header,
+    verify_sdm,
+    verify_tagpt,
+    verify_token,
+)
+from config import ASGI_EXECUTOR, ASGI_MAX_PENDING, ASGI_MAX_WORKERS
+from libsdm.stages import stage
+from server.admission import DELAY_BUDGETS, parse_request_start
+from server.tenants import ENVIRON_KEY
+
+# path -> (plain SUN, with TagTamper, JSON output)
+ROUTES = {
+    '/tag': (False, False, False),
+    '/api/tag': (False, False, True),
+    '/tagtt': (False, True, False),
+    '/api/tagtt': (False, True, True),
+    '/tagpt': (True, False, False),
+    '/api/tagpt': (True, False, True),
+}
+
+CT_HTML = b"text/html; charset=utf-8"
+CT_JSON = b"application/json"
+CT_METRICS = b"text/plain; version=0.0.4; charset=utf-8"
+
+
+def _render(path: str, query_string: bytes, tenant, prefix: str, template: str, **kwargs) -> bytes:
+    # templates refer to request.full_path, request.script_root and the context processors
+    with stage("render"), app.test_request_context(path,
+                                                   base_url="http://localhost" + prefix,
+                                                   query_string=query_string.decode('latin-1'),
+                                                   environ_overrides={ENVIRON_KEY: tenant}):
+        return render_template(template, **kwargs).encode('utf-8')
+
+
+def _headers(content_type: bytes,
+             token: Optional[str] = None,
+             retry_after: Optional[int] = None) -> List[Tuple[bytes, bytes]]:
+    headers = [(b"content-type", content_type)]
+
+    if retry_after is not None:
+        headers.append((b"retry-after", str(retry_after).encode('ascii')))
+
+    if token:
+        headers.append((b"set-cookie", token_cookie_header(token).encode('latin-1')))
+
+    return headers
+
+
+def _rejection(path: str, err: HTTPException) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+    """
+    Cheap error response (429 or 503 with Retry-After) without rendering the error page
+    """
+    if path.startswith('/api/'):
+        return err.code, _headers(CT_JSON, retry_after=err.retry_after), json_body({"error": str(err)})
+
+    return err.code, _headers(CT_HTML, retry_after=err.retry_after), err.get_body().encode('utf-8')
+
+
+def handle_queued_request(queued: float,
+                          max_wait: Optional[float],
+                          *args) -> Tuple[float, Optional[Tuple[int, List[Tuple[bytes, bytes]], bytes]]]:
+    """
+    handle_request() unless the request waited in the executor queue for longer than max_wait seconds
+    :param queued: when the request was queued (seconds since epoch)
+    :return: tuple (seconds waited, response or None if the request was dropped)
+    """
+    waited = max(0.0, time.time() - queued)
+
+    if max_wait is not None and waited > max_wait:
+        return waited, None
+
+    return waited, handle_request(*args)
+
+
+def handle_request(path: str,
+                   query_string: bytes,
+                   tenant_name: str = "default",
+                   prefix: str = "") -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+    """
+    Verify the SUN message and build the response, mirroring the routes of app.py.
+    Executed inside the executor, so it must stay a picklable module-level function.
+    :param path: request path (without the tenant prefix)
+    :param tenant_name: name of the tenant in the registry
+    :param prefix: tenant path prefix
+    :return: tuple (status, headers, body)
+    """
+    started = instrumentation.start(path)
+
+    try:
+        status, headers, body = _handle_request(path, query_string, tenant_name, prefix)
+    finally:
+        extra_headers = instrumentation.finish(started, path)
+
+    headers += [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in extra_headers]
+    return status, headers, body
+
+
+def _handle_request(path: str,
+                    query_string: bytes,
+                    tenant_name: str,
+                    prefix: str) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+    tenant = tenants.tenants[tenant_name]
+
+    def render(template, **kwargs):
+        return _render(path, query_string, tenant, prefix, template, **kwargs)
+
+    if path == '/metrics' and metrics_store is not None:
+        return 200, [(b"content-type", CT_METRICS)], render_metrics().encode('utf-8')
+
+    if path not in ROUTES:
+        return 404, _headers(CT_HTML), render('error.html', code=404, msg=str(NotFound()))
+
+    plain, with_tt, force_json = ROUTES[path]
+    args = parse_query_string(query_string.decode('latin-1'))
+    want_json = force_json or args.get("output") == "json"
+
+    try:
+        if plain:
+            res = verify_tagpt(args, tenant)
+        else:
+            res = verify_sdm(args, with_tt=with_tt, tenant=tenant)
+    except BadRequest as err:
+        if force_json:
+            # /api/tagpt responds with 400, /api/tag and /api/tagtt with 200
+            return 400 if plain else 200, _headers(CT_JSON), json_body({"error": str(err)})
+
+        return 400, _headers(CT_HTML), render('error.html', code=400, msg=str(err))
+    except TooManyRequests as err:
+        if force_json:
+            return 429, _headers(CT_JSON, retry_after=err.retry_after), json_body({"error": str(err)})
+
+        return 429, _headers(CT_HTML, retry_after=err.retry_after), render('error.html', code=429, msg=str(err))
+
+    if want_json:
+        result = tagpt_api_result(res, tenant) if plain else sdm_api_result(res, tenant)
+        return 200, _headers(CT_JSON, result.get("token")), json_body(result)
+
+    if plain:
+        return 200, _headers(CT_HTML, tagpt_token(res, tenant)), render('sdm_info.html',
+                                                                        encryption_mode=res['encryption_mode'].name,
+                                                                        uid=res['uid'],
+                                                                        read_ctr_num=res['read_ctr'])
+
+    return 200, _headers(CT_HTML, sdm_token(res, tenant)), render('sdm_info.html',
+                                                                  encryption_mode=res['encryption_mode'],
+                                                                  picc_data_tag=res['picc_data_tag'],
+                                                                  uid=res['uid'],
+                                                                  read_ctr_num=res['read_ctr_num'],
+                                                                  file_data=res['file_data'],
+                                                                  file_data_utf8=res['file_data_utf8'],
+                                                                  tt_status=res['tt_status'],
+                                                                  tt_color=res['tt_color'])
+
+
+def handle_token(query_string: bytes, cookie: str, tenant=None) -> Tuple[int, List[Tuple[bytes, bytes]], bytes]:
+    """
+    Validate verification token. This takes a single HMAC, so it's executed directly on the event loop.
+    :return: tuple (status, headers, body)
+    """
+    try:
+        res = verify_token(parse_query_string(query_string.decode('latin-1')), parse_cookie(cookie), tenant)
+    except HTTPException as err:
+        return err.code, _headers(CT_JSON), json_body({"error": str(err)})
+
+    return 200, _headers(CT_JSON), json_body(token_api_result(res))
+
+
+class SDMApplication:
+    def __init__(self, executor: str = "thread", max_workers: int = 0, max_pending: int = 256):
+        """
+        ASGI application
+        :param executor: "thread" or "process"
+        :param max_workers: size of the executor (0 = number of CPU cores)
+        :param max_pending: maximum number of requests queued or running in the executor
+        """
+        if executor not in ("thread", "process"):
+            raise RuntimeError("Invalid ASGI_EXECUTOR.")
+
+        self.executor_kind = executor
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_pending = max_pending
+        self.executor: Optional[Executor] = None
+        self.pending: Optional[asyncio.Semaphore] = None
+
+    def startup(self):
+        if self.executor is not None:
+            return
+
+        if self.executor_kind == "process":
+            self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="sdm")
+
+        self.pending = asyncio.Semaphore(self.max_pending)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+
+            if message['type'] == 'lifespan.startup':
+                self.startup()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, send):
+        if scope['method'] not in ('GET', 'HEAD'):
+            await self._respond(send, scope, 405, [(b"content-type", b"text/plain")], b"Method Not Allowed")
+            return
+
+        headers = scope.get('headers', [])
+        host = b"".join(value for name, value in headers if name == b"host").decode('latin-1')
+        tenant, prefix, path = tenants.resolve(host, scope['path'])
+
+        if path == '/api/token':
+            cookie = b"; ".join(value for name, value in headers if name == b"cookie")
+            await self._respond(send, scope, *handle_token(scope['query_string'], cookie.decode('latin-1'), tenant))
+            return
+
+        if ip_rate_limit is not None and path in ROUTES:
+            client = scope.get('client') or ("", 0)
+
+            try:
+                # before the request is queued for the executor
+                ip_rate_limit.check(client[0].encode('ascii', 'replace'))
+            except TooManyRequests as err:
+                await self._respond(send, scope, *_rejection(path, err))
+                return
+
+        priority = admission.priorities.get(path) if admission is not None and path in ROUTES else None
+
+        if priority is None:
+            await self._respond(send, scope, *await self._execute(path, scope, tenant, prefix))
+            return
+
+        request_start = b"".join(value for name, value in headers if name == b"x-request-start").decode('latin-1')
+        delay = parse_request_start(request_start, time.time()) if request_start else None
+
+        if not admission.admit(priority, delay):
+            await self._respond(send, scope, *_rejection(path, admission.rejection()))
+            return
+
+        try:
+            # don't start the verification if the request waited for too long in the executor queue
+            max_wait = admission.target_delay * DELAY_BUDGETS[priority] if admission.overloaded else None
+            response = await self._execute(path, scope, tenant, prefix, priority, max_wait)
+        finally:
+            admission.release()
+
+        await self._respond(send, scope, *response)
+
+    # pylint: disable=too-many-arguments
+    async def _execute(self, path: str, scope, tenant, prefix: str, priority: Optional[int] = None,
+                       max_wait: Optional[float] = None):
+        # servers without lifespan support
+        self.startup()
+        queued = time.time()
+
+        async with self.pending:
+            loop = asyncio.get_running_loop()
+            waited, response = await loop.run_in_executor(
+                self.executor, handle_queued_request, queued, max_wait, path, scope['query_string'], tenant.name,
+                prefix)
+
+        if priority is not None:
+            admission.observe_delay(waited)
+
+            if response is None:
+                admission.shed(priority)
+                return _rejection(path, admission.rejection())
+
+        return response
+
+    @staticmethod
+    async def _respond(send, scope, status: int, headers: List[Tuple[bytes, bytes]], body: bytes):
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': headers + [(b"content-length", str(len(body)).encode('ascii'))]
+        })
+        await send({
+            'type': 'http.response.body',
+            'body': body if scope['method'] != 'HEAD' else b"",
+        })
+
+
+application = SDMApplication(executor=ASGI_EXECUTOR,
+                             max_workers=ASGI_MAX_WORKERS,
+                             max_pending=ASGI_MAX_PENDING)
@@ -0,0 +1,348 @@
+# pylint: disable=invalid-name
+
+"""
+In-process load test of the WSGI application.
+
+Valid SUN messages are generated for a set of simulated tags and replayed against app.app through
+the WSGI interface (no sockets, no HTTP parsing) from several threads and/or processes.
+Reports throughput, latency percentiles and CPU time per request. A response counts as an error if its status
+isn't 2xx or its JSON body contains the "error" key (e.g. /api/tag rejects messages with status 200).
+
+Usage (from the repository root):
+    python -m benchmarks.loadtest --requests 20000 --threads 4 --processes 2 \\
+        --mix tag=5,tagtt=2,tagpt=3 --lrp 0.5 --derive-mode standard --uids 1000
+
+The configuration from config.py is used, except of MASTER_KEY and DERIVE_MODE which are set
+from the command line. Every worker has its own subset of the tags and increments their read counters,
+so the messages pass replay protection as long as there are at least as many tags as workers.
+"""
+
+import argparse
+import binascii
+import io
+import json
+import multiprocessing
+import os
+import random
+import sys
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from benchmarks.runner import percentile
+from libsdm.encoder import DERIVE_MODES, encode_plain_sun, encode_sun_message, format_query
+from libsdm.sdm import EncMode, ParamMode
+
+ROUTES = ("tag", "tagtt", "tagpt")
+PERCENTILES = (50, 95, 99, 99.9)
+# TagTamper status "CC" (closed), length of the following data, data, padding
+FILE_DATA = b"CC\x08loadtestEEEEE"
+
+
+class _Tags:
+    def __init__(self, master_key: bytes, derive_mode: str, uids: List[bytes], sdmmac_param: str):
+        self.derive = DERIVE_MODES[derive_mode]
+        self.master_key = master_key
+        self.meta_key = self.derive.derive_undiversified_key(master_key, 1)
+        self.uids = uids
+        self.counters = {uid: 0 for uid in uids}
+        self.file_keys: Dict[bytes, bytes] = {}
+        self.sdmmac_param = sdmmac_param
+
+    def file_key(self, uid: bytes) -> bytes:
+        if uid not in self.file_keys:
+            self.file_keys[uid] = self.derive.derive_tag_key(self.master_key, uid, 2)
+
+        return self.file_keys[uid]
+
+    def message(self, route: str, mode: EncMode, param_mode: ParamMode, rand: random.Random, params: dict) -> str:
+        """
+        :return: query string of the next SUN message of a random tag
+        """
+        uid = rand.choice(self.uids)
+        self.counters[uid] += 1
+        file_key = self.file_key(uid)
+
+        if route == "tagpt":
+            return format_query(encode_plain_sun(uid, self.counters[uid], file_key),
+                                uid_param=params['uid'], ctr_param=params['ctr'], sdmmac_param=params['sdmmac'])
+
+        message = encode_sun_message(param_mode, self.meta_key, file_key, uid, self.counters[uid],
+                                     file_data=FILE_DATA if route == "tagtt" else None, mode=mode,
+                                     sdmmac_param=self.sdmmac_param, rand=rand.randbytes)
+        return format_query(message, param_mode, enc_picc_data_param=params['picc_data'],
+                            enc_file_data_param=params['enc'], sdmmac_param=params['sdmmac'])
+
+
+def _load_app(options: dict):
+    import config  # pylint: disable=import-outside-toplevel
+
+    config.MASTER_KEY = binascii.unhexlify(options["master_key"])
+    config.DERIVE_MODE = options["derive_mode"]
+
+    import app  # pylint: disable=import-outside-toplevel
+    return app.app, config
+
+
+def _messages(options: dict, config, worker: int, workers: int) -> List[Tuple[str, str]]:
+    rand = random.Random(options["seed"] * 1000003 + worker)
+    all_uids = [b"\x04" + random.Random(options["seed"] + i).randbytes(6) for i in range(options["uids"])]
+    uids = all_uids[worker::workers] or all_uids
+    tags = _Tags(binascii.unhexlify(options["master_key"]), options["derive_mode"], uids, config.SDMMAC_PARAM)
+    params = {
+        "picc_data": config.ENC_PICC_DATA_PARAM,
+        "enc": config.ENC_FILE_DATA_PARAM,
+        "sdmmac": config.SDMMAC_PARAM,
+        "uid": config.UID_PARAM,
+        "ctr": config.CTR_PARAM
+    }
+    routes = [route for route in ROUTES if options["mix"].get(route)]
+    weights = [options["mix"][route] for route in routes]
+    messages = []
+
+    for _ in range(options["requests"] // workers):
+        route = rand.choices(routes, weights)[0]
+        mode = EncMode.LRP if rand.random() < options["lrp"] else EncMode.AES
+        param_mode = ParamMode.BULK if rand.random() < options["bulk"] else ParamMode.SEPARATED
+        messages.append((f"/api/{route}", tags.message(route, mode, param_mode, rand, params)))
+
+    return messages
+
+
+def _environ(path: str, query_string: str) -> dict:
+    return {
+        "REQUEST_METHOD": "GET",
+        "SCRIPT_NAME": "",
+        "PATH_INFO": path,
+        "QUERY_STRING": query_string,
+        "SERVER_NAME": "localhost",
+        "SERVER_PORT": "80",
+        "SERVER_PROTOCOL": "HTTP/1.1",
+        "REMOTE_ADDR": "127.0.0.1",
+        "HTTP_HOST": "localhost",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+
+
+def _request(application, path: str, query_string: str) -> Tuple[str, bytes]:
+    """
+    :return: tuple (status line, body)
+    """
+    status = []
+
+    def start_response(status_line, headers, exc_info=None):  # pylint: disable=unused-argument
+        status.append(status_line)
+
+    response = application(_environ(path, query_string), start_response)
+
+    try:
+        body = b"".join(response)
+    finally:
+        if hasattr(response, 'close'):
+            response.close()
+
+    return status[0] if status else "", body
+
+
+def _error(status: str, body: bytes) -> Optional[str]:
+    """
+    :return: reason of the failure or None if the request succeeded
+    """
+    if not status.startswith("2"):
+        return status or "no response"
+
+    try:
+        result = json.loads(body)
+    except ValueError:
+        return None
+
+    if isinstance(result, dict) and "error" in result:
+        return str(result["error"])
+
+    return None
+
+
+def _run_threads(application, messages: List[List[Tuple[str, str]]]) -> dict:
+    barrier = threading.Barrier(len(messages) + 1)
+    latencies: List[List[int]] = [[] for _ in messages]
+    errors: List[Dict[str, int]] = [{} for _ in messages]
+
+    def worker(index: int):
+        barrier.wait()
+        own = latencies[index]
+        own_errors = errors[index]
+
+        for path, query_string in messages[index]:
+            before = time.perf_counter_ns()
+            status, body = _request(application, path, query_string)
+            own.append(time.perf_counter_ns() - before)
+            error = _error(status, body)
+
+            if error is not None:
+                own_errors[error] = own_errors.get(error, 0) + 1
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(len(messages))]
+
+    for thread in threads:
+        thread.start()
+
+    cpu_before = time.process_time()
+    barrier.wait()
+    started = time.time()
+
+    for thread in threads:
+        thread.join()
+
+    return {
+        "latencies": [value for own in latencies for value in own],
+        "errors": _merge_errors(errors),
+        "cpu": time.process_time() - cpu_before,
+        "started": started,
+        "finished": time.time()
+    }
+
+
+def _merge_errors(parts: List[Dict[str, int]]) -> Dict[str, int]:
+    """
+    :return: number of the failed requests by reason
+    """
+    merged: Dict[str, int] = {}
+
+    for part in parts:
+        for reason, count in part.items():
+            merged[reason] = merged.get(reason, 0) + count
+
+    return merged
+
+
+def _process(options: dict, process: int, results):
+    application, config = _load_app(options)
+    threads = options["threads"]
+    workers = options["processes"] * threads
+    messages = [_messages(options, config, process * threads + thread, workers) for thread in range(threads)]
+    results.put(_run_threads(application, messages))
+
+
+def run(options: dict) -> dict:
+    """
+    :param options: master_key (hex), derive_mode, requests, threads, processes, mix (route -> weight),
+                    lrp (fraction of LRP messages), bulk (fraction of BULK messages), uids, seed
+    :return: summary of the run
+    """
+    if options["processes"] > 1:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        results = context.Queue()
+        processes = [context.Process(target=_process, args=(options, index, results))
+                     for index in range(options["processes"])]
+
+        for process in processes:
+            process.start()
+
+        parts = [results.get() for _ in processes]
+
+        for process in processes:
+            process.join()
+    else:
+        application, config = _load_app(options)
+        workers = options["threads"]
+        parts = [_run_threads(application, [_messages(options, config, worker, workers) for worker in range(workers)])]
+
+    latencies = sorted(value for part in parts for value in part["latencies"])
+    elapsed = max(part["finished"] for part in parts) - min(part["started"] for part in parts)
+    cpu = sum(part["cpu"] for part in parts)
+
+    errors = _merge_errors([part["errors"] for part in parts])
+
+    summary = {
+        "requests": len(latencies),
+        "errors": sum(errors.values()),
+        "elapsed_s": elapsed,
+        "requests_per_sec": len(latencies) / elapsed if elapsed else 0.0,
+        "cpu_per_request_ms": cpu / len(latencies) * 1e3 if latencies else 0.0,
+        "mean_ms": sum(latencies) / len(latencies) / 1e6 if latencies else 0.0,
+    }
+
+    for pct in PERCENTILES:
+        summary[f"p{pct:g}_ms".replace(".", "")] = percentile(latencies, pct) / 1e6
+
+    # number of the failed requests by reason (status line or the "error" of the JSON response)
+    summary["error_reasons"] = errors
+    return summary
+
+
+def parse_mix(value: str) -> Dict[str, float]:
+    """
+    "tag=5,tagtt=2,tagpt=3" -> {"tag": 5.0, "tagtt": 2.0, "tagpt": 3.0}
+    """
+    mix = {}
+
+    for item in value.split(","):
+        route, _, weight = item.partition("=")
+        route = route.strip()
+
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f"Unknown route: {route}")
+
+        mix[route] = float(weight) if weight else 1.0
+
+    if not any(mix.values()):
+        raise argparse.ArgumentTypeError("At least one route must have non-zero weight.")
+
+    return mix
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='In-process load test of the WSGI application')
+    parser.add_argument('--requests', type=int, default=10000, help='total number of requests')
+    parser.add_argument('--threads', type=int, default=4, help='threads per process')
+    parser.add_argument('--processes', type=int, default=1, help='number of processes')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix("tag=1,tagtt=1,tagpt=1"),
+                        help='route weights, e.g. tag=5,tagtt=2,tagpt=3')
+    parser.add_argument('--lrp', type=float, default=0.0, help='fraction of LRP messages (tag and tagtt)')
+    parser.add_argument('--bulk', type=float, default=0.0, help='fraction of messages in BULK parameter mode')
+    parser.add_argument('--derive-mode', choices=('legacy', 'standard'), default='standard')
+    parser.add_argument('--master-key', type=str, default="00112233445566778899AABBCCDDEEFF",
+                        help='master key (hex); all-zeros key skips the key derivation')
+    parser.add_argument('--uids', type=int, default=1000, help='number of distinct tags')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the summary as JSON')
+    args = parser.parse_args(argv)
+
+    options = {
+        "master_key": args.master_key,
+        "derive_mode": args.derive_mode,
+        "requests": args.requests,
+        "threads": args.threads,
+        "processes": args.processes,
+        "mix": args.mix,
+        "lrp": args.lrp,
+        "bulk": args.bulk,
+        "uids": args.uids,
+        "seed": args.seed,
+    }
+    summary = run(options)
+
+    if args.json:
+        print(json.dumps(dict(summary, options=options), indent=2))
+    else:
+        for key, value in summary.items():
+            if key == "error_reasons":
+                for reason, count in sorted(value.items(), key=lambda item: -item[1]):
+                    print(f"{'error':<20} {count} x {reason}")
+            else:
+                print(f"{key:<20} {value:.3f}" if isinstance(value, float) else f"{key:<20} {value}")
+
+        print(f"{'pid':<20} {os.getpid()}")
+
+    return 1 if summary["errors"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
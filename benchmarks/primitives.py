@@ -0,0 +1,153 @@
+# pylint: disable=invalid-name
+
+"""
+Microbenchmarks of the libsdm primitives and of complete SUN message verification.
+
+Usage (from the repository root):
+    python -m benchmarks.primitives                         # run all cases
+    python -m benchmarks.primitives -k lrp -k verify.aes    # run the cases matching any of the substrings
+    python -m benchmarks.primitives --save baseline.json    # store the results as a baseline
+    python -m benchmarks.primitives --compare baseline.json --threshold 0.1
+                                                            # exit with 1 if any case got >10% slower
+
+The messages come from the AN12196/AN12304 vectors used in tests/. Without SDMEncFileData the SDMMAC
+is the same in both parameter modes; with it, the MAC of the other mode is recalculated for the same
+ciphertexts, so that every combination (AES/LRP x SEPARATED/BULK x with/without file data) is covered.
+"""
+
+import argparse
+import binascii
+import struct
+import sys
+from typing import Callable, List, Tuple
+
+from benchmarks import runner
+from libsdm import derive, legacy_derive
+from libsdm.lrp import LRP
+from libsdm.sdm import (
+    EncMode,
+    ParamMode,
+    calculate_sdmmac,
+    decrypt_sun_message,
+    validate_plain_sun,
+)
+
+ZERO_KEY = b"\x00" * 16
+SDMMAC_PARAM = "cmac"
+MASTER_KEY = binascii.unhexlify("C9EB67DF090AFF47C3B19A2516680B9D")
+UID = binascii.unhexlify("04958CAA5C5E80")
+
+# (name, encryption mode, picc_enc_data, enc_file_data, parameter mode of sdmmac, sdmmac)
+MESSAGES = [
+    ("aes", EncMode.AES, "EF963FF7828658A599F3041510671E88", None,
+     ParamMode.SEPARATED, "94EED9EE65337086"),
+    ("aes.file", EncMode.AES, "FD91EC264309878BE6345CBE53BADF40", "CEE9A53E3E463EF1F459635736738962",
+     ParamMode.SEPARATED, "ECC1E7F6C6C73BF6"),
+    ("lrp", EncMode.LRP, "1FCBE61B3E4CAD980CBFDD333E7A4AC4A579569BAFD22C5F", None,
+     ParamMode.SEPARATED, "4231608BA7B02BA9"),
+    ("lrp.file", EncMode.LRP, "07D9CA2545881D4BFDD920BE1603268C0714420DD893A497", "D6E921C47DB4C17C56F979F81559BB83",
+     ParamMode.SEPARATED, "F9481AC7D855BDB6"),
+]
+
+Case = Tuple[str, Callable[[], object]]
+
+
+def _decrypt(param_mode: ParamMode, picc_enc_data: bytes, enc_file_data, sdmmac: bytes) -> dict:
+    return decrypt_sun_message(param_mode=param_mode,
+                               sdm_meta_read_key=ZERO_KEY,
+                               sdm_file_read_key=lambda _: ZERO_KEY,
+                               picc_enc_data=picc_enc_data,
+                               sdmmac=sdmmac,
+                               enc_file_data=enc_file_data,
+                               sdmmac_param=SDMMAC_PARAM)
+
+
+def primitive_cases() -> List[Case]:
+    lrp_key = binascii.unhexlify("567826B8DA8E768432A9548DBE4AA3A0")
+    plaintexts = LRP.generate_plaintexts(lrp_key)
+    updated_key = LRP.generate_updated_keys(lrp_key)[2]
+    block = binascii.unhexlify("BB4FCF27C94076F756AB030D00000000")
+    message = binascii.unhexlify("BBD5B85772C7" * 8)
+    cmac_lrp = LRP(binascii.unhexlify("8195088CE6C393708EBBE6C7914ECB0B"), 0)
+
+    return [
+        ("lrp.eval_lrp", lambda: LRP.eval_lrp(plaintexts, updated_key, block, True)),
+        ("lrp.cmac", lambda: cmac_lrp.cmac(message)),
+        ("lrp.init", lambda: LRP(lrp_key, 0)),
+        ("derive.tag_key", lambda: derive.derive_tag_key(MASTER_KEY, UID, 2)),
+        ("derive.undiversified_key", lambda: derive.derive_undiversified_key(MASTER_KEY, 1)),
+        ("legacy_derive.tag_key", lambda: legacy_derive.derive_tag_key(MASTER_KEY, UID, 2)),
+        ("legacy_derive.undiversified_key", lambda: legacy_derive.derive_undiversified_key(MASTER_KEY, 1)),
+    ]
+
+
+def verification_cases() -> List[Case]:
+    cases = []
+
+    for name, mode, picc_enc_data, enc_file_data, vector_param_mode, sdmmac in MESSAGES:
+        picc_enc_data = binascii.unhexlify(picc_enc_data)
+        enc_file_data = binascii.unhexlify(enc_file_data) if enc_file_data else None
+        res = _decrypt(vector_param_mode, picc_enc_data, enc_file_data, binascii.unhexlify(sdmmac))
+        picc_data = res['uid'] + struct.pack("<I", res['read_ctr'])[:3]
+
+        for param_mode in (ParamMode.SEPARATED, ParamMode.BULK):
+            mac = calculate_sdmmac(param_mode, ZERO_KEY, picc_data, enc_file_data, mode=mode,
+                                   sdmmac_param=SDMMAC_PARAM)
+            # fail early if the message doesn't verify
+            _decrypt(param_mode, picc_enc_data, enc_file_data, mac)
+            cases.append((f"verify.{name}.{param_mode.name.lower()}",
+                          lambda args=(param_mode, picc_enc_data, enc_file_data, mac): _decrypt(*args)))
+
+    plain_sdmmac = binascii.unhexlify("4B00064004B0B3D3")
+    cases.append(("verify.plain", lambda: validate_plain_sun(uid=binascii.unhexlify("041E3C8A2D6B80"),
+                                                             read_ctr=binascii.unhexlify("000006"),
+                                                             sdmmac=plain_sdmmac,
+                                                             sdm_file_read_key=ZERO_KEY)))
+    return cases
+
+
+def all_cases() -> List[Case]:
+    return primitive_cases() + verification_cases()
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='libsdm microbenchmarks')
+    parser.add_argument('-k', '--filter', action='append', help='run only the cases containing this substring')
+    parser.add_argument('--duration', type=float, default=1.0, help='measured seconds per case')
+    parser.add_argument('--warmup', type=float, default=0.1, help='warmup seconds per case')
+    parser.add_argument('--save', type=str, help='store the results as a JSON baseline')
+    parser.add_argument('--compare', type=str, help='compare the results with a JSON baseline')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='relative throughput drop reported as a regression (default: 0.1)')
+    parser.add_argument('--list', action='store_true', help='list the cases and exit')
+    args = parser.parse_args(argv)
+
+    cases = runner.filter_cases(all_cases(), args.filter)
+
+    if args.list:
+        for name, _ in cases:
+            print(name)
+
+        return 0
+
+    document = runner.run(cases, duration=args.duration, warmup=args.warmup,
+                          report=lambda name, result: print(runner.format_result(name, result), flush=True))
+
+    if args.save:
+        runner.save(args.save, document)
+
+    if args.compare:
+        rows = runner.compare(runner.load(args.compare), document, threshold=args.threshold)
+        print()
+
+        for row in rows:
+            print(runner.format_comparison(row))
+
+        if any(row["regression"] for row in rows):
+            return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
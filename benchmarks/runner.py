@@ -0,0 +1,147 @@
+"""
+Minimal benchmark runner: measures the latency of every call, reports ops/sec and latency percentiles,
+stores the results as a JSON baseline and compares a run against a stored baseline.
+"""
+
+import json
+import math
+import platform
+import sys
+import time
+from typing import Callable, Iterable, List, Optional, Tuple
+
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """
+    Nearest-rank percentile of already sorted values
+    """
+    if not sorted_values:
+        return 0.0
+
+    rank = max(0, min(len(sorted_values) - 1, math.ceil(pct / 100.0 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def measure(func: Callable[[], object],
+            duration: float = 1.0,
+            warmup: float = 0.1,
+            min_calls: int = 10,
+            clock: Callable[[], int] = time.perf_counter_ns) -> dict:
+    """
+    Call func() repeatedly for the given number of seconds (after the warmup)
+    :return: calls, ops_per_sec and mean/min/max/pNN latencies (in microseconds)
+    """
+    deadline = clock() + int(warmup * 1e9)
+
+    while clock() < deadline:
+        func()
+
+    latencies = []
+    started = clock()
+    deadline = started + int(duration * 1e9)
+
+    while len(latencies) < min_calls or clock() < deadline:
+        before = clock()
+        func()
+        latencies.append(clock() - before)
+
+    elapsed = clock() - started
+    latencies.sort()
+    result = {
+        "calls": len(latencies),
+        "ops_per_sec": len(latencies) / (elapsed / 1e9) if elapsed else 0.0,
+        "mean_us": sum(latencies) / len(latencies) / 1e3,
+        "min_us": latencies[0] / 1e3,
+        "max_us": latencies[-1] / 1e3,
+    }
+
+    for pct in PERCENTILES:
+        result[f"p{pct}_us"] = percentile(latencies, pct) / 1e3
+
+    return result
+
+
+def run(cases: Iterable[Tuple[str, Callable[[], object]]],
+        duration: float = 1.0,
+        warmup: float = 0.1,
+        report: Optional[Callable[[str, dict], None]] = None) -> dict:
+    """
+    Measure all cases
+    :return: baseline document {"meta": {...}, "results": {name: measurement}}
+    """
+    results = {}
+
+    for name, func in cases:
+        results[name] = measure(func, duration=duration, warmup=warmup)
+
+        if report is not None:
+            report(name, results[name])
+
+    return {
+        "meta": {
+            "python": sys.version.split()[0],
+            "implementation": platform.python_implementation(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "timestamp": int(time.time()),
+        },
+        "results": results
+    }
+
+
+def save(path: str, document: dict):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(document, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def load(path: str) -> dict:
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.1) -> List[dict]:
+    """
+    Compare throughput of the cases present in both runs
+    :param threshold: relative slowdown (0.1 = 10% less ops/sec) reported as a regression
+    :return: per case: name, baseline and current ops/sec, change (relative), regression (bool)
+    """
+    rows = []
+
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+
+        if base is None or not base["ops_per_sec"]:
+            continue
+
+        change = result["ops_per_sec"] / base["ops_per_sec"] - 1.0
+        rows.append({
+            "name": name,
+            "baseline": base["ops_per_sec"],
+            "current": result["ops_per_sec"],
+            "change": change,
+            "regression": change < -threshold
+        })
+
+    return rows
+
+
+def format_result(name: str, result: dict) -> str:
+    percentiles = "  ".join(f"p{pct} {result[f'p{pct}_us']:>9.1f}" for pct in PERCENTILES)
+    return f"{name:<40} {result['ops_per_sec']:>12.1f} ops/s  {percentiles} us"
+
+
+def format_comparison(row: dict) -> str:
+    flag = "  REGRESSION" if row["regression"] else ""
+    return f"{row['name']:<40} {row['baseline']:>12.1f} -> {row['current']:>12.1f} ops/s  " \
+           f"{row['change'] * 100:+7.1f}%{flag}"
+
+
+def filter_cases(cases: Iterable[Tuple[str, Callable[[], object]]],
+                 patterns: Optional[List[str]]) -> List[Tuple[str, Callable[[], object]]]:
+    if not patterns:
+        return list(cases)
+
+    return [(name, func) for name, func in cases if any(pattern in name for pattern in patterns)]
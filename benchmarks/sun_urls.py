@@ -0,0 +1,69 @@
+"""
+Generate valid SUN URLs of simulated tags, one per line.
+
+Usage (from the repository root):
+    python -m benchmarks.sun_urls --master-key 00112233445566778899AABBCCDDEEFF --tags 1000 --taps 1000 \\
+        --base-url https://sdm.example.com/api/tag > urls.txt
+"""
+
+import argparse
+import binascii
+import random
+import sys
+from typing import List, Optional
+
+from libsdm.encoder import format_query, generate_sun_messages
+from libsdm.sdm import EncMode, ParamMode
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Generate SUN URLs of simulated tags')
+    parser.add_argument('--master-key', type=str, default="00000000000000000000000000000000")
+    parser.add_argument('--derive-mode', choices=('legacy', 'standard'), default='standard')
+    parser.add_argument('--base-url', type=str, default="http://localhost:5000/api/tag")
+    parser.add_argument('--tags', type=int, default=1000, help='number of distinct tags')
+    parser.add_argument('--taps', type=int, default=1, help='messages per tag (consecutive read counters)')
+    parser.add_argument('--start-ctr', type=int, default=1, help='read counter of the first message of every tag')
+    parser.add_argument('--lrp', action='store_true', help='LRP instead of AES')
+    parser.add_argument('--bulk', action='store_true', help='BULK parameter mode (single "e" parameter)')
+    parser.add_argument('--file-data', type=str, help='file data to encrypt (16 bytes, e.g. "CCxxxxxxxxxxxxxx")')
+    parser.add_argument('--plain', action='store_true', help='plaintext SUN messages (uid, ctr, cmac)')
+    parser.add_argument('--enc-picc-data-param', type=str, default="picc_data")
+    parser.add_argument('--enc-file-data-param', type=str, default="enc")
+    parser.add_argument('--sdmmac-param', type=str, default="cmac")
+    parser.add_argument('--uid-param', type=str, default="uid")
+    parser.add_argument('--ctr-param', type=str, default="ctr")
+    parser.add_argument('--processes', type=int, help='worker processes (default: number of CPUs)')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the tag UIDs')
+    args = parser.parse_args(argv)
+
+    rand = random.Random(args.seed)
+    uids = [b"\x04" + rand.randbytes(6) for _ in range(args.tags)]
+    param_mode = ParamMode.BULK if args.bulk else ParamMode.SEPARATED
+    messages = generate_sun_messages(binascii.unhexlify(args.master_key),
+                                     uids,
+                                     taps=args.taps,
+                                     derive_mode=args.derive_mode,
+                                     start_ctr=args.start_ctr,
+                                     mode=EncMode.LRP if args.lrp else EncMode.AES,
+                                     param_mode=param_mode,
+                                     file_data=args.file_data.encode('ascii') if args.file_data else None,
+                                     plain=args.plain,
+                                     sdmmac_param=args.sdmmac_param,
+                                     processes=args.processes)
+    out = sys.stdout
+
+    for message in messages:
+        out.write(args.base_url + "?" + format_query(message,
+                                                     param_mode=param_mode,
+                                                     enc_picc_data_param=args.enc_picc_data_param,
+                                                     enc_file_data_param=args.enc_file_data_param,
+                                                     sdmmac_param=args.sdmmac_param,
+                                                     uid_param=args.uid_param,
+                                                     ctr_param=args.ctr_param) + "\n")
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,183 @@
+"""
+Unique memory of forked worker processes, with and without the pre-fork warmup (server.warmup).
+
+For every variant, the application is loaded in a master process (like uWSGI without lazy-apps),
+optionally warmed up and frozen, and several workers are forked from it. Every worker reports its
+unique set size (USS - pages not shared with any other process) right after the fork and after serving
+the same kind of requests as the load test, followed by a full garbage collection (as would eventually happen
+in a long-running worker).
+
+Usage (from the repository root):
+    python -m benchmarks.worker_memory --workers 4 --requests 4000 --derive-mode legacy --lrp 0.5
+
+The workers of a running uWSGI instance can be measured as well (e.g. before and after a load test):
+    python -m benchmarks.worker_memory --pid <pid of the uWSGI master>
+
+Linux only (/proc/<pid>/smaps_rollup).
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import sys
+from typing import Dict, List, Optional
+
+from benchmarks.loadtest import _error, _load_app, _messages, _request, parse_mix
+
+VARIANTS = ("cold", "warm")
+
+
+def parse_smaps_rollup(text: str) -> Dict[str, int]:
+    """
+    :return: rss, pss and uss (private clean + private dirty) in kB
+    """
+    values = {}
+
+    for line in text.splitlines():
+        name, _, rest = line.partition(":")
+        fields = rest.split()
+
+        if len(fields) == 2 and fields[1] == "kB":
+            values[name] = int(fields[0])
+
+    return {
+        "rss": values.get("Rss", 0),
+        "pss": values.get("Pss", 0),
+        "uss": values.get("Private_Clean", 0) + values.get("Private_Dirty", 0)
+    }
+
+
+def memory(pid="self") -> Dict[str, int]:
+    with open(f"/proc/{pid}/smaps_rollup", "r", encoding="ascii") as f:
+        return parse_smaps_rollup(f.read())
+
+
+def children(pid: int) -> List[int]:
+    pids = []
+
+    for task in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{task}/children", "r", encoding="ascii") as f:
+            pids += [int(child) for child in f.read().split()]
+
+    return sorted(pids)
+
+
+def _worker(application, options: dict, config, worker: int, results):
+    messages = _messages(options, config, worker, options["workers"])
+    before = memory()
+    errors = 0
+
+    for path, query_string in messages:
+        if _error(*_request(application, path, query_string)) is not None:
+            errors += 1
+
+    gc.collect()
+    results.put({"worker": worker, "after_fork": before, "after_requests": memory(), "errors": errors})
+
+
+def _master(options: dict, variant: str, results):
+    application, config = _load_app(options)
+
+    if variant == "warm":
+        import app  # pylint: disable=import-outside-toplevel
+        from server.warmup import warmup  # pylint: disable=import-outside-toplevel
+
+        warmup(app.app, app.tenants.tenants.values())
+
+    context = multiprocessing.get_context("fork")
+    workers = [context.Process(target=_worker, args=(application, options, config, index, results))
+               for index in range(options["workers"])]
+
+    for worker in workers:
+        worker.start()
+
+    for worker in workers:
+        worker.join()
+
+
+def run(options: dict) -> dict:
+    """
+    :param options: master_key (hex), derive_mode, requests (per worker), workers, mix, lrp, bulk, uids, seed
+    :return: variant -> worker reports, ordered by worker
+    """
+    context = multiprocessing.get_context("fork")
+    reports = {}
+
+    for index, variant in enumerate(VARIANTS):
+        # other tags for every variant, in case the read counters are persisted (replay protection)
+        variant_options = dict(options, seed=options["seed"] + index * 1000003,
+                               requests=options["requests"] * options["workers"])
+        results = context.Queue()
+        master = context.Process(target=_master, args=(variant_options, variant, results))
+        master.start()
+        reports[variant] = sorted((results.get() for _ in range(options["workers"])), key=lambda r: r["worker"])
+        master.join()
+
+    return reports
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Unique memory of forked workers with and without warmup')
+    parser.add_argument('--pid', type=int, help='report the workers of a running uWSGI master instead')
+    parser.add_argument('--workers', type=int, default=4, help='number of forked workers')
+    parser.add_argument('--requests', type=int, default=1000, help='requests per worker')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix("tag=1,tagtt=1,tagpt=1"),
+                        help='route weights, e.g. tag=5,tagtt=2,tagpt=3')
+    parser.add_argument('--lrp', type=float, default=0.0, help='fraction of LRP messages (tag and tagtt)')
+    parser.add_argument('--bulk', type=float, default=0.0, help='fraction of messages in BULK parameter mode')
+    parser.add_argument('--derive-mode', choices=('legacy', 'standard'), default='standard')
+    parser.add_argument('--master-key', type=str, default="00112233445566778899AABBCCDDEEFF",
+                        help='master key (hex); all-zeros key skips the key derivation')
+    parser.add_argument('--uids', type=int, default=1000, help='number of distinct tags')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the reports as JSON')
+    args = parser.parse_args(argv)
+
+    if args.pid:
+        reports = {pid: memory(pid) for pid in [args.pid] + children(args.pid)}
+
+        if args.json:
+            print(json.dumps(reports, indent=2))
+        else:
+            print(f"{'pid':<10} {'rss_kb':>10} {'pss_kb':>10} {'uss_kb':>10}")
+
+            for pid, values in reports.items():
+                print(f"{pid:<10} {values['rss']:>10} {values['pss']:>10} {values['uss']:>10}")
+
+        return 0
+
+    options = {
+        "master_key": args.master_key,
+        "derive_mode": args.derive_mode,
+        "requests": args.requests,
+        "workers": args.workers,
+        "mix": args.mix,
+        "lrp": args.lrp,
+        "bulk": args.bulk,
+        "uids": args.uids,
+        "seed": args.seed,
+    }
+    reports = run(options)
+
+    if args.json:
+        print(json.dumps(dict(reports, options=options), indent=2))
+    else:
+        print(f"{'variant':<8} {'worker':>6} {'uss_fork_kb':>12} {'uss_kb':>10} {'pss_kb':>10} {'errors':>7}")
+
+        for variant, workers in reports.items():
+            for report in workers:
+                print(f"{variant:<8} {report['worker']:>6} {report['after_fork']['uss']:>12} "
+                      f"{report['after_requests']['uss']:>10} {report['after_requests']['pss']:>10} "
+                      f"{report['errors']:>7}")
+
+        for variant, workers in reports.items():
+            mean = sum(report['after_requests']['uss'] for report in workers) / len(workers)
+            print(f"{variant:<8} mean uss_kb {mean:.0f}")
+
+    return 1 if any(report["errors"] for workers in reports.values() for report in workers) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
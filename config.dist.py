@@ -17,3 +17,184 @@ SDMMAC_PARAM = "cmac"
 
 # accept only SDM using LRP, disallow usage of AES
 REQUIRE_LRP = False
+
+# ASGI variant (asgi.py): run verification in "thread" or "process" executor
+# ASGI_MAX_WORKERS = 0 means one worker per CPU core
+ASGI_EXECUTOR = "thread"
+ASGI_MAX_WORKERS = 0
+# maximum number of requests waiting for or running in the executor
+ASGI_MAX_PENDING = 256
+
+# serve /api/tag, /api/tagtt and /api/tagpt through the lean WSGI application (api_wsgi.py)
+# instead of going through Flask
+API_FAST_PATH = True
+
+# short-TTL cache of verification results for repeated identical SUN URLs
+# RESULT_CACHE_SIZE = 0 disables the cache
+RESULT_CACHE_SIZE = 0
+RESULT_CACHE_TTL = 10.0
+# also cache rejected messages (invalid signature)
+RESULT_CACHE_REJECTIONS = False
+
+# issue signed short-lived verification tokens (returned in JSON and as a cookie)
+# which can be validated through /api/token without repeating SUN verification
+# TOKEN_KEY = None disables the tokens, otherwise use random secret, e.g. binascii.unhexlify("...")
+TOKEN_KEY = None
+TOKEN_TTL = 300
+TOKEN_COOKIE = "sdm_token"
+
+# reject messages with read counter not higher than the last one seen for the given UID
+# (the result cache is disabled then, as a cached result would be served without the check)
+# the counters are shared by the worker processes (uWSGI workers) of the instance through a memory-mapped table,
+# set COUNTER_SYNC to share them with other instances
+REPLAY_PROTECTION = False
+# directory for the shared counter table, the write-ahead log and snapshots
+# (None = table in a temporary directory removed on exit, no log)
+COUNTER_STORE_DIR = None
+# capacity of the shared counter table (number of tags, the counters above it are kept by each worker only)
+COUNTER_STORE_SLOTS = 262144
+COUNTER_STORE_COMPACT_EVERY = 100000
+COUNTER_STORE_FSYNC = False
+
+# share the highest read counters between several instances (requires REPLAY_PROTECTION)
+# COUNTER_SYNC = None (disabled), "udp" (datagrams to COUNTER_SYNC_PEERS) or "dir" (batch files in shared COUNTER_SYNC_DIR)
+# with "udp", each of the COUNTER_SYNC_WORKERS worker processes (uWSGI workers) of a node receives on its own port,
+# COUNTER_SYNC_BIND port + worker index (checked at startup against the number of uWSGI workers),
+# the peers are listed with the port of their first worker; a failed bind is logged and retried in the background
+COUNTER_SYNC = None
+COUNTER_SYNC_BIND = "127.0.0.1:7400"
+COUNTER_SYNC_PEERS = []
+COUNTER_SYNC_WORKERS = 1
+COUNTER_SYNC_DIR = None
+# secret key shared by the instances, authenticates the exchanged batches (required with COUNTER_SYNC)
+# use random secret, e.g. binascii.unhexlify("...")
+COUNTER_SYNC_KEY = None
+# how often (in seconds) the deltas are shipped, at most COUNTER_SYNC_MAX_BATCHES batches each time
+COUNTER_SYNC_INTERVAL = 0.2
+COUNTER_SYNC_MAX_BATCHES = 10
+
+# plaintext SUN (/tagpt): after successful verification, precompute expected SDMMACs
+# for the next PLAIN_MAC_PRECOMPUTE counter values in the background (0 = disabled)
+PLAIN_MAC_PRECOMPUTE = 0
+PLAIN_MAC_PRECOMPUTE_SIZE = 100000
+
+# JSON file with additional tenants (own MASTER_KEY, DERIVE_MODE, parameter names, REQUIRE_LRP),
+# selected by the request host or path prefix (see server/tenants.py); None = single tenant
+TENANTS_FILE = None
+
+# master keys which were replaced by MASTER_KEY but are still accepted (tags not re-personalized yet),
+# e.g. [binascii.unhexlify("00112233445566778899AABBCCDDEEFF")]
+PREVIOUS_MASTER_KEYS = []
+# maximum number of cached UID-diversified keys (per tenant)
+DERIVED_KEY_CACHE_SIZE = 100000
+# capacity of the derived key cache shared by all worker processes on the host (0 = disabled),
+# consulted before deriving a key, so a key derived by one worker is reused by the others
+SHARED_KEY_CACHE_SLOTS = 0
+# directory for the cache file (holds derived keys, keep it private; None = new directory in /dev/shm
+# created on startup, before the workers are forked, and removed when the creating process exits)
+SHARED_KEY_CACHE_DIR = None
+
+# expose latency histograms of the verification stages at /metrics (Prometheus text format)
+METRICS = False
+# directory for the per-process metric files, shared by all workers
+# (None = temporary directory created on startup, before the workers are forked)
+METRICS_DIR = None
+
+# add Server-Timing header with the durations of the verification stages to the responses of the SUN endpoints
+# (reveals how long the key derivation and MAC calculation took, so don't enable it in public deployments)
+SERVER_TIMING = False
+
+# write traces of the verification pipeline (OpenTelemetry-shaped spans, JSON lines) into this directory
+# (one size-rotated file per worker process; None = disabled)
+TRACE_DIR = None
+# probability of tracing a request; requests slower than TRACE_SLOW_THRESHOLD seconds are always traced
+TRACE_SAMPLE_RATE = 0.01
+TRACE_SLOW_THRESHOLD = 0.1
+TRACE_MAX_BYTES = 10 * 1024 * 1024
+TRACE_BACKUP_COUNT = 5
+
+# fraction of the requests to the SUN endpoints profiled with tracemalloc (0 = disabled),
+# top allocating source lines are reported at /debug/allocations
+ALLOC_PROFILE = 0.0
+# value of X-Debug-Token header required by the /debug/ endpoints (None = debug endpoints are forbidden)
+DEBUG_TOKEN = None
+
+# run cProfile on one in CPU_PROFILE_EVERY requests to the SUN endpoints (0 = disabled) and write merged
+# pstats and collapsed stacks (for flame graph tools) per endpoint and worker into CPU_PROFILE_DIR
+# every CPU_PROFILE_INTERVAL seconds
+CPU_PROFILE_EVERY = 0
+CPU_PROFILE_DIR = "profiles"
+CPU_PROFILE_INTERVAL = 60.0
+
+# append every scan (UID, read counter, mode, TagTamper status, outcome, time) to a binary event log
+# in this directory (one set of segment files per worker process; None = disabled),
+# export with: python -m server.event_log <directory> --format csv
+EVENT_LOG_DIR = None
+EVENT_LOG_SEGMENT_RECORDS = 1000000
+EVENT_LOG_BATCH_RECORDS = 1000
+EVENT_LOG_FLUSH_INTERVAL = 1.0
+
+# deliver every verified scan (JSON line with UID, read counter, mode, TagTamper status, time) asynchronously
+# to a local sink: "unix:/run/sdm/events.sock", "pipe:/run/sdm/events.fifo" or "http://127.0.0.1:8080/events"
+# (None = disabled); the delivery metrics are exposed at /metrics (with METRICS = True)
+EVENT_SINK = None
+# maximum number of events waiting for delivery in memory (per worker process)
+EVENT_SINK_QUEUE_SIZE = 10000
+EVENT_SINK_BATCH_SIZE = 100
+EVENT_SINK_FLUSH_INTERVAL = 0.5
+EVENT_SINK_MAX_RETRIES = 5
+# what to do with the events which can't be queued or delivered: "drop" or "spill" (into EVENT_SINK_SPILL_DIR,
+# replayed once the sink is available again)
+EVENT_SINK_OVERFLOW = "drop"
+EVENT_SINK_SPILL_DIR = None
+
+# track the most scanned and the suddenly hot tags (count-min sketch and top-k, bounded memory per worker process),
+# reported at /debug/heavy-hitters (requires DEBUG_TOKEN); the report covers only the scans handled by the worker
+# which answers it, with N workers about 1/N of the traffic
+HEAVY_HITTERS = False
+HEAVY_HITTERS_TOP = 100
+HEAVY_HITTERS_WIDTH = 4096
+HEAVY_HITTERS_DEPTH = 4
+# the recent scan counts ("hot" tags) are halved every HEAVY_HITTERS_HALF_LIFE seconds
+HEAVY_HITTERS_HALF_LIFE = 300.0
+# size of the table with the last read counter and scan time of the tags
+HEAVY_HITTERS_SLOTS = 65536
+
+# token-bucket rate limits of the SUN endpoints (0 = disabled), over-limit requests get 429 Too Many Requests:
+# requests per second (and burst) per client IP, checked before any cryptographic work,
+# and per UID, checked right after PICC decryption (before the key derivation and MAC calculation)
+RATE_LIMIT_IP_RATE = 0
+RATE_LIMIT_IP_BURST = 20
+# note: the UID limit applies before the MAC is verified, so anyone can use up the tokens of a tag and get its genuine
+# scans rejected for a while: on /tagpt with any UID (it's sent in plaintext), on /tag and /tagtt by repeating
+# a URL of the tag
+RATE_LIMIT_UID_RATE = 0
+RATE_LIMIT_UID_BURST = 10
+# maximum number of tracked client IPs and UIDs (least recently seen are forgotten)
+RATE_LIMIT_SLOTS = 65536
+# directory for the bucket files shared by all workers
+# (None = temporary directory created on startup, before the workers are forked)
+RATE_LIMIT_DIR = None
+
+# admission control of the verification routes and demo pages: reject with 503 Service Unavailable when overloaded,
+# the JSON API has priority over the SUN pages and those over the demo pages (/, /webnfc)
+ADMISSION_CONTROL = False
+# maximum number of requests processed concurrently by a worker process (threads, ASGI executor; 0 = no limit),
+# counted per process: single-threaded uWSGI workers process one request at a time, so there only the queueing
+# delay below sheds load
+ADMISSION_MAX_IN_FLIGHT = 0
+# start shedding when the queueing delay stays above ADMISSION_TARGET_DELAY seconds for ADMISSION_INTERVAL seconds;
+# the delay is measured from the X-Request-Start header set by the front-end proxy
+# (nginx: uwsgi_param HTTP_X_REQUEST_START "t=${msec}";, set by the Docker image) or from the arrival
+# at the ASGI server; without either, the requests are never shed because of the delay
+ADMISSION_TARGET_DELAY = 0.05
+ADMISSION_INTERVAL = 0.1
+ADMISSION_RETRY_AFTER = 1
+
+# warm up the application before uWSGI forks the workers (compiled templates, LRP tables of the meta keys,
+# verification code paths) and gc.freeze() it, so that the workers share the warmed state copy-on-write;
+# requires the application to be loaded in the master (uWSGI without lazy-apps)
+WARMUP = False
+# also derive the SDMFileReadKeys of up to WARMUP_PRELOAD_KEYS tags with the most recently accepted read counters
+# (requires REPLAY_PROTECTION, and COUNTER_STORE_DIR to remember them across restarts)
+WARMUP_PRELOAD_KEYS = 0
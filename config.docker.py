@@ -13,3 +13,96 @@ CTR_PARAM = os.environ.get("CTR_PARAM", "ctr")
 SDMMAC_PARAM = os.environ.get("SDMMAC_PARAM", "cmac")
 
 REQUIRE_LRP = os.environ.get("REQUIRE_LRP", "0") == "1"
+
+ASGI_EXECUTOR = os.environ.get("ASGI_EXECUTOR", "thread")
+ASGI_MAX_WORKERS = int(os.environ.get("ASGI_MAX_WORKERS", "0"))
+ASGI_MAX_PENDING = int(os.environ.get("ASGI_MAX_PENDING", "256"))
+
+API_FAST_PATH = os.environ.get("API_FAST_PATH", "1") == "1"
+
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "0"))
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", "10.0"))
+RESULT_CACHE_REJECTIONS = os.environ.get("RESULT_CACHE_REJECTIONS", "0") == "1"
+
+TOKEN_KEY = binascii.unhexlify(os.environ["TOKEN_KEY"]) if os.environ.get("TOKEN_KEY") else None
+TOKEN_TTL = int(os.environ.get("TOKEN_TTL", "300"))
+TOKEN_COOKIE = os.environ.get("TOKEN_COOKIE", "sdm_token")
+
+REPLAY_PROTECTION = os.environ.get("REPLAY_PROTECTION", "0") == "1"
+COUNTER_STORE_DIR = os.environ.get("COUNTER_STORE_DIR") or None
+COUNTER_STORE_SLOTS = int(os.environ.get("COUNTER_STORE_SLOTS", "262144"))
+COUNTER_STORE_COMPACT_EVERY = int(os.environ.get("COUNTER_STORE_COMPACT_EVERY", "100000"))
+COUNTER_STORE_FSYNC = os.environ.get("COUNTER_STORE_FSYNC", "0") == "1"
+
+COUNTER_SYNC = os.environ.get("COUNTER_SYNC") or None
+COUNTER_SYNC_BIND = os.environ.get("COUNTER_SYNC_BIND", "127.0.0.1:7400")
+COUNTER_SYNC_PEERS = [peer for peer in os.environ.get("COUNTER_SYNC_PEERS", "").split(",") if peer]
+COUNTER_SYNC_WORKERS = int(os.environ.get("COUNTER_SYNC_WORKERS", "1"))
+COUNTER_SYNC_DIR = os.environ.get("COUNTER_SYNC_DIR") or None
+COUNTER_SYNC_KEY = binascii.unhexlify(os.environ["COUNTER_SYNC_KEY"]) if os.environ.get("COUNTER_SYNC_KEY") else None
+COUNTER_SYNC_INTERVAL = float(os.environ.get("COUNTER_SYNC_INTERVAL", "0.2"))
+COUNTER_SYNC_MAX_BATCHES = int(os.environ.get("COUNTER_SYNC_MAX_BATCHES", "10"))
+
+PLAIN_MAC_PRECOMPUTE = int(os.environ.get("PLAIN_MAC_PRECOMPUTE", "0"))
+PLAIN_MAC_PRECOMPUTE_SIZE = int(os.environ.get("PLAIN_MAC_PRECOMPUTE_SIZE", "100000"))
+
+TENANTS_FILE = os.environ.get("TENANTS_FILE") or None
+
+PREVIOUS_MASTER_KEYS = [binascii.unhexlify(key) for key in os.environ.get("PREVIOUS_MASTER_KEYS", "").split(",") if key]
+DERIVED_KEY_CACHE_SIZE = int(os.environ.get("DERIVED_KEY_CACHE_SIZE", "100000"))
+SHARED_KEY_CACHE_SLOTS = int(os.environ.get("SHARED_KEY_CACHE_SLOTS", "0"))
+SHARED_KEY_CACHE_DIR = os.environ.get("SHARED_KEY_CACHE_DIR") or None
+
+METRICS = os.environ.get("METRICS", "0") == "1"
+METRICS_DIR = os.environ.get("METRICS_DIR") or None
+
+SERVER_TIMING = os.environ.get("SERVER_TIMING", "0") == "1"
+
+TRACE_DIR = os.environ.get("TRACE_DIR") or None
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+TRACE_SLOW_THRESHOLD = float(os.environ["TRACE_SLOW_THRESHOLD"]) if os.environ.get("TRACE_SLOW_THRESHOLD") else 0.1
+TRACE_MAX_BYTES = int(os.environ.get("TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.environ.get("TRACE_BACKUP_COUNT", "5"))
+
+ALLOC_PROFILE = float(os.environ.get("ALLOC_PROFILE", "0"))
+DEBUG_TOKEN = os.environ.get("DEBUG_TOKEN") or None
+
+CPU_PROFILE_EVERY = int(os.environ.get("CPU_PROFILE_EVERY", "0"))
+CPU_PROFILE_DIR = os.environ.get("CPU_PROFILE_DIR") or "profiles"
+CPU_PROFILE_INTERVAL = float(os.environ.get("CPU_PROFILE_INTERVAL", "60"))
+
+EVENT_LOG_DIR = os.environ.get("EVENT_LOG_DIR") or None
+EVENT_LOG_SEGMENT_RECORDS = int(os.environ.get("EVENT_LOG_SEGMENT_RECORDS", "1000000"))
+EVENT_LOG_BATCH_RECORDS = int(os.environ.get("EVENT_LOG_BATCH_RECORDS", "1000"))
+EVENT_LOG_FLUSH_INTERVAL = float(os.environ.get("EVENT_LOG_FLUSH_INTERVAL", "1"))
+
+EVENT_SINK = os.environ.get("EVENT_SINK") or None
+EVENT_SINK_QUEUE_SIZE = int(os.environ.get("EVENT_SINK_QUEUE_SIZE", "10000"))
+EVENT_SINK_BATCH_SIZE = int(os.environ.get("EVENT_SINK_BATCH_SIZE", "100"))
+EVENT_SINK_FLUSH_INTERVAL = float(os.environ.get("EVENT_SINK_FLUSH_INTERVAL", "0.5"))
+EVENT_SINK_MAX_RETRIES = int(os.environ.get("EVENT_SINK_MAX_RETRIES", "5"))
+EVENT_SINK_OVERFLOW = os.environ.get("EVENT_SINK_OVERFLOW") or "drop"
+EVENT_SINK_SPILL_DIR = os.environ.get("EVENT_SINK_SPILL_DIR") or None
+
+HEAVY_HITTERS = os.environ.get("HEAVY_HITTERS", "0") == "1"
+HEAVY_HITTERS_TOP = int(os.environ.get("HEAVY_HITTERS_TOP", "100"))
+HEAVY_HITTERS_WIDTH = int(os.environ.get("HEAVY_HITTERS_WIDTH", "4096"))
+HEAVY_HITTERS_DEPTH = int(os.environ.get("HEAVY_HITTERS_DEPTH", "4"))
+HEAVY_HITTERS_HALF_LIFE = float(os.environ.get("HEAVY_HITTERS_HALF_LIFE", "300"))
+HEAVY_HITTERS_SLOTS = int(os.environ.get("HEAVY_HITTERS_SLOTS", "65536"))
+
+RATE_LIMIT_IP_RATE = float(os.environ.get("RATE_LIMIT_IP_RATE", "0"))
+RATE_LIMIT_IP_BURST = float(os.environ.get("RATE_LIMIT_IP_BURST", "20"))
+RATE_LIMIT_UID_RATE = float(os.environ.get("RATE_LIMIT_UID_RATE", "0"))
+RATE_LIMIT_UID_BURST = float(os.environ.get("RATE_LIMIT_UID_BURST", "10"))
+RATE_LIMIT_SLOTS = int(os.environ.get("RATE_LIMIT_SLOTS", "65536"))
+RATE_LIMIT_DIR = os.environ.get("RATE_LIMIT_DIR") or None
+
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "0") == "1"
+ADMISSION_MAX_IN_FLIGHT = int(os.environ.get("ADMISSION_MAX_IN_FLIGHT", "0"))
+ADMISSION_TARGET_DELAY = float(os.environ.get("ADMISSION_TARGET_DELAY", "0.05"))
+ADMISSION_INTERVAL = float(os.environ.get("ADMISSION_INTERVAL", "0.1"))
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", "1"))
+
+WARMUP = os.environ.get("WARMUP", "0") == "1"
+WARMUP_PRELOAD_KEYS = int(os.environ.get("WARMUP_PRELOAD_KEYS", "0"))
@@ -0,0 +1,273 @@
+# pylint: disable=invalid-name
+
+"""
+PICC side of the SUN messages (tag simulator), e.g. for load tests and benchmarks.
+
+Produces the messages accepted by sdm.decrypt_sun_message() (PICCENCData, optional SDMENCFileData
+and SDMMAC in SEPARATED or BULK layout, AES or LRP) and by sdm.validate_plain_sun() (plain UID
+and SDMReadCtr with SDMMAC), for the SDM settings used by the NFC Developer App:
+PICCDataTag C7h (UID and SDMReadCtr mirroring, 7 byte UID).
+
+generate_sun_messages() produces messages of many tags in parallel worker processes,
+in chunks of consecutive taps of the same tag (so the read counters of a tag are increasing).
+"""
+
+import copy
+import functools
+import multiprocessing
+import os
+import struct
+from typing import Callable, Iterator, List, Optional, Sequence, Tuple
+
+from Crypto.Cipher import AES
+from Crypto.Hash import CMAC
+
+from libsdm import derive, legacy_derive
+from libsdm.lrp import LRP
+from libsdm.sdm import EncMode, ParamMode, calculate_plain_sdmmac, calculate_sdmmac
+
+DERIVE_MODES = {
+    "legacy": legacy_derive,
+    "standard": derive,
+}
+
+PICC_DATA_TAG = b"\xc7"
+
+
+@functools.lru_cache(maxsize=64)
+def _lrp(key: bytes) -> LRP:
+    return LRP(key, 0, pad=False)
+
+
+def encrypt_picc_data(mode: EncMode,
+                      sdm_meta_read_key: bytes,
+                      uid: bytes,
+                      read_ctr: int,
+                      rand: Callable[[int], bytes] = os.urandom) -> bytes:
+    """
+    Encrypt PICCData (PICCDataTag || UID || SDMReadCtr || random padding)
+    :param rand: source of the random padding and of PICCRand (LRP)
+    :return: PICCENCData (16 bytes for AES, PICCRand || ciphertext = 24 bytes for LRP)
+    """
+    if len(uid) != 7:
+        raise RuntimeError("UID must have 7 bytes.")
+
+    plaintext = PICC_DATA_TAG + uid + struct.pack("<I", read_ctr)[:3] + rand(5)
+
+    if mode == EncMode.AES:
+        return AES.new(sdm_meta_read_key, AES.MODE_CBC, IV=b"\x00" * 16).encrypt(plaintext)
+
+    if mode == EncMode.LRP:
+        picc_rand = rand(8)
+        # generating the plaintexts and updated keys is the expensive part, reuse them
+        cipher = copy.copy(_lrp(sdm_meta_read_key))
+        cipher.r = picc_rand
+        return picc_rand + cipher.encrypt(plaintext)
+
+    raise RuntimeError("Invalid encryption mode.")
+
+
+def encrypt_file_data(mode: EncMode, sdm_file_read_key: bytes, uid: bytes, read_ctr: int, file_data: bytes) -> bytes:
+    """
+    Encrypt SDMFileData (inverse of sdm.decrypt_file_data())
+    :param file_data: plaintext, length must be a multiple of 16 bytes
+    :return: SDMENCFileData
+    """
+    if not file_data or len(file_data) % AES.block_size != 0:
+        raise RuntimeError("File data length must be a non-zero multiple of 16 bytes.")
+
+    read_ctr_b = struct.pack("<I", read_ctr)[:3]
+    picc_data = uid + read_ctr_b
+
+    if mode == EncMode.AES:
+        sv1 = b"\xC3\x3C\x00\x01\x00\x80" + picc_data
+        sv1 += b"\x00" * (-len(sv1) % AES.block_size)
+        k_ses_sdm_file_read_enc = CMAC.new(sdm_file_read_key, msg=sv1, ciphermod=AES).digest()
+        ive = AES.new(k_ses_sdm_file_read_enc, AES.MODE_ECB).encrypt(read_ctr_b + b"\x00" * 13)
+        return AES.new(k_ses_sdm_file_read_enc, AES.MODE_CBC, IV=ive).encrypt(file_data)
+
+    if mode == EncMode.LRP:
+        sv2 = b"\x00\x01\x00\x80" + picc_data
+        sv2 += b"\x00" * (-(len(sv2) + 2) % AES.block_size) + b"\x1E\xE1"
+        master_key = _lrp(sdm_file_read_key).cmac(sv2)
+        return LRP(master_key, 1, read_ctr_b + b"\x00\x00\x00", pad=False).encrypt(file_data)
+
+    raise RuntimeError("Invalid encryption mode.")
+
+
+# pylint: disable=too-many-arguments
+def encode_sun_message(param_mode: ParamMode,
+                       sdm_meta_read_key: bytes,
+                       sdm_file_read_key: bytes,
+                       uid: bytes,
+                       read_ctr: int,
+                       file_data: Optional[bytes] = None,
+                       mode: Optional[EncMode] = None,
+                       sdmmac_param: Optional[str] = None,
+                       rand: Callable[[int], bytes] = os.urandom) -> dict:
+    """
+    Encode encrypted SUN message for NTAG 424 DNA
+    :param param_mode: Type of dynamic URL encoding (ParamMode)
+    :param sdm_meta_read_key: SUN encryption key (K_SDMMetaReadKey)
+    :param sdm_file_read_key: MAC calculation key (K_SDMFileReadKey) of the tag
+    :param uid: UID (7 bytes)
+    :param read_ctr: SDMReadCtr
+    :param file_data: SDMFileData to encrypt (if used)
+    :param mode: EncMode.AES (default) or EncMode.LRP
+    :param sdmmac_param: name of the SDMMAC URL parameter (default: config.SDMMAC_PARAM)
+    :return: dict: picc_enc_data, enc_file_data (or None), sdmmac - as expected by sdm.decrypt_sun_message()
+    """
+    if mode is None:
+        mode = EncMode.AES
+
+    picc_enc_data = encrypt_picc_data(mode, sdm_meta_read_key, uid, read_ctr, rand=rand)
+    enc_file_data = encrypt_file_data(mode, sdm_file_read_key, uid, read_ctr, file_data) if file_data else None
+    sdmmac = calculate_sdmmac(param_mode,
+                              sdm_file_read_key,
+                              uid + struct.pack("<I", read_ctr)[:3],
+                              enc_file_data,
+                              mode=mode,
+                              sdmmac_param=sdmmac_param)
+
+    return {
+        "picc_enc_data": picc_enc_data,
+        "enc_file_data": enc_file_data,
+        "sdmmac": sdmmac
+    }
+
+
+def encode_plain_sun(uid: bytes, read_ctr: int, sdm_file_read_key: bytes, mode: Optional[EncMode] = None) -> dict:
+    """
+    Encode plaintext SUN message (UID and SDMReadCtr mirrored in clear)
+    :return: dict: uid, read_ctr (3 bytes, MSB first), sdmmac - as expected by sdm.validate_plain_sun()
+    """
+    read_ctr_b = read_ctr.to_bytes(3, 'big')
+
+    return {
+        "uid": uid,
+        "read_ctr": read_ctr_b,
+        "sdmmac": calculate_plain_sdmmac(uid, read_ctr_b, sdm_file_read_key, mode=mode)
+    }
+
+
+def format_query(message: dict,
+                 param_mode: ParamMode = ParamMode.SEPARATED,
+                 enc_picc_data_param: str = "picc_data",
+                 enc_file_data_param: str = "enc",
+                 sdmmac_param: str = "cmac",
+                 uid_param: str = "uid",
+                 ctr_param: str = "ctr") -> str:
+    """
+    Format the message as URL query string (hex in upper case, as mirrored by the tag)
+    :param message: result of encode_sun_message() or encode_plain_sun()
+    """
+    if "picc_enc_data" not in message:
+        return f"{uid_param}={message['uid'].hex().upper()}&{ctr_param}={message['read_ctr'].hex().upper()}" \
+               f"&{sdmmac_param}={message['sdmmac'].hex().upper()}"
+
+    if param_mode == ParamMode.BULK:
+        return "e=" + (message['picc_enc_data'] + (message['enc_file_data'] or b"") + message['sdmmac']).hex().upper()
+
+    query = f"{enc_picc_data_param}={message['picc_enc_data'].hex().upper()}"
+
+    if message['enc_file_data']:
+        query += f"&{enc_file_data_param}={message['enc_file_data'].hex().upper()}"
+
+    return query + f"&{sdmmac_param}={message['sdmmac'].hex().upper()}"
+
+
+class TagSimulator:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+                 master_key: bytes,
+                 uid: bytes,
+                 derive_mode: str = "standard",
+                 read_ctr: int = 0,
+                 mode: Optional[EncMode] = None,
+                 sdmmac_param: Optional[str] = None,
+                 sdm_meta_read_key: Optional[bytes] = None):
+        """
+        Tag personalized with the keys derived from the master key
+        :param derive_mode: "standard" (libsdm.derive) or "legacy" (libsdm.legacy_derive)
+        :param read_ctr: SDMReadCtr of the last tap
+        :param sdm_meta_read_key: already derived K_SDMMetaReadKey (it's the same for all tags)
+        """
+        derive_module = DERIVE_MODES[derive_mode]
+        self.uid = uid
+        self.read_ctr = read_ctr
+        self.mode = mode or EncMode.AES
+        self.sdmmac_param = sdmmac_param
+        self.sdm_meta_read_key = sdm_meta_read_key or derive_module.derive_undiversified_key(master_key, 1)
+        self.sdm_file_read_key = derive_module.derive_tag_key(master_key, uid, 2)
+
+    def tap(self, param_mode: ParamMode = ParamMode.SEPARATED, file_data: Optional[bytes] = None) -> dict:
+        """
+        Encrypted SUN message of the next tap (increments SDMReadCtr)
+        """
+        self.read_ctr += 1
+        return encode_sun_message(param_mode, self.sdm_meta_read_key, self.sdm_file_read_key, self.uid,
+                                  self.read_ctr, file_data=file_data, mode=self.mode, sdmmac_param=self.sdmmac_param)
+
+    def tap_plain(self) -> dict:
+        """
+        Plaintext SUN message of the next tap (increments SDMReadCtr)
+        """
+        self.read_ctr += 1
+        return encode_plain_sun(self.uid, self.read_ctr, self.sdm_file_read_key, mode=self.mode)
+
+
+def _generate_chunk(job: Tuple) -> List[dict]:
+    master_key, derive_mode, sdm_meta_read_key, uid, start_ctr, taps, mode, param_mode, file_data, plain, \
+        sdmmac_param = job
+    tag = TagSimulator(master_key, uid, derive_mode=derive_mode, read_ctr=start_ctr - 1, mode=mode,
+                       sdmmac_param=sdmmac_param, sdm_meta_read_key=sdm_meta_read_key)
+    messages = []
+
+    for _ in range(taps):
+        if plain:
+            messages.append(tag.tap_plain())
+        else:
+            messages.append(dict(tag.tap(param_mode, file_data), uid=uid, read_ctr=tag.read_ctr))
+
+    return messages
+
+
+# pylint: disable=too-many-locals
+def generate_sun_messages(master_key: bytes,
+                          uids: Sequence[bytes],
+                          taps: int = 1,
+                          derive_mode: str = "standard",
+                          start_ctr: int = 1,
+                          mode: Optional[EncMode] = None,
+                          param_mode: ParamMode = ParamMode.SEPARATED,
+                          file_data: Optional[bytes] = None,
+                          plain: bool = False,
+                          sdmmac_param: Optional[str] = None,
+                          processes: Optional[int] = None) -> Iterator[dict]:
+    """
+    Messages of consecutive taps of every tag, computed by a pool of worker processes
+    :param taps: number of messages per tag
+    :param start_ctr: SDMReadCtr of the first message of every tag
+    :param plain: plaintext SUN messages instead of the encrypted ones
+    :param processes: number of worker processes (default: number of CPUs; 1 = no worker processes)
+    :return: messages in the order of uids (the taps of a tag in the order of SDMReadCtr);
+             encrypted messages additionally contain uid and read_ctr (int)
+    """
+    if sdmmac_param is None:
+        # resolve in this process, the workers may not have the same configuration
+        import config  # pylint: disable=import-outside-toplevel
+        sdmmac_param = config.SDMMAC_PARAM
+
+    sdm_meta_read_key = DERIVE_MODES[derive_mode].derive_undiversified_key(master_key, 1)
+    jobs = ((master_key, derive_mode, sdm_meta_read_key, uid, start_ctr, taps, mode, param_mode, file_data, plain,
+             sdmmac_param) for uid in uids)
+
+    if processes == 1:
+        for job in jobs:
+            yield from _generate_chunk(job)
+
+        return
+
+    with multiprocessing.Pool(processes) as pool:
+        for messages in pool.imap(_generate_chunk, jobs, chunksize=max(1, 256 // max(taps, 1))):
+            yield from messages
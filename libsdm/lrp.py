@@ -9,7 +9,7 @@ because in such case it may be not resistant to the side channel attacks.
 """
 import binascii
 import io
-from typing import Generator, List, Optional, Union
+from typing import Dict, Generator, List, Optional, Tuple, Union
 
 from Crypto.Cipher import AES
 from Crypto.Protocol.SecretSharing import _Element
@@ -72,6 +72,9 @@ def d(k: bytes, v: bytes) -> bytes:
 
 
 class LRP:
+    # plaintexts and updated keys of the long-lived keys, see LRP.remember()
+    remembered: Dict[bytes, Tuple[List[bytes], List[bytes]]] = {}
+
     def __init__(self, key: bytes, u: int, r: Optional[bytes] = None, pad: bool = True):
         """
         Leakage Resilient Primitive
@@ -88,10 +91,24 @@ class LRP:
         self.r = r
         self.pad = pad
 
-        self.p = LRP.generate_plaintexts(key)
-        self.ku = LRP.generate_updated_keys(key)
+        tables = LRP.remembered.get(key)
+
+        if tables is not None:
+            self.p, self.ku = tables
+        else:
+            self.p = LRP.generate_plaintexts(key)
+            self.ku = LRP.generate_updated_keys(key)
+
         self.kp = self.ku[self.u]
 
+    @staticmethod
+    def remember(key: bytes):
+        """
+        Precompute the plaintexts and updated keys of a key used for many messages (e.g. SDMMetaReadKey),
+        so that the following LRP contexts of the key skip Algorithms 1 and 2
+        """
+        LRP.remembered[key] = (LRP.generate_plaintexts(key), LRP.generate_updated_keys(key))
+
     @staticmethod
     def generate_plaintexts(k: bytes, m: int = 4) -> List[bytes]:
         """
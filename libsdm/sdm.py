@@ -15,6 +15,7 @@ from Crypto.Hash import CMAC
 
 import config
 from libsdm.lrp import LRP
+from libsdm.stages import annotate, stage
 
 
 class EncMode(Enum):
@@ -31,11 +32,16 @@ class InvalidMessage(RuntimeError):
     pass
 
 
+class ImplausiblePICCData(InvalidMessage):
+    pass
+
+
 def calculate_sdmmac(param_mode: ParamMode,
                      sdm_file_read_key: bytes,
                      picc_data: bytes,
                      enc_file_data: Optional[bytes] = None,
-                     mode: Optional[EncMode] = None) -> bytes:
+                     mode: Optional[EncMode] = None,
+                     sdmmac_param: Optional[str] = None) -> bytes:
     """
     Calculate SDMMAC for NTAG 424 DNA
     :param param_mode: Type of dynamic URL encoding (ParamMode)
@@ -43,17 +49,21 @@ def calculate_sdmmac(param_mode: ParamMode,
     :param picc_data: [ UID ][ SDMReadCtr ]
     :param enc_file_data: SDMEncFileData (if used)
     :param mode: Encryption mode used by PICC - EncMode.AES (default) or EncMode.LRP
+    :param sdmmac_param: name of the SDMMAC URL parameter (default: config.SDMMAC_PARAM)
     :return: calculated SDMMAC (8 bytes)
     """
     if mode is None:
         mode = EncMode.AES
 
+    if sdmmac_param is None:
+        sdmmac_param = config.SDMMAC_PARAM
+
     input_buf = io.BytesIO()
 
     if enc_file_data:
-        sdmmac_param_text = f"&{config.SDMMAC_PARAM}="
+        sdmmac_param_text = f"&{sdmmac_param}="
 
-        if param_mode == ParamMode.BULK or not config.SDMMAC_PARAM:
+        if param_mode == ParamMode.BULK or not sdmmac_param:
             sdmmac_param_text = ""
 
         input_buf.write(enc_file_data.hex().upper().encode('ascii') + sdmmac_param_text.encode('ascii'))
@@ -152,10 +162,15 @@ def decrypt_file_data(sdm_file_read_key: bytes,
     raise InvalidMessage("Invalid encryption mode")
 
 
-def validate_plain_sun(uid: bytes, read_ctr: bytes, sdmmac: bytes, sdm_file_read_key: bytes, mode: Optional[EncMode] = None):
-    if mode is None:
-        mode = EncMode.AES
-
+def calculate_plain_sdmmac(uid: bytes, read_ctr: bytes, sdm_file_read_key: bytes, mode: Optional[EncMode] = None) -> bytes:
+    """
+    Calculate SDMMAC of plaintext SUN message (UID and SDMReadCtr mirrored in clear)
+    :param uid: UID
+    :param read_ctr: SDMReadCtr as mirrored (MSB first)
+    :param sdm_file_read_key: MAC calculation key (K_SDMFileReadKey)
+    :param mode: Encryption mode used by PICC - EncMode.AES (default) or EncMode.LRP
+    :return: calculated SDMMAC (8 bytes)
+    """
     read_ctr_ba = bytearray(read_ctr)
     read_ctr_ba.reverse()
 
@@ -163,10 +178,20 @@ def validate_plain_sun(uid: bytes, read_ctr: bytes, sdmmac: bytes, sdm_file_read
     data_stream.write(uid)
     data_stream.write(read_ctr_ba)
 
-    proper_sdmmac = calculate_sdmmac(ParamMode.SEPARATED,
-                                     sdm_file_read_key,
-                                     data_stream.getvalue(),
-                                     mode=mode)
+    return calculate_sdmmac(ParamMode.SEPARATED,
+                            sdm_file_read_key,
+                            data_stream.getvalue(),
+                            mode=mode)
+
+
+def validate_plain_sun(uid: bytes, read_ctr: bytes, sdmmac: bytes, sdm_file_read_key: bytes, mode: Optional[EncMode] = None):
+    if mode is None:
+        mode = EncMode.AES
+
+    annotate("encryption_mode", mode.name)
+
+    with stage("mac"):
+        proper_sdmmac = calculate_plain_sdmmac(uid, read_ctr, sdm_file_read_key, mode=mode)
 
     if sdmmac != proper_sdmmac:
         raise InvalidMessage("Message is not properly signed - invalid MAC")
@@ -179,6 +204,14 @@ def validate_plain_sun(uid: bytes, read_ctr: bytes, sdmmac: bytes, sdm_file_read
     }
 
 
+def picc_data_plausible(picc_data_tag: int) -> bool:
+    """
+    Check the fields of PICCDataTag which are fixed for NTAG 424 DNA (UID mirroring enabled,
+    RFU bits cleared, 7 byte UID). PICCData decrypted with a wrong key passes with probability 1/128.
+    """
+    return (picc_data_tag & 0xB0) == 0x80 and (picc_data_tag & 0x0F) == 0x07
+
+
 def get_encryption_mode(picc_enc_data: bytes):
     if len(picc_enc_data) == 16:
         return EncMode.AES
@@ -189,13 +222,31 @@ def get_encryption_mode(picc_enc_data: bytes):
     raise InvalidMessage("Unsupported encryption mode.")
 
 
+def _fake_sdmmac(param_mode: ParamMode,
+                 sdm_file_read_key: Callable[[bytes], bytes],
+                 enc_file_data: Optional[bytes],
+                 mode: EncMode,
+                 sdmmac_param: Optional[str]):
+    """
+    Derive the key and calculate SDMMAC for a dummy UID, so the rejected messages take as long as the verified ones
+    """
+    with stage("derive"):
+        fake_key = sdm_file_read_key(b"\x00" * 7)
+
+    with stage("mac"):
+        calculate_sdmmac(param_mode, fake_key, b"\x00" * 10, enc_file_data, mode=mode, sdmmac_param=sdmmac_param)
+
+
 # pylint: disable=too-many-arguments, too-many-locals
 def decrypt_sun_message(param_mode: ParamMode,
                         sdm_meta_read_key: bytes,
                         sdm_file_read_key: Callable[[bytes], bytes],
                         picc_enc_data: bytes,
                         sdmmac: bytes,
-                        enc_file_data: Optional[bytes] = None) -> dict:
+                        enc_file_data: Optional[bytes] = None,
+                        read_ctr_check: Optional[Callable[[bytes, Optional[int]], None]] = None,
+                        sdmmac_param: Optional[str] = None,
+                        check_picc_data_tag: bool = False) -> dict:
     """
     Decrypt SUN message for NTAG 424 DNA
     :param param_mode: Type of dynamic URL encoding (ParamMode)
@@ -204,27 +255,41 @@ def decrypt_sun_message(param_mode: ParamMode,
     :param ciphertext: Encrypted SUN message
     :param mac: SDMMAC of the SUN message
     :param enc_file_data: SDMEncFileData (if present)
+    :param read_ctr_check: called with (UID, SDMReadCtr) right after PICCData decryption,
+                           before key derivation and MAC calculation; may raise to reject the message
+    :param sdmmac_param: name of the SDMMAC URL parameter (default: config.SDMMAC_PARAM)
+    :param check_picc_data_tag: reject implausible PICCDataTag right away, with the fake MAC calculation only
+                                (used to quickly discard wrong keys when trying several of them)
     :return: dict: picc_data_tag (1 byte), uid (bytes), read_ctr (int), file_data (bytes; only if present), encryption_mode (EncMode.AES or EncMode.LRP)
     :raises:
         InvalidMessage: if SUN message is invalid
+        ImplausiblePICCData: if check_picc_data_tag is set and PICCDataTag is implausible
     """
     mode = get_encryption_mode(picc_enc_data)
-
-    if mode == EncMode.AES:
-        cipher = AES.new(sdm_meta_read_key, AES.MODE_CBC, IV=b'\x00' * 16)
-        plaintext = cipher.decrypt(picc_enc_data)
-    elif mode == EncMode.LRP:
-        picc_rand = picc_enc_data[0:8]
-        picc_enc_data_stripped = picc_enc_data[8:]
-        cipher = LRP(sdm_meta_read_key, 0, picc_rand, pad=False)
-        plaintext = cipher.decrypt(picc_enc_data_stripped)
-    else:
-        raise InvalidMessage("Invalid encryption mode.")
+    annotate("encryption_mode", mode.name)
+
+    with stage("picc_decrypt"):
+        if mode == EncMode.AES:
+            cipher = AES.new(sdm_meta_read_key, AES.MODE_CBC, IV=b'\x00' * 16)
+            plaintext = cipher.decrypt(picc_enc_data)
+        elif mode == EncMode.LRP:
+            picc_rand = picc_enc_data[0:8]
+            picc_enc_data_stripped = picc_enc_data[8:]
+            cipher = LRP(sdm_meta_read_key, 0, picc_rand, pad=False)
+            plaintext = cipher.decrypt(picc_enc_data_stripped)
+        else:
+            raise InvalidMessage("Invalid encryption mode.")
 
     p_stream = io.BytesIO(plaintext)
     data_stream = io.BytesIO()
 
     picc_data_tag = p_stream.read(1)
+
+    if check_picc_data_tag and not picc_data_plausible(picc_data_tag[0]):
+        # same fake SDMMAC calculation as below, the wrong key mustn't be told apart by the timing
+        _fake_sdmmac(param_mode, sdm_file_read_key, enc_file_data, mode, sdmmac_param)
+        raise ImplausiblePICCData("Implausible PICCDataTag (most probably wrong key)")
+
     uid_mirroring_en = (picc_data_tag[0] & 0x80) == 0x80
     sdm_read_ctr_en = (picc_data_tag[0] & 0x40) == 0x40
     uid_length = picc_data_tag[0] & 0x0F
@@ -238,7 +303,7 @@ def decrypt_sun_message(param_mode: ParamMode,
     # dont read the buffer any further if we don't recognize it
     if uid_length not in [0x07]:
         # fake SDMMAC calculation to avoid potential timing attacks
-        calculate_sdmmac(param_mode, sdm_file_read_key(b"\x00" * 7), b"\x00" * 10, enc_file_data, mode=mode)
+        _fake_sdmmac(param_mode, sdm_file_read_key, enc_file_data, mode, sdmmac_param)
         raise InvalidMessage("Unsupported UID length")
 
     if uid_mirroring_en:
@@ -253,21 +318,30 @@ def decrypt_sun_message(param_mode: ParamMode,
     if uid is None:
         raise InvalidMessage("UID cannot be None.")
 
-    file_key = sdm_file_read_key(uid)
+    if read_ctr_check is not None:
+        read_ctr_check(uid, read_ctr_num)
+
+    with stage("derive"):
+        file_key = sdm_file_read_key(uid)
 
-    if sdmmac != calculate_sdmmac(param_mode,
-                                  file_key,
-                                  data_stream.getvalue(),
-                                  enc_file_data,
-                                  mode=mode):
+    with stage("mac"):
+        proper_sdmmac = calculate_sdmmac(param_mode,
+                                         file_key,
+                                         data_stream.getvalue(),
+                                         enc_file_data,
+                                         mode=mode,
+                                         sdmmac_param=sdmmac_param)
+
+    if sdmmac != proper_sdmmac:
         raise InvalidMessage("Message is not properly signed - invalid MAC")
 
     if enc_file_data:
         if not read_ctr:
             raise InvalidMessage("SDMReadCtr is required to decipher SDMENCFileData.")
 
-        file_data = decrypt_file_data(file_key, data_stream.getvalue(),
-                                      read_ctr, enc_file_data, mode=mode)
+        with stage("file_decrypt"):
+            file_data = decrypt_file_data(file_key, data_stream.getvalue(),
+                                          read_ctr, enc_file_data, mode=mode)
 
     return {
         "picc_data_tag": picc_data_tag,
@@ -0,0 +1,127 @@
+"""
+Optional timing of the SUN verification stages (key derivation, PICCData decryption, SDMMAC calculation, ...).
+
+The server installs a StageRecorder for the duration of a request. Without a recorder, stage() returns
+a shared no-op context manager, so the instrumented code pays only for a context variable lookup.
+"""
+
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+
+
+class Stage:
+    __slots__ = ("recorder", "name", "parent", "start", "end", "error")
+
+    def __init__(self, recorder: "StageRecorder", name: str, parent: Optional[int]):
+        self.recorder = recorder
+        self.name = name
+        # index of the enclosing stage in StageRecorder.stages
+        self.parent = parent
+        self.start = 0.0
+        self.end: Optional[float] = None
+        self.error: Optional[str] = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else self.recorder.clock()) - self.start
+
+    def __enter__(self):
+        self.recorder.stack.append(len(self.recorder.stages))
+        self.recorder.stages.append(self)
+        self.start = self.recorder.clock()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.end = self.recorder.clock()
+        self.recorder.stack.pop()
+
+        if exc_type is not None:
+            self.error = exc_type.__name__
+
+
+class StageRecorder:
+    def __init__(self, clock=time.perf_counter):
+        """
+        Stages of a single request
+        :param clock: monotonic clock (in seconds)
+        """
+        self.clock = clock
+        self.start = clock()
+        self.end: Optional[float] = None
+        self.stages: List[Stage] = []
+        self.stack: List[int] = []
+        # e.g. encryption_mode, derive_mode, outcome
+        self.labels: Dict[str, str] = {}
+
+    def stage(self, name: str) -> Stage:
+        return Stage(self, name, self.stack[-1] if self.stack else None)
+
+    def finish(self) -> float:
+        """
+        :return: total duration of the request (in seconds)
+        """
+        if self.end is None:
+            self.end = self.clock()
+
+        return self.end - self.start
+
+    def durations(self) -> Dict[str, float]:
+        """
+        :return: stage name -> total duration (in seconds) of all finished stages with that name
+        """
+        result: Dict[str, float] = {}
+
+        for item in self.stages:
+            if item.end is not None:
+                result[item.name] = result.get(item.name, 0.0) + item.end - item.start
+
+        return result
+
+
+class _NoStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return None
+
+
+NO_STAGE = _NoStage()
+
+_recorder: ContextVar[Optional[StageRecorder]] = ContextVar("libsdm_stage_recorder", default=None)
+
+
+def stage(name: str):
+    """
+    Context manager timing the enclosed code as the given stage (if there is an active recorder).
+    """
+    recorder = _recorder.get()
+
+    if recorder is None:
+        return NO_STAGE
+
+    return recorder.stage(name)
+
+
+def annotate(key: str, value: str):
+    recorder = _recorder.get()
+
+    if recorder is not None:
+        recorder.labels[key] = value
+
+
+def current_recorder() -> Optional[StageRecorder]:
+    return _recorder.get()
+
+
+def activate(recorder: Optional[StageRecorder]):
+    """
+    Install the recorder for the current context
+    :return: token for deactivate()
+    """
+    return _recorder.set(recorder)
+
+
+def deactivate(token):
+    _recorder.reset(token)
@@ -0,0 +1,234 @@
+"""
+Adaptive load shedding (admission control) in front of the verification routes.
+
+Under overload all the requests would slow down together (every worker busy deriving keys), so the requests
+which can't be served in time are rejected early with 503 Service Unavailable and Retry-After,
+before any cryptographic work. Two signals are used:
+* requests in flight in the process (threads of a worker, requests queued in the ASGI executor); single-threaded
+  uWSGI workers never have more than one, the requests queue up in the listen backlog instead
+* queueing delay - time between the arrival of the request at the front-end proxy (X-Request-Start header,
+  e.g. nginx: uwsgi_param HTTP_X_REQUEST_START "t=${msec}";) or at the ASGI server and the start of its processing
+
+Like CoDel, the process is considered overloaded when even the smallest queueing delay within an interval
+exceeds the target delay (a standing queue, not a short burst). The routes have priorities: the JSON API
+first, then the SUN pages (/tag, /tagtt, /tagpt), then the demo pages (/, /webnfc). Lower priorities
+get a smaller share of the in-flight limit and, while overloaded, a smaller queueing delay budget
+(the demo pages are not served at all), so the queueing delay of the admitted requests stays bounded.
+
+Admitted and shed requests are counted in per-process memory-mapped files (admission.<pid>.db),
+like the stage metrics.
+"""
+
+import math
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+from werkzeug.exceptions import ServiceUnavailable
+
+from api_wsgi import json_error_response
+from server.metrics import ProcessValues
+
+API, SUN, DEMO = 0, 1, 2
+PRIORITY_NAMES = ("api", "sun", "demo")
+PRIORITIES = {
+    '/api/tag': API,
+    '/api/tagtt': API,
+    '/api/tagpt': API,
+    '/api/token': API,
+    '/tag': SUN,
+    '/tagtt': SUN,
+    '/tagpt': SUN,
+    '/': DEMO,
+    '/webnfc': DEMO,
+}
+# share of the in-flight limit available to the priority
+IN_FLIGHT_SHARES = (1.0, 0.75, 0.5)
+# queueing delay budget (in target delays) of the priority while overloaded
+DELAY_BUDGETS = (2.0, 1.0, 0.0)
+
+SLOTS = tuple(f"{kind}_{priority}" for kind in ("admitted", "shed_in_flight", "shed_delay")
+              for priority in PRIORITY_NAMES) + ("in_flight", "overloaded")
+
+
+def parse_request_start(value: str, now: float) -> Optional[float]:
+    """
+    :param value: X-Request-Start header, e.g. "t=1700000000.123" (seconds) or "t=1700000000123456" (microseconds)
+    :return: queueing delay in seconds or None if the header is malformed
+    """
+    try:
+        started = float(value[2:] if value.startswith("t=") else value)
+    except ValueError:
+        return None
+
+    # milliseconds or microseconds since epoch
+    if started > 1e14:
+        started /= 1e6
+    elif started > 1e11:
+        started /= 1e3
+
+    return max(0.0, now - started)
+
+
+class AdmissionControl:
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self,
+                 max_in_flight: int = 0,
+                 target_delay: float = 0.05,
+                 interval: float = 0.1,
+                 retry_after: int = 1,
+                 priorities: Optional[Dict[str, int]] = None,
+                 stats_directory: Optional[str] = None,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param max_in_flight: maximum number of requests processed concurrently by the process (0 = no limit)
+        :param target_delay: acceptable standing queueing delay (in seconds)
+        :param interval: length of the interval (in seconds) of the smallest queueing delay
+        :param retry_after: value of the Retry-After header of the rejections (in seconds)
+        :param priorities: path -> priority (API, SUN or DEMO), other paths are always admitted
+        """
+        self.max_in_flight = max_in_flight
+        self.target_delay = target_delay
+        self.interval = interval
+        self.retry_after = retry_after
+        self.priorities = PRIORITIES if priorities is None else priorities
+        self.stats = ProcessValues("admission", SLOTS, stats_directory)
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.overloaded = False
+        self.interval_end = clock() + interval
+        self.interval_min = math.inf
+
+    def observe_delay(self, delay: float):
+        """
+        Record the queueing delay of a request (admitted or not)
+        """
+        now = self.clock()
+
+        with self.lock:
+            if now >= self.interval_end:
+                if self.interval_min != math.inf:
+                    self.overloaded = self.interval_min > self.target_delay
+                elif now >= self.interval_end + self.interval:
+                    # no requests for a whole interval
+                    self.overloaded = False
+
+                self.interval_min = math.inf
+                self.interval_end = now + self.interval
+
+            self.interval_min = min(self.interval_min, delay)
+
+        self.stats.set("overloaded", 1.0 if self.overloaded else 0.0)
+
+    def delay_ok(self, priority: int, delay: Optional[float]) -> bool:
+        """
+        :return: whether the request may be processed after waiting for the given time
+        """
+        if delay is None or not self.overloaded:
+            return True
+
+        return delay <= self.target_delay * DELAY_BUDGETS[priority]
+
+    def admit(self, priority: int, delay: Optional[float] = None) -> bool:
+        """
+        Decide about the request, release() must be called after an admitted request was processed
+        :param delay: queueing delay of the request (None = unknown)
+        """
+        if delay is not None:
+            self.observe_delay(delay)
+
+        if not self.delay_ok(priority, delay):
+            self.stats.add(f"shed_delay_{PRIORITY_NAMES[priority]}")
+            return False
+
+        with self.lock:
+            if self.max_in_flight and self.in_flight >= max(1, int(self.max_in_flight * IN_FLIGHT_SHARES[priority])):
+                admitted = False
+            else:
+                admitted = True
+                self.in_flight += 1
+
+            in_flight = self.in_flight
+
+        if not admitted:
+            self.stats.add(f"shed_in_flight_{PRIORITY_NAMES[priority]}")
+            return False
+
+        self.stats.add(f"admitted_{PRIORITY_NAMES[priority]}")
+        self.stats.set("in_flight", in_flight)
+        return True
+
+    def shed(self, priority: int):
+        """
+        Count an admitted request which was dropped later on (e.g. waited for too long in the executor queue),
+        it's counted both as admitted and shed
+        """
+        self.stats.add(f"shed_delay_{PRIORITY_NAMES[priority]}")
+
+    def release(self):
+        with self.lock:
+            self.in_flight -= 1
+            in_flight = self.in_flight
+
+        self.stats.set("in_flight", in_flight)
+
+    def rejection(self) -> ServiceUnavailable:
+        return ServiceUnavailable("Server is overloaded, try again later.", retry_after=self.retry_after)
+
+    def render(self) -> str:
+        """
+        :return: metrics in Prometheus text exposition format
+        """
+        values = self.stats.collect(maxima=("overloaded",))
+        lines = ["# HELP sdm_admission_requests_total Requests to the routes under admission control.",
+                 "# TYPE sdm_admission_requests_total counter"]
+
+        for priority in PRIORITY_NAMES:
+            for decision, slot in (("admitted", "admitted"), ("shed", "shed_in_flight"), ("shed", "shed_delay")):
+                reason = "" if decision == "admitted" else f',reason="{slot[len("shed_"):]}"'
+                lines.append(f'sdm_admission_requests_total{{priority="{priority}",decision="{decision}"{reason}}} '
+                             f'{int(values[f"{slot}_{priority}"])}')
+
+        lines += ["# HELP sdm_admission_in_flight Requests processed at the moment.",
+                  "# TYPE sdm_admission_in_flight gauge",
+                  f"sdm_admission_in_flight {int(values['in_flight'])}",
+                  "# HELP sdm_admission_overloaded Whether some process is shedding load because of queueing delay.",
+                  "# TYPE sdm_admission_overloaded gauge",
+                  f"sdm_admission_overloaded {int(values['overloaded'])}"]
+
+        return "\n".join(lines) + "\n"
+
+
+class AdmissionMiddleware:
+    def __init__(self, app, admission: AdmissionControl):
+        """
+        WSGI middleware which answers 503 to the requests rejected by the admission control, JSON for the /api/ paths
+        """
+        self.app = app
+        self.admission = admission
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        priority = self.admission.priorities.get(path)
+
+        if priority is None:
+            return self.app(environ, start_response)
+
+        request_start = environ.get('HTTP_X_REQUEST_START')
+        delay = parse_request_start(request_start, time.time()) if request_start else None
+
+        if not self.admission.admit(priority, delay):
+            err = self.admission.rejection()
+
+            if path.startswith('/api/'):
+                return json_error_response(err, environ, start_response)
+
+            return err(environ, start_response)
+
+        try:
+            # the responses of the routes are fully rendered, so the request is done once the app returns
+            return self.app(environ, start_response)
+        finally:
+            self.admission.release()
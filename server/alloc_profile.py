@@ -0,0 +1,168 @@
+"""
+Allocation profiling of sampled requests with tracemalloc.
+
+For a sampled request, tracemalloc is started (unless it's already tracing, e.g. PYTHONTRACEMALLOC is set),
+the request is handled (including the iteration of the response body) and a snapshot is taken.
+The allocations still alive at the end of the request (retained memory) and the peak of the traced memory
+during the request (short-lived objects, e.g. io.BytesIO buffers) are aggregated per endpoint
+and per source line. Tracing is stopped again after the request, so the other requests run without
+any tracemalloc overhead.
+
+tracemalloc is process-wide, so only one request is profiled at a time and the allocations made
+by concurrent requests in other threads of the same process are attributed to the profiled one.
+The statistics are kept per process.
+"""
+
+import os
+import random
+import threading
+import tracemalloc
+from collections import defaultdict
+from typing import Callable, Dict, Iterable
+
+SNAPSHOT_FILTERS = [
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, __file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+]
+
+
+class AllocationProfiler:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+                 sample_rate: float,
+                 paths: Iterable[str],
+                 frames: int = 1,
+                 max_lines: int = 10000,
+                 rand: Callable[[], float] = random.random):
+        """
+        :param sample_rate: fraction of the requests to profile
+        :param paths: paths of the profiled endpoints
+        :param frames: number of stack frames recorded per allocation (1 = the allocating line only)
+        :param max_lines: maximum number of tracked source lines per endpoint
+        """
+        self.sample_rate = sample_rate
+        self.paths = frozenset(paths)
+        self.frames = frames
+        self.max_lines = max_lines
+        self.rand = rand
+
+        self.lock = threading.Lock()
+        self.busy = threading.Lock()
+        # endpoint -> {"requests", "count", "size", "peak"}
+        self.endpoints: Dict[str, Dict[str, int]] = defaultdict(lambda: {"requests": 0, "count": 0, "size": 0, "peak": 0})
+        # endpoint -> "file:line" -> {"count", "size"}
+        self.lines: Dict[str, Dict[str, Dict[str, int]]] = defaultdict(dict)
+
+    def should_sample(self, path: str) -> bool:
+        return path in self.paths and self.rand() < self.sample_rate
+
+    def profile(self, path: str, func: Callable[[], object]):
+        """
+        Run func() under tracemalloc (unless another request is being profiled) and record its allocations.
+        :return: return value of func()
+        """
+        if not self.busy.acquire(blocking=False):
+            return func()
+
+        try:
+            started_here = not tracemalloc.is_tracing()
+
+            if started_here:
+                tracemalloc.start(self.frames)
+                before = None
+            else:
+                before = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+
+            try:
+                result = func()
+            finally:
+                peak = tracemalloc.get_traced_memory()[1] - baseline
+                after = tracemalloc.take_snapshot().filter_traces(SNAPSHOT_FILTERS)
+
+                if started_here:
+                    tracemalloc.stop()
+
+            if before is None:
+                stats = [(stat.traceback, stat.count, stat.size) for stat in after.statistics('lineno')]
+            else:
+                stats = [(stat.traceback, stat.count_diff, stat.size_diff) for stat in after.compare_to(before, 'lineno')]
+
+            self.record(path, stats, peak)
+            return result
+        finally:
+            self.busy.release()
+
+    def record(self, path: str, stats, peak: int):
+        with self.lock:
+            endpoint = self.endpoints[path]
+            endpoint["requests"] += 1
+            endpoint["peak"] = max(endpoint["peak"], peak)
+            lines = self.lines[path]
+
+            for traceback, count, size in stats:
+                if not count and not size:
+                    continue
+
+                endpoint["count"] += count
+                endpoint["size"] += size
+                frame = traceback[0]
+                key = f"{frame.filename}:{frame.lineno}"
+                line = lines.get(key)
+
+                if line is None:
+                    if len(lines) >= self.max_lines:
+                        continue
+
+                    line = lines[key] = {"count": 0, "size": 0}
+
+                line["count"] += count
+                line["size"] += size
+
+    def report(self, top: int = 25) -> dict:
+        """
+        :return: per endpoint totals and the top source lines by the retained size
+        """
+        with self.lock:
+            endpoints = {}
+
+            for path, totals in self.endpoints.items():
+                lines = sorted(self.lines[path].items(), key=lambda item: item[1]["size"], reverse=True)[:top]
+                endpoints[path] = dict(totals, top_lines=[dict(line=key, **value) for key, value in lines])
+
+            return {"pid": os.getpid(), "endpoints": endpoints}
+
+    def reset(self):
+        with self.lock:
+            self.endpoints.clear()
+            self.lines.clear()
+
+
+class AllocationMiddleware:
+    def __init__(self, app, profiler: AllocationProfiler):
+        """
+        WSGI middleware profiling the allocations of the sampled requests.
+        """
+        self.app = app
+        self.profiler = profiler
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+
+        if not self.profiler.should_sample(path):
+            return self.app(environ, start_response)
+
+        def handle():
+            response = self.app(environ, start_response)
+
+            try:
+                return list(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+
+        return self.profiler.profile(path, handle)
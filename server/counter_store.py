@@ -0,0 +1,390 @@
+"""
+Replay protection: per-UID store of the highest SDMReadCtr seen so far.
+
+The state is kept in a memory-mapped table (replay-table.db) shared by all worker processes, so a message
+verified by one worker is rejected as replayed by all the others, including the workers respawned later on.
+The table is divided into stripes of STRIPE_SLOTS slots: the hash of the UID selects a stripe and the UID
+is stored in its first free slot. Entries are never evicted. A stripe is guarded by a byte-range lock
+of the file (between the processes) and a per-process lock (between the threads). In the unlikely case
+that the stripe of a UID is full, its counter is kept in the memory of the process only (see overflowed).
+
+If a directory is configured, every accepted counter is also appended to a write-ahead log
+which is periodically compacted into a snapshot in the background.
+
+Each process writes only its own files (counters.<pid>.wal, counters.<pid>.snap), so several workers
+may share the directory. On startup, the state is recovered by merging all snapshots and logs found
+in the directory (taking the maximum counter per UID). Files left behind by processes which are no longer
+running are folded into the snapshot of the recovering process and removed.
+
+Every slot also records when its counter was last raised (in seconds), so the recently active tags
+can be listed (see recent), e.g. to pre-derive their keys at startup. The table in a configured directory
+survives restarts together with these times; the counters restored only from the logs count as raised at recovery.
+
+Slot layout: fingerprint of the UID (uint64, 0 = empty), UID length (uint8), UID (padded), padding,
+read counter (uint32), time of the last update (uint32, UNIX time).
+"""
+
+import atexit
+import fcntl
+import glob
+import hashlib
+import heapq
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from libsdm.sdm import InvalidMessage
+from server.key_cache import _remove_directory
+
+# uid length, uid (padded), read counter, crc32 of the preceding fields
+RECORD = struct.Struct("<B10sII")
+MAX_UID_LENGTH = 10
+
+SLOT = struct.Struct("<QB10sxII")
+STRIPE_SLOTS = 64
+TABLE_NAME = "replay-table.db"
+
+
+class ReplayedMessage(InvalidMessage):
+    pass
+
+
+def pack_record(uid: bytes, read_ctr: int) -> bytes:
+    head = struct.pack("<B10sI", len(uid), uid, read_ctr)
+    return head + struct.pack("<I", zlib.crc32(head))
+
+
+def iter_records(data: bytes) -> Iterator[Tuple[bytes, int]]:
+    """
+    Parse records, stopping at the first torn or corrupted one (e.g. after a crash).
+    """
+    usable = len(data) - len(data) % RECORD.size
+
+    for offset in range(0, usable, RECORD.size):
+        uid_length, uid, read_ctr, crc = RECORD.unpack_from(data, offset)
+
+        if crc != zlib.crc32(data[offset:offset + RECORD.size - 4]) or uid_length > MAX_UID_LENGTH:
+            return
+
+        yield uid[:uid_length], read_ctr
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+    return True
+
+
+class CounterStore:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+                 directory: Optional[str] = None,
+                 slots: int = 262144,
+                 compact_every: int = 100000,
+                 fsync: bool = False):
+        """
+        Per-UID last seen read counter store
+        :param directory: where to keep the shared table, the write-ahead log and snapshots
+                          (None = new private temporary directory for the table only, shared by the processes
+                          forked later on and removed when this process exits)
+        :param slots: capacity of the shared table (rounded up to whole stripes)
+        :param compact_every: compact the log after this number of appended records
+        :param fsync: whether to fsync() the log after every record
+        """
+        self.stripes = max(1, -(-slots // STRIPE_SLOTS))
+        self.size = self.stripes * STRIPE_SLOTS * SLOT.size
+        self.directory = directory
+        self.compact_every = compact_every
+        self.fsync = fsync
+
+        if directory is None:
+            table_directory = tempfile.mkdtemp(prefix="sdm-counters-",
+                                               dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+            # only by the process which created it, the forked workers run the exit handlers as well
+            atexit.register(_remove_directory, table_directory, os.getpid())
+        else:
+            table_directory = directory
+            os.makedirs(directory, exist_ok=True)
+
+        self.table_path = os.path.join(table_directory, TABLE_NAME)
+        fd = os.open(self.table_path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            if os.fstat(fd).st_size != self.size:
+                # different layout (or new file), start empty, the logs are merged below
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+        finally:
+            os.close(fd)
+
+        self.lock = threading.Lock()
+        self.table_pid: Optional[int] = None
+        self.table_fd: Optional[int] = None
+        self.mapped = None
+        # UIDs whose stripe was full, kept by this process only
+        self.overflow: Dict[bytes, Tuple[int, int]] = {}
+        self.overflowed = 0
+
+        # called with (uid, read_ctr) after the counter was updated (e.g. to share it with other nodes)
+        self.listener: Optional[Callable[[bytes, int], None]] = None
+
+        self.wal_lock = threading.Lock()
+        self.wal_fd = None
+        self.wal_records = 0
+        self.compacting = False
+
+        if directory is not None:
+            self._set_paths()
+            self._recover()
+
+    def _set_paths(self):
+        self.pid = os.getpid()
+        self.wal_path = os.path.join(self.directory, f"counters.{self.pid}.wal")
+        self.snap_path = os.path.join(self.directory, f"counters.{self.pid}.snap")
+
+    def _map(self):
+        if self.table_pid != os.getpid():
+            with self.lock:
+                if self.table_pid != os.getpid():
+                    # forked, open own descriptor (the byte-range locks belong to the process)
+                    self.table_fd = os.open(self.table_path, os.O_RDWR)
+                    self.mapped = mmap.mmap(self.table_fd, self.size)
+                    self.table_pid = os.getpid()
+
+        return self.mapped
+
+    def _raise(self, uid: bytes, read_ctr: Optional[int]) -> Tuple[Optional[int], bool]:
+        """
+        Look up the counter of the UID and raise it to read_ctr (if given and higher)
+        :return: tuple (previous counter or None, whether the counter was raised)
+        """
+        fingerprint = int.from_bytes(hashlib.blake2b(uid, digest_size=8).digest(), 'little') | 1
+        stripe = (fingerprint >> 1) % self.stripes
+        base = stripe * STRIPE_SLOTS * SLOT.size
+        mapped = self._map()
+
+        with self.lock:
+            fcntl.lockf(self.table_fd, fcntl.LOCK_EX, 1, stripe)
+
+            try:
+                for position in range(base, base + STRIPE_SLOTS * SLOT.size, SLOT.size):
+                    entry_fingerprint, uid_length, entry_uid, last, _ = SLOT.unpack_from(mapped, position)
+
+                    if entry_fingerprint == 0:
+                        # entries are never removed, so the UID can't be further
+                        if read_ctr is None or uid in self.overflow:
+                            break
+
+                        SLOT.pack_into(mapped, position, fingerprint, len(uid), uid, read_ctr, int(time.time()))
+                        return None, True
+
+                    if entry_fingerprint == fingerprint and entry_uid[:uid_length] == uid:
+                        if read_ctr is None or read_ctr <= last:
+                            return last, False
+
+                        SLOT.pack_into(mapped, position, fingerprint, len(uid), uid, read_ctr, int(time.time()))
+                        return last, True
+                else:
+                    if read_ctr is not None and uid not in self.overflow:
+                        self.overflowed += 1
+            finally:
+                fcntl.lockf(self.table_fd, fcntl.LOCK_UN, 1, stripe)
+
+            last = self.overflow[uid][0] if uid in self.overflow else None
+
+            if read_ctr is None or (last is not None and read_ctr <= last):
+                return last, False
+
+            self.overflow[uid] = read_ctr, int(time.time())
+            return last, True
+
+    def get(self, uid: bytes) -> Optional[int]:
+        if len(uid) > MAX_UID_LENGTH:
+            return None
+
+        return self._raise(uid, None)[0]
+
+    def check(self, uid: bytes, read_ctr: Optional[int]):
+        """
+        Reject stale or duplicate counter. Doesn't modify the state, so it's safe
+        to call before the message is authenticated.
+        :raises:
+            ReplayedMessage: if read_ctr is not higher than the last seen one
+        """
+        if read_ctr is None:
+            return
+
+        last = self.get(uid)
+
+        if last is not None and read_ctr <= last:
+            raise ReplayedMessage("Stale read counter (replayed message).")
+
+    def update(self, uid: bytes, read_ctr: Optional[int]):
+        """
+        Record counter of the authenticated message.
+        :raises:
+            ReplayedMessage: if read_ctr is not higher than the last seen one (e.g. concurrent replay)
+        """
+        if read_ctr is None or len(uid) > MAX_UID_LENGTH:
+            return
+
+        if not self._raise(uid, read_ctr)[1]:
+            raise ReplayedMessage("Stale read counter (replayed message).")
+
+        if self.directory is not None:
+            self._append(pack_record(uid, read_ctr))
+
+        if self.listener is not None:
+            self.listener(uid, read_ctr)
+
+    def merge(self, uid: bytes, read_ctr: int, log: bool = False) -> bool:
+        """
+        Raise the counter to read_ctr (if it's higher).
+        :param log: whether to append the change to the write-ahead log
+        :return: whether the state was changed
+        """
+        if len(uid) > MAX_UID_LENGTH:
+            return False
+
+        if not self._raise(uid, read_ctr)[1]:
+            return False
+
+        if log and self.directory is not None:
+            self._append(pack_record(uid, read_ctr))
+
+        return True
+
+    def _entries(self) -> Iterator[Tuple[bytes, int, int]]:
+        """
+        :return: iterator of (uid, read_ctr, time of the last update)
+        """
+        mapped = self._map()
+
+        for stripe in range(self.stripes):
+            base = stripe * STRIPE_SLOTS * SLOT.size
+
+            with self.lock:
+                fcntl.lockf(self.table_fd, fcntl.LOCK_SH, 1, stripe)
+
+                try:
+                    copy = [(uid[:uid_length], read_ctr, updated)
+                            for fingerprint, uid_length, uid, read_ctr, updated
+                            in SLOT.iter_unpack(mapped[base:base + STRIPE_SLOTS * SLOT.size]) if fingerprint]
+                finally:
+                    fcntl.lockf(self.table_fd, fcntl.LOCK_UN, 1, stripe)
+
+            yield from copy
+
+        with self.lock:
+            copy = [(uid, read_ctr, updated) for uid, (read_ctr, updated) in self.overflow.items()]
+
+        yield from copy
+
+    def items(self) -> Iterator[Tuple[bytes, int]]:
+        for uid, read_ctr, _ in self._entries():
+            yield uid, read_ctr
+
+    def recent(self, count: int) -> List[bytes]:
+        """
+        :return: up to count UIDs with the most recently raised counters, the most recent first
+        """
+        return [uid for uid, _, _ in heapq.nlargest(count, self._entries(), key=lambda entry: entry[2])]
+
+    def __len__(self):
+        return sum(1 for _ in self.items())
+
+    def _append(self, record: bytes):
+        with self.wal_lock:
+            if self.pid != os.getpid():
+                # forked (e.g. uWSGI worker), the inherited state is kept but the files belong to the parent
+                os.close(self.wal_fd)
+                self._set_paths()
+                self._open_wal()
+                self.compacting = False
+
+            os.write(self.wal_fd, record)
+
+            if self.fsync:
+                os.fsync(self.wal_fd)
+
+            self.wal_records += 1
+            start_compaction = self.wal_records >= self.compact_every and not self.compacting
+
+            if start_compaction:
+                self.compacting = True
+
+        if start_compaction:
+            threading.Thread(target=self.compact, name="counter-store-compaction", daemon=True).start()
+
+    def _open_wal(self):
+        self.wal_fd = os.open(self.wal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        self.wal_records = 0
+
+    def _recover(self):
+        files = glob.glob(os.path.join(self.directory, "counters.*"))
+
+        for path in files:
+            with open(path, "rb") as f:
+                for uid, read_ctr in iter_records(f.read()):
+                    self.merge(uid, read_ctr)
+
+        # our snapshot now covers everything found in the directory
+        self._write_snapshot()
+
+        for path in files:
+            if path == self.snap_path:
+                continue
+
+            try:
+                pid = int(os.path.basename(path).split(".")[1])
+            except (IndexError, ValueError):
+                continue
+
+            if pid == self.pid or not _pid_alive(pid):
+                os.unlink(path)
+
+        self._open_wal()
+
+    def _write_snapshot(self):
+        tmp_path = self.snap_path + ".tmp"
+
+        with open(tmp_path, "wb") as f:
+            f.write(b"".join(pack_record(uid, read_ctr) for uid, read_ctr in self.items()))
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(tmp_path, self.snap_path)
+
+    def compact(self):
+        """
+        Replace the write-ahead log with a snapshot of the current state.
+        """
+        try:
+            with self.wal_lock:
+                old_path = self.wal_path + ".1"
+                # the records in the rotated log are already applied to the in-memory state
+                os.close(self.wal_fd)
+                os.replace(self.wal_path, old_path)
+                self._open_wal()
+
+            self._write_snapshot()
+            os.unlink(old_path)
+        finally:
+            with self.wal_lock:
+                self.compacting = False
+
+    def close(self):
+        with self.wal_lock:
+            if self.wal_fd is not None:
+                os.close(self.wal_fd)
+                self.wal_fd = None
@@ -0,0 +1,445 @@
+"""
+Reconciliation of read counters between several server instances.
+
+The per-UID highest read counter is a max-register CRDT: merging is taking the maximum, which is
+commutative, associative and idempotent, so deltas may be delivered late, twice or out of order.
+Every accepted counter is queued (non-blocking) and a background thread ships the queued deltas
+in compact batches, with a bounded number of batches per interval. Each batch is authenticated by HMAC-SHA256
+with the secret key shared by the nodes; the batches failing the check are dropped. Another thread receives the batches
+of the other nodes and merges them into the local CounterStore.
+
+Transports:
+* UDPTransport - datagrams sent to the configured list of peers; every worker process of a node
+  receives on its own port (bind port + worker index) and the batches are sent to all the workers
+  of the peers and to the other workers of the same node
+* DirectoryTransport - batch files dropped into a shared directory (works for several workers per node)
+
+The transport is started by the background thread (never in the request thread): if it can't be started
+(e.g. the port is taken), the failure is logged and the start is retried with exponential backoff.
+
+Note that a replay which reaches another node within the shipping interval may still be accepted.
+"""
+
+import hashlib
+import hmac
+import logging
+import os
+import random
+import socket
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from server.counter_store import MAX_UID_LENGTH, CounterStore
+
+MAGIC = b"SDMC"
+VERSION = 2
+# magic, version, node id, number of records
+HEADER = struct.Struct("<4sB16sH")
+# uid length, uid (padded), read counter
+RECORD = struct.Struct("<B10sI")
+MAX_BATCH = 1000
+MAC_LENGTH = 16
+
+logger = logging.getLogger(__name__)
+
+
+def _batch_mac(key: bytes, body: bytes) -> bytes:
+    return hmac.new(key, body, digestmod=hashlib.sha256).digest()[0:MAC_LENGTH]
+
+
+def encode_batch(key: bytes, node_id: bytes, deltas: List[Tuple[bytes, int]]) -> bytes:
+    body = HEADER.pack(MAGIC, VERSION, node_id, len(deltas)) \
+        + b"".join(RECORD.pack(len(uid), uid, read_ctr) for uid, read_ctr in deltas)
+    return body + _batch_mac(key, body)
+
+
+def decode_batch(key: bytes, payload: bytes) -> Optional[Tuple[bytes, List[Tuple[bytes, int]]]]:
+    """
+    :return: tuple (node_id, deltas) or None if the payload is malformed or not authentic
+    """
+    if len(payload) < HEADER.size + MAC_LENGTH:
+        return None
+
+    body, mac = payload[:-MAC_LENGTH], payload[-MAC_LENGTH:]
+
+    if not hmac.compare_digest(mac, _batch_mac(key, body)):
+        return None
+
+    magic, version, node_id, count = HEADER.unpack_from(body, 0)
+
+    if magic != MAGIC or version != VERSION or len(body) != HEADER.size + count * RECORD.size:
+        return None
+
+    deltas = []
+
+    for uid_length, uid, read_ctr in RECORD.iter_unpack(body[HEADER.size:]):
+        if uid_length <= MAX_UID_LENGTH:
+            deltas.append((uid[:uid_length], read_ctr))
+
+    return node_id, deltas
+
+
+def parse_address(address: str) -> Tuple[str, int]:
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def uwsgi_worker_index() -> int:
+    """
+    :return: 0-based index of the current uWSGI worker (0 when not running under uWSGI)
+    """
+    try:
+        import uwsgi  # pylint: disable=import-outside-toplevel,import-error
+    except ImportError:
+        return 0
+
+    return max(uwsgi.worker_id() - 1, 0)
+
+
+def uwsgi_worker_count() -> Optional[int]:
+    """
+    :return: number of uWSGI worker processes (None when not running under uWSGI)
+    """
+    try:
+        import uwsgi  # pylint: disable=import-outside-toplevel,import-error
+    except ImportError:
+        return None
+
+    return uwsgi.numproc
+
+
+class UDPTransport:
+    def __init__(self,
+                 bind: Tuple[str, int],
+                 peers: List[Tuple[str, int]],
+                 workers: int = 1,
+                 worker_index: Callable[[], int] = uwsgi_worker_index,
+                 worker_count: Callable[[], Optional[int]] = uwsgi_worker_count):
+        """
+        :param bind: (host, port) to receive batches on, the worker with index i uses port + i
+        :param peers: list of (host, port) of the other nodes (the port of their first worker)
+        :param workers: number of worker processes per node (the same on all the nodes)
+        :param worker_index: returns the index (0 ... workers - 1) of the current worker process
+        :param worker_count: returns the number of worker processes which will be started (None if unknown)
+        :raises:
+            ValueError: if the ports of the workers can't be laid out (checked once, at startup)
+        """
+        if workers < 1:
+            raise ValueError("The number of workers must be at least 1.")
+
+        if workers > 1 and bind[1] == 0:
+            raise ValueError("Several workers need a fixed port to bind.")
+
+        if any(port + workers > 65536 for _, port in [bind] + peers):
+            raise ValueError("The ports of the workers exceed 65535.")
+
+        processes = worker_count()
+
+        if processes is not None and processes > workers:
+            raise ValueError(f"{processes} worker processes don't fit the ports of {workers} workers.")
+
+        self.bind = bind
+        self.peers = peers
+        self.workers = workers
+        self.worker_index = worker_index
+        self.index = 0
+        self.sock: Optional[socket.socket] = None
+
+    def start(self, node_id: bytes):  # pylint: disable=unused-argument
+        if self.sock is not None:
+            self.sock.close()
+
+        self.index = self.worker_index() if self.workers > 1 else 0
+
+        if not 0 <= self.index < self.workers:
+            raise RuntimeError(f"Worker index {self.index} is out of range, check the number of workers.")
+
+        host, port = self.bind
+        # no SO_REUSEPORT: each worker owns its port, so every datagram reaches the worker it was sent to
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind((host, port + self.index))
+        self.sock.settimeout(1.0)
+
+    def targets(self) -> List[Tuple[str, int]]:
+        """
+        :return: all the workers of the peers and the other workers of this node
+        """
+        host, port = self.bind
+        targets = [(peer_host, peer_port + i) for peer_host, peer_port in self.peers for i in range(self.workers)]
+        return targets + [(host, port + i) for i in range(self.workers) if i != self.index]
+
+    def send(self, payload: bytes):
+        for target in self.targets():
+            try:
+                self.sock.sendto(payload, target)
+            except OSError:
+                # peer unreachable, CRDT merge tolerates lost deltas
+                pass
+
+    def receive(self) -> List[bytes]:
+        try:
+            payload, _ = self.sock.recvfrom(65535)
+        except socket.timeout:
+            return []
+
+        return [payload]
+
+
+class DirectoryTransport:
+    def __init__(self, directory: str, retention: float = 60.0, poll_interval: float = 0.2):
+        """
+        :param directory: shared directory for batch files
+        :param retention: how long (in seconds) the written batch files are kept
+        :param poll_interval: how often to look for new batch files
+        """
+        self.directory = directory
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self.prefix = ""
+        self.seq = 0
+        self.seen: set = set()
+        os.makedirs(directory, exist_ok=True)
+
+    def start(self, node_id: bytes):
+        self.prefix = node_id.hex() + "-"
+        self.seq = 0
+
+    def send(self, payload: bytes):
+        self.seq += 1
+        name = f"{self.prefix}{self.seq:012d}.delta"
+        tmp_path = os.path.join(self.directory, "." + name)
+
+        with open(tmp_path, "wb") as f:
+            f.write(payload)
+
+        os.replace(tmp_path, os.path.join(self.directory, name))
+
+    def receive(self) -> List[bytes]:
+        time.sleep(self.poll_interval)
+        payloads = []
+        present = set()
+        expired = time.time() - self.retention
+
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith(".delta") or entry.name.startswith("."):
+                    continue
+
+                present.add(entry.name)
+
+                if entry.name.startswith(self.prefix):
+                    try:
+                        if entry.stat().st_mtime < expired:
+                            os.unlink(entry.path)
+                    except FileNotFoundError:
+                        pass
+                    continue
+
+                if entry.name in self.seen:
+                    continue
+
+                self.seen.add(entry.name)
+
+                try:
+                    with open(entry.path, "rb") as f:
+                        payloads.append(f.read())
+                except FileNotFoundError:
+                    pass
+
+        # forget the files which were already removed by their writers
+        self.seen &= present
+        return payloads
+
+
+class CounterSync:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+                 store: CounterStore,
+                 transport,
+                 key: bytes,
+                 interval: float = 0.2,
+                 max_batches: int = 10,
+                 max_pending: int = 100000,
+                 anti_entropy_interval: Optional[float] = None,
+                 retry_base: float = 0.5,
+                 retry_max: float = 30.0):
+        """
+        Ship local counter updates to other nodes and merge theirs
+        :param store: local counter store
+        :param transport: UDPTransport or DirectoryTransport
+        :param key: secret key shared by the nodes, authenticates the batches
+        :param interval: how often (in seconds) the queued deltas are shipped
+        :param max_batches: maximum number of batches shipped per interval
+        :param max_pending: maximum number of distinct UIDs queued for shipping
+        :param anti_entropy_interval: how often to re-ship the complete state (None = never)
+        :param retry_base: delay (in seconds) before the first retry of a failed transport start,
+                           doubled after every further failure up to retry_max
+        """
+        self.store = store
+        self.transport = transport
+        self.key = key
+        self.interval = interval
+        self.max_batches = max_batches
+        self.max_pending = max_pending
+        self.anti_entropy_interval = anti_entropy_interval
+
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+
+        self.lock = threading.Lock()
+        self.pending: Dict[bytes, int] = {}
+        self.node_id = b""
+        self.pid: Optional[int] = None
+        # set once the transport of the current process is started
+        self.started = threading.Event()
+
+        self.sent_batches = 0
+        self.received_batches = 0
+        self.merged = 0
+        self.dropped = 0
+        self.rejected_batches = 0
+        self.start_failures = 0
+
+    def ensure_started(self):
+        """
+        Start the background threads in the current process (threads don't survive fork).
+        Doesn't block, the transport is started by the background thread.
+        """
+        if self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            self.node_id = random.getrandbits(128).to_bytes(16, 'big')
+            self.started = threading.Event()
+            # the loops run while the pid matches
+            self.pid = os.getpid()
+
+            try:
+                threading.Thread(target=self._ship_loop, name="counter-sync-ship", daemon=True).start()
+            except RuntimeError:
+                # retried on the next call
+                self.pid = None
+                logger.exception("Can't start the counter sync thread")
+
+    def stop(self):
+        """
+        Stop the background threads of the current process.
+        """
+        self.pid = None
+
+    def enqueue(self, uid: bytes, read_ctr: int):
+        """
+        Queue local counter update for shipping. Never blocks on I/O.
+        """
+        self.ensure_started()
+
+        with self.lock:
+            if uid in self.pending:
+                self.pending[uid] = max(self.pending[uid], read_ctr)
+            elif len(self.pending) < self.max_pending:
+                self.pending[uid] = read_ctr
+            else:
+                self.dropped += 1
+
+    def flush(self):
+        """
+        Ship up to max_batches batches of the queued deltas.
+        """
+        with self.lock:
+            if len(self.pending) <= self.max_batches * MAX_BATCH:
+                deltas = list(self.pending.items())
+                self.pending = {}
+            else:
+                deltas = []
+
+                for uid in list(self.pending)[:self.max_batches * MAX_BATCH]:
+                    deltas.append((uid, self.pending.pop(uid)))
+
+        for offset in range(0, len(deltas), MAX_BATCH):
+            self.transport.send(encode_batch(self.key, self.node_id, deltas[offset:offset + MAX_BATCH]))
+            self.sent_batches += 1
+
+    def receive(self):
+        for payload in self.transport.receive():
+            batch = decode_batch(self.key, payload)
+
+            if batch is None:
+                self.rejected_batches += 1
+                continue
+
+            if batch[0] == self.node_id:
+                continue
+
+            self.received_batches += 1
+
+            for uid, read_ctr in batch[1]:
+                if self.store.merge(uid, read_ctr, log=True):
+                    self.merged += 1
+
+    def _start_transport(self, pid: int) -> bool:
+        """
+        Start the transport and the receiving thread, retry with backoff until it succeeds.
+        :return: whether it was started (False if stopped meanwhile)
+        """
+        failures = 0
+
+        while self.pid == pid:
+            try:
+                self.transport.start(self.node_id)
+                threading.Thread(target=self._receive_loop, name="counter-sync-receive", daemon=True).start()
+            except (OSError, RuntimeError):
+                failures += 1
+                self.start_failures += 1
+                delay = min(self.retry_max, self.retry_base * 2 ** (failures - 1))
+                logger.exception("Can't start the counter sync transport, retrying in %.1f s", delay)
+                time.sleep(delay)
+                continue
+
+            self.started.set()
+            return True
+
+        return False
+
+    def _ship_loop(self):
+        pid = os.getpid()
+
+        if not self._start_transport(pid):
+            return
+
+        last_full = time.monotonic()
+
+        while self.pid == pid:
+            time.sleep(self.interval)
+
+            if self.anti_entropy_interval is not None and time.monotonic() - last_full >= self.anti_entropy_interval:
+                last_full = time.monotonic()
+
+                for uid, read_ctr in self.store.items():
+                    self.enqueue(uid, read_ctr)
+
+            self.flush()
+
+    def _receive_loop(self):
+        pid = os.getpid()
+
+        while self.pid == pid:
+            self.receive()
+
+    def stats(self) -> dict:
+        with self.lock:
+            pending = len(self.pending)
+
+        return {
+            "pending": pending,
+            "sent_batches": self.sent_batches,
+            "received_batches": self.received_batches,
+            "merged": self.merged,
+            "dropped": self.dropped,
+            "rejected_batches": self.rejected_batches,
+            "start_failures": self.start_failures
+        }
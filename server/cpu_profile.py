@@ -0,0 +1,203 @@
+"""
+Sampled CPU profiling with cProfile.
+
+One in N requests to the profiled endpoints is run under cProfile and its statistics are merged
+into the statistics of the endpoint. Periodically (by a background thread, so the sampled request
+doesn't wait for it) and at exit, every endpoint's statistics are written into the profile directory as:
+* <endpoint>.<pid>.pstats - for pstats / snakeviz
+* <endpoint>.<pid>.collapsed - collapsed stacks ("frame;frame;frame microseconds") for flamegraph.pl,
+  speedscope, inferno and similar tools
+
+cProfile records only caller/callee pairs, not the complete stacks, so the collapsed stacks are
+reconstructed from the call graph by splitting the time of each function between its callers
+in proportion to the time spent under each of them.
+"""
+
+import atexit
+import cProfile
+import os
+import pstats
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Optional
+
+
+def _label(func) -> str:
+    filename, lineno, name = func
+
+    if filename == "~":
+        # built-in function
+        return name
+
+    return f"{name} ({os.path.basename(filename)}:{lineno})"
+
+
+def collapsed_stacks(stats: pstats.Stats, max_depth: int = 64, min_time: float = 1e-6) -> Dict[str, float]:
+    """
+    Reconstruct the stacks from the call graph
+    :param max_depth: maximum depth of the stacks
+    :param min_time: ignore the paths where less than this time (in seconds) was spent
+    :return: "frame;frame;frame" -> self time (in seconds)
+    """
+    entries = stats.stats  # pylint: disable=no-member
+    callees = defaultdict(list)
+
+    for func, (_, _, _, _, callers) in entries.items():
+        for caller, edge in callers.items():
+            # edge = (primitive calls, calls, total time, cumulative time)
+            callees[caller].append((func, edge[3]))
+
+    result: Dict[str, float] = defaultdict(float)
+
+    def walk(func, stack, share):
+        _, _, tt, ct, _ = entries[func]
+        stack = stack + (func,)
+        key = ";".join(_label(item) for item in stack)
+
+        if tt * share > 0:
+            result[key] += tt * share
+
+        if len(stack) >= max_depth:
+            return
+
+        for callee, edge_ct in callees.get(func, []):
+            callee_ct = entries[callee][3]
+
+            if callee in stack or callee_ct <= 0 or edge_ct * share < min_time:
+                continue
+
+            walk(callee, stack, min(1.0, edge_ct * share / callee_ct))
+
+    for func, (_, _, _, _, callers) in entries.items():
+        if not callers:
+            walk(func, (), 1.0)
+
+    return result
+
+
+class SampledProfiler:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+                 every: int,
+                 paths: Iterable[str],
+                 directory: str,
+                 interval: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param every: profile one in this many requests
+        :param paths: paths of the profiled endpoints
+        :param directory: where to write the profiles
+        :param interval: how often (in seconds) the profiles are written
+        """
+        self.every = every
+        self.paths = frozenset(paths)
+        self.directory = directory
+        self.interval = interval
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.busy = threading.Lock()
+        # serializes the writes of the files (the statistics are copied under self.lock)
+        self.write_lock = threading.Lock()
+        self.writer: Optional[threading.Thread] = None
+        self.requests = 0
+        self.stats: Dict[str, pstats.Stats] = {}
+        self.sampled: Dict[str, int] = defaultdict(int)
+        self.last_write = clock()
+        os.makedirs(directory, exist_ok=True)
+        atexit.register(self.write)
+
+    def should_sample(self, path: str) -> bool:
+        if path not in self.paths:
+            return False
+
+        with self.lock:
+            self.requests += 1
+            return self.requests % self.every == 0
+
+    def profile(self, path: str, func: Callable[[], object]):
+        """
+        Run func() under cProfile (unless another request is being profiled) and merge its statistics.
+        :return: return value of func()
+        """
+        if not self.busy.acquire(blocking=False):
+            return func()
+
+        profiler = cProfile.Profile()
+
+        try:
+            result = profiler.runcall(func)
+        finally:
+            self.busy.release()
+
+        with self.lock:
+            if path in self.stats:
+                self.stats[path].add(profiler)
+            else:
+                self.stats[path] = pstats.Stats(profiler)
+
+            self.sampled[path] += 1
+            due = self.clock() - self.last_write >= self.interval and \
+                (self.writer is None or not self.writer.is_alive())
+
+            if due:
+                self.last_write = self.clock()
+                self.writer = threading.Thread(target=self.write, name="cpu-profile-writer", daemon=True)
+
+        if due:
+            self.writer.start()
+
+        return result
+
+    def write(self, directory: Optional[str] = None):
+        """
+        Write pstats and collapsed stacks of every endpoint.
+        """
+        directory = directory or self.directory
+
+        with self.lock:
+            copies = {}
+
+            for path, stats in self.stats.items():
+                copies[path] = pstats.Stats()
+                copies[path].add(stats)
+
+        with self.write_lock:
+            for path, stats in copies.items():
+                base = os.path.join(directory, f"{path.strip('/').replace('/', '_') or 'root'}.{os.getpid()}")
+                stats.dump_stats(base + ".pstats")
+                lines = [f"{stack} {round(seconds * 1e6)}\n" for stack, seconds in collapsed_stacks(stats).items()
+                         if round(seconds * 1e6) > 0]
+                tmp_path = base + ".collapsed.tmp"
+
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    f.writelines(sorted(lines))
+
+                os.replace(tmp_path, base + ".collapsed")
+
+
+class CPUProfileMiddleware:
+    def __init__(self, app, profiler: SampledProfiler):
+        """
+        WSGI middleware profiling the sampled requests.
+        """
+        self.app = app
+        self.profiler = profiler
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+
+        if not self.profiler.should_sample(path):
+            return self.app(environ, start_response)
+
+        def handle():
+            response = self.app(environ, start_response)
+
+            try:
+                return list(response)
+            finally:
+                if hasattr(response, 'close'):
+                    response.close()
+
+        return self.profiler.profile(path, handle)
@@ -0,0 +1,313 @@
+"""
+Append-only binary log of the scans (verified SUN messages).
+
+Every worker process buffers fixed-size records in memory and appends them to its own segment files
+in batches (events.<pid>.<seq>.bin), starting a new segment after the configured number of records.
+The request path only packs a record into the buffer, the file is written once per batch.
+The buffer is also flushed at exit; the records buffered by a worker which is killed are lost.
+
+Segment layout: 16 byte header (magic, record size) followed by the records:
+    timestamp (int64, microseconds since epoch), SDMReadCtr (uint32, 0xFFFFFFFF = unknown),
+    UID (7 bytes, zero-padded), UID length, encryption mode, route, TagTamper status, outcome (uint8 each)
+
+The reader maps the segments into memory and unpacks the records in bulk, a partially written
+record at the end of a segment (crash during write) is ignored.
+
+Export (from the repository root):
+    python -m server.event_log /var/lib/sdm/events --format csv --since 2024-01-01 --outcome ok > scans.csv
+"""
+
+import argparse
+import atexit
+import csv
+import datetime
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from typing import Callable, Iterable, Iterator, List, NamedTuple, Optional, Sequence
+
+MAGIC = b"SDMEVT01"
+RECORD = struct.Struct("<qI7sBBBBB")
+HEADER = struct.Struct("<8sI4x")
+NO_READ_CTR = 0xFFFFFFFF
+
+ENCRYPTION_MODES = ("AES", "LRP")
+ROUTES = ("tag", "tagtt", "tagpt")
+TT_STATUSES = ("", "secure", "tampered_closed", "tampered_open", "not_initialized", "not_supported", "unknown")
+OUTCOMES = ("ok", "invalid", "replayed", "bad_request")
+
+
+def _code(values: Sequence[str], value: Optional[str]) -> int:
+    try:
+        return values.index(value)
+    except ValueError:
+        return 255
+
+
+def _name(values: Sequence[str], code: int) -> str:
+    return values[code] if code < len(values) else ""
+
+
+class Event(NamedTuple):
+    timestamp: int
+    read_ctr: Optional[int]
+    uid: bytes
+    encryption_mode: str
+    route: str
+    tt_status: str
+    outcome: str
+
+    @classmethod
+    def unpack(cls, fields: tuple) -> "Event":
+        timestamp, read_ctr, uid, uid_len, encryption_mode, route, tt_status, outcome = fields
+        return cls(timestamp,
+                   read_ctr if read_ctr != NO_READ_CTR else None,
+                   uid[:uid_len],
+                   _name(ENCRYPTION_MODES, encryption_mode),
+                   _name(ROUTES, route),
+                   _name(TT_STATUSES, tt_status),
+                   _name(OUTCOMES, outcome))
+
+    def to_dict(self) -> dict:
+        timestamp = datetime.datetime.fromtimestamp(self.timestamp / 1e6, datetime.timezone.utc)
+        return {
+            "timestamp": timestamp.isoformat(timespec='microseconds'),
+            "uid": self.uid.hex().upper(),
+            "read_ctr": self.read_ctr,
+            "encryption_mode": self.encryption_mode,
+            "route": self.route,
+            "tt_status": self.tt_status,
+            "outcome": self.outcome
+        }
+
+
+class EventLog:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+                 directory: str,
+                 segment_records: int = 1000000,
+                 batch_records: int = 1000,
+                 flush_interval: float = 1.0,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        :param directory: where to write the segments
+        :param segment_records: number of records per segment
+        :param batch_records: flush the buffer once it has this many records
+        :param flush_interval: flush the buffer on the next record after this many seconds
+        """
+        self.directory = directory
+        self.segment_records = segment_records
+        self.batch_records = batch_records
+        self.flush_interval = flush_interval
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.buffer = bytearray()
+        self.buffered = 0
+        self.last_flush = clock()
+        self.pid: Optional[int] = None
+        self.seq = 0
+        self.file = None
+        self.segment_count = 0
+        os.makedirs(directory, exist_ok=True)
+        atexit.register(self.flush)
+
+    def record(self,
+               route: str,
+               outcome: str,
+               uid: Optional[bytes] = None,
+               read_ctr: Optional[int] = None,
+               encryption_mode: Optional[str] = None,
+               tt_status: str = "",
+               timestamp: Optional[int] = None):
+        """
+        Append a scan to the buffer (flushed in batches)
+        :param timestamp: microseconds since epoch (default: now)
+        """
+        uid = uid or b""
+        data = RECORD.pack(timestamp if timestamp is not None else time.time_ns() // 1000,
+                           read_ctr if read_ctr is not None else NO_READ_CTR,
+                           uid[:7],
+                           min(len(uid), 7),
+                           _code(ENCRYPTION_MODES, encryption_mode),
+                           _code(ROUTES, route),
+                           _code(TT_STATUSES, tt_status),
+                           _code(OUTCOMES, outcome))
+
+        with self.lock:
+            if self.pid != os.getpid():
+                # forked, the buffer and the segment of the parent belong to the parent
+                self.pid = os.getpid()
+                self.buffer = bytearray()
+                self.buffered = 0
+                self.file = None
+
+            self.buffer += data
+            self.buffered += 1
+
+            if self.buffered >= self.batch_records or self.clock() - self.last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                self._flush()
+
+    def _flush(self):
+        self.last_flush = self.clock()
+        offset = 0
+
+        with memoryview(self.buffer) as view:
+            while self.buffered:
+                if self.file is None or self.segment_count >= self.segment_records:
+                    self._next_segment()
+
+                count = min(self.buffered, self.segment_records - self.segment_count)
+                self.file.write(view[offset:offset + count * RECORD.size])
+                self.file.flush()
+                offset += count * RECORD.size
+                self.buffered -= count
+                self.segment_count += count
+
+        self.buffer = bytearray()
+
+    def _next_segment(self):
+        if self.file is not None:
+            self.file.close()
+
+        while True:
+            self.seq += 1
+            path = os.path.join(self.directory, f"events.{self.pid}.{self.seq:06d}.bin")
+
+            if not os.path.exists(path):
+                break
+
+        self.file = open(path, "ab")  # pylint: disable=consider-using-with
+        self.file.write(HEADER.pack(MAGIC, RECORD.size))
+        self.segment_count = 0
+
+
+class EventLogReader:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def segments(self) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.directory, "events.*.bin")))
+
+    @staticmethod
+    def read_segment(path: str) -> Iterator[tuple]:
+        """
+        :return: raw record tuples of the segment (see RECORD)
+        """
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+
+            if size < HEADER.size + RECORD.size:
+                return
+
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                magic, record_size = HEADER.unpack_from(mapped)
+
+                if magic != MAGIC or record_size != RECORD.size:
+                    raise RuntimeError(f"Not an event log segment: {path}")
+
+                end = HEADER.size + (size - HEADER.size) // RECORD.size * RECORD.size
+                view = memoryview(mapped)[HEADER.size:end]
+                records = RECORD.iter_unpack(view)
+
+                try:
+                    yield from records
+                finally:
+                    # the mapping can't be closed while the buffer is still exported
+                    del records
+                    view.release()
+
+    # pylint: disable=too-many-arguments
+    def scan(self,
+             since: Optional[int] = None,
+             until: Optional[int] = None,
+             uid: Optional[bytes] = None,
+             outcomes: Optional[Iterable[str]] = None,
+             routes: Optional[Iterable[str]] = None) -> Iterator[Event]:
+        """
+        Records of all segments matching the filters
+        :param since: minimal timestamp (microseconds since epoch, inclusive)
+        :param until: maximal timestamp (microseconds since epoch, exclusive)
+        """
+        since = since if since is not None else -2 ** 63
+        until = until if until is not None else 2 ** 63
+        padded_uid = uid[:7].ljust(7, b"\x00") if uid is not None else None
+        outcome_codes = {_code(OUTCOMES, outcome) for outcome in outcomes} if outcomes else None
+        route_codes = {_code(ROUTES, route) for route in routes} if routes else None
+
+        for path in self.segments():
+            for fields in self.read_segment(path):
+                if not since <= fields[0] < until:
+                    continue
+
+                if padded_uid is not None and fields[2] != padded_uid:
+                    continue
+
+                if outcome_codes is not None and fields[7] not in outcome_codes:
+                    continue
+
+                if route_codes is not None and fields[5] not in route_codes:
+                    continue
+
+                yield Event.unpack(fields)
+
+    def count(self) -> int:
+        return sum(max(0, os.path.getsize(path) - HEADER.size) // RECORD.size for path in self.segments())
+
+
+def export(events: Iterable[Event], out, fmt: str = "ndjson"):
+    if fmt == "csv":
+        writer = csv.DictWriter(out, fieldnames=list(Event._fields))
+        writer.writeheader()
+
+        for event in events:
+            writer.writerow(event.to_dict())
+    else:
+        for event in events:
+            out.write(json.dumps(event.to_dict()) + "\n")
+
+
+def _timestamp(value: str) -> int:
+    parsed = datetime.datetime.fromisoformat(value)
+
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+
+    return int(parsed.timestamp() * 1e6)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Export the scan event log')
+    parser.add_argument('directory', type=str)
+    parser.add_argument('--format', choices=('ndjson', 'csv'), default='ndjson')
+    parser.add_argument('--since', type=_timestamp, help='ISO 8601 date/time (UTC unless specified)')
+    parser.add_argument('--until', type=_timestamp, help='ISO 8601 date/time (UTC unless specified)')
+    parser.add_argument('--uid', type=bytes.fromhex, help='UID (hex)')
+    parser.add_argument('--outcome', action='append', choices=OUTCOMES)
+    parser.add_argument('--route', action='append', choices=ROUTES)
+    parser.add_argument('--count', action='store_true', help='only print the number of matching records')
+    args = parser.parse_args(argv)
+
+    events = EventLogReader(args.directory).scan(since=args.since, until=args.until, uid=args.uid,
+                                                 outcomes=args.outcome, routes=args.route)
+
+    if args.count:
+        print(sum(1 for _ in events))
+    else:
+        export(events, sys.stdout, args.format)
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,482 @@
+"""
+Asynchronous delivery of the verified scans to a local sink (e.g. a relay to the downstream systems).
+
+The request path only appends the event (one JSON line) to a bounded in-memory queue, a background thread
+of every worker process ships the queued events in batches (newline-delimited JSON) to the sink:
+* unix:/path/to/socket - Unix stream socket
+* pipe:/path/to/fifo - named pipe (opened non-blocking, so a missing reader is a delivery error)
+* http://host:port/path - HTTP POST (Content-Type: application/x-ndjson), any 2xx status is success
+
+Failed batches are retried with exponential backoff and full jitter. Under backpressure (the queue is full
+or a batch couldn't be delivered after all the retries), the events are either dropped or, with the "spill"
+overflow policy, appended to spill files which are replayed once the sink accepts the batches again.
+While the sink is failing and no new events arrive, the replay itself probes the sink, with the same backoff.
+The events are delivered at least once (a batch may be repeated after a timeout), not necessarily in order.
+
+Counters and delivery lag (time between the scan and the delivery of its event) are accumulated
+in per-process memory-mapped files (event_sink.<pid>.db), like the stage metrics.
+"""
+
+import atexit
+import collections
+import glob
+import http.client
+import json
+import os
+import random
+import socket
+import threading
+import time
+from typing import Callable, Deque, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from server.metrics import ProcessValues
+
+OVERFLOW_POLICIES = ("drop", "spill")
+
+# counters, summed over the processes
+COUNTERS = ("enqueued", "delivered", "dropped", "spilled", "retries", "failed_batches", "lag_sum", "lag_count")
+# gauges: queue depth (summed), lag of the last delivered batch (maximum)
+SLOTS = COUNTERS + ("queue_depth", "last_lag")
+
+# (scan timestamp, JSON line)
+Item = Tuple[float, bytes]
+
+
+class UnixSocketTransport:
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+        self.sock: Optional[socket.socket] = None
+
+    def send(self, payload: bytes):
+        if self.sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+
+            try:
+                sock.connect(self.path)
+            except OSError:
+                sock.close()
+                raise
+
+            self.sock = sock
+
+        self.sock.sendall(payload)
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class PipeTransport:
+    def __init__(self, path: str):
+        self.path = path
+        self.fd: Optional[int] = None
+
+    def send(self, payload: bytes):
+        if self.fd is None:
+            # fails with ENXIO if nobody reads the pipe
+            self.fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+            # blocking writes from the delivery thread, a slow reader fills up the queue
+            os.set_blocking(self.fd, True)
+
+        view = memoryview(payload)
+
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class HTTPTransport:
+    def __init__(self, url: str, timeout: float = 5.0):
+        parts = urlsplit(url)
+        self.https = parts.scheme == "https"
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port
+        self.path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+        self.timeout = timeout
+        self.conn: Optional[http.client.HTTPConnection] = None
+
+    def send(self, payload: bytes):
+        if self.conn is None:
+            conn_class = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+            self.conn = conn_class(self.host, self.port, timeout=self.timeout)
+
+        self.conn.request("POST", self.path, body=payload, headers={"Content-Type": "application/x-ndjson"})
+        response = self.conn.getresponse()
+        response.read()
+
+        if not 200 <= response.status < 300:
+            raise OSError(f"Event sink responded with HTTP {response.status}.")
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+def open_transport(target: str, timeout: float = 5.0):
+    """
+    :param target: unix:/path, pipe:/path or http(s)://host:port/path
+    """
+    if target.startswith("unix:"):
+        return UnixSocketTransport(target[5:], timeout=timeout)
+
+    if target.startswith("pipe:"):
+        return PipeTransport(target[5:])
+
+    if target.startswith(("http://", "https://")):
+        return HTTPTransport(target, timeout=timeout)
+
+    raise RuntimeError(f"Unsupported event sink: {target}")
+
+
+class SinkStats(ProcessValues):
+    def __init__(self, directory: Optional[str] = None):
+        """
+        :param directory: directory shared by all worker processes
+                          (None = new temporary directory, shared by the processes forked later on)
+        """
+        super().__init__("event_sink", SLOTS, directory)
+
+    def collect(self, maxima: Iterable[str] = ("last_lag",)) -> dict:
+        """
+        :return: values of all processes (counters and queue depth summed, maximal last lag)
+        """
+        return super().collect(maxima)
+
+    def render(self) -> str:
+        """
+        :return: metrics in Prometheus text exposition format
+        """
+        values = self.collect()
+        lines = ["# HELP sdm_event_sink_events_total Scan events passed to the event sink.",
+                 "# TYPE sdm_event_sink_events_total counter"]
+
+        for state in ("enqueued", "delivered", "dropped", "spilled"):
+            lines.append(f'sdm_event_sink_events_total{{state="{state}"}} {int(values[state])}')
+
+        lines += ["# HELP sdm_event_sink_retries_total Retried batch deliveries.",
+                  "# TYPE sdm_event_sink_retries_total counter",
+                  f"sdm_event_sink_retries_total {int(values['retries'])}",
+                  "# HELP sdm_event_sink_failed_batches_total Batches not delivered after all the retries.",
+                  "# TYPE sdm_event_sink_failed_batches_total counter",
+                  f"sdm_event_sink_failed_batches_total {int(values['failed_batches'])}",
+                  "# HELP sdm_event_sink_delivery_lag_seconds Time between the scan and the delivery of its event.",
+                  "# TYPE sdm_event_sink_delivery_lag_seconds summary",
+                  f"sdm_event_sink_delivery_lag_seconds_sum {values['lag_sum']!r}",
+                  f"sdm_event_sink_delivery_lag_seconds_count {int(values['lag_count'])}",
+                  "# HELP sdm_event_sink_last_lag_seconds Maximal delivery lag of the last delivered batch.",
+                  "# TYPE sdm_event_sink_last_lag_seconds gauge",
+                  f"sdm_event_sink_last_lag_seconds {values['last_lag']!r}",
+                  "# HELP sdm_event_sink_queue_depth Events waiting for delivery in memory.",
+                  "# TYPE sdm_event_sink_queue_depth gauge",
+                  f"sdm_event_sink_queue_depth {int(values['queue_depth'])}"]
+
+        return "\n".join(lines) + "\n"
+
+
+class EventSink:
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self,
+                 transport,
+                 max_queue: int = 10000,
+                 batch_size: int = 100,
+                 flush_interval: float = 0.5,
+                 overflow: str = "drop",
+                 spill_dir: Optional[str] = None,
+                 max_retries: int = 5,
+                 retry_base: float = 0.1,
+                 retry_max: float = 5.0,
+                 stats: Optional[SinkStats] = None,
+                 rand: Callable[[], float] = random.random,
+                 sleep: Callable[[float], None] = time.sleep):
+        """
+        :param transport: UnixSocketTransport, PipeTransport or HTTPTransport (see open_transport())
+        :param max_queue: maximum number of events queued in memory (per process)
+        :param batch_size: maximum number of events per delivery
+        :param flush_interval: how long (in seconds) to wait for a full batch
+        :param overflow: "drop" or "spill" (to spill_dir) the events which can't be queued or delivered
+        :param max_retries: retries of a failed delivery, the delay before the n-th retry is uniformly
+                            distributed between 0 and min(retry_max, retry_base * 2^n) seconds
+        """
+        if overflow not in OVERFLOW_POLICIES:
+            raise RuntimeError(f"Invalid overflow policy: {overflow}")
+
+        if overflow == "spill" and not spill_dir:
+            raise RuntimeError("Spill directory is required for the spill overflow policy.")
+
+        self.transport = transport
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.spill_dir = spill_dir
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.stats = stats or SinkStats()
+        self.rand = rand
+        self.sleep = sleep
+
+        self.cond = threading.Condition()
+        self.send_lock = threading.Lock()
+        self.queue: Deque[Item] = collections.deque()
+        self.pid: Optional[int] = None
+        self.spill_file = None
+        self.spill_seq = 0
+        self.healthy = True
+        # failed replays since the sink became unhealthy, the next one is attempted at probe_at (monotonic)
+        self.probes = 0
+        self.probe_at = 0.0
+        self.replay: Optional[Iterator[bytes]] = None
+
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        atexit.register(self.flush)
+
+    def ensure_started(self):
+        """
+        Start the delivery thread in the current process (threads don't survive fork).
+        """
+        if self.pid == os.getpid():
+            return
+
+        with self.cond:
+            if self.pid == os.getpid():
+                return
+
+            # forked, the queue and the spill file of the parent belong to the parent
+            self.pid = os.getpid()
+            self.queue = collections.deque()
+            self.spill_file = None
+            self.replay = None
+            threading.Thread(target=self._deliver_loop, name="event-sink", daemon=True).start()
+
+    def enqueue(self, event: dict):
+        """
+        Queue the event for delivery. Never blocks on I/O (except of spilling to a local file when the queue is full).
+        :param event: JSON-serializable dict, its "timestamp" (seconds since epoch) is added if missing
+        """
+        self.ensure_started()
+        timestamp = event.setdefault("timestamp", time.time())
+        line = json.dumps(event, separators=(",", ":")).encode("utf-8") + b"\n"
+
+        with self.cond:
+            queued = len(self.queue) < self.max_queue
+
+            if queued:
+                self.queue.append((timestamp, line))
+                self.stats.set("queue_depth", len(self.queue))
+
+                if len(self.queue) >= self.batch_size:
+                    self.cond.notify()
+
+        if queued:
+            self.stats.add("enqueued")
+        else:
+            self._overflow([line])
+
+    def flush(self):
+        """
+        Deliver all queued events of the current process (e.g. at exit), without retries.
+        """
+        if self.pid != os.getpid():
+            return
+
+        with self.cond:
+            items = list(self.queue)
+            self.queue.clear()
+            self.stats.set("queue_depth", 0)
+
+        for offset in range(0, len(items), self.batch_size):
+            if not self._deliver(items[offset:offset + self.batch_size], retries=0):
+                self._overflow([line for _, line in items[offset + self.batch_size:]])
+                break
+
+        with self.cond:
+            self._close_spill_file()
+
+    def _overflow(self, lines: List[bytes]):
+        if not lines:
+            return
+
+        if self.overflow == "spill":
+            with self.cond:
+                if self.spill_file is None:
+                    self.spill_seq += 1
+                    path = os.path.join(self.spill_dir, f"spill.{os.getpid()}.{self.spill_seq:06d}.part")
+                    self.spill_file = open(path, "ab")  # pylint: disable=consider-using-with
+
+                self.spill_file.writelines(lines)
+
+            self.stats.add("spilled", len(lines))
+        else:
+            self.stats.add("dropped", len(lines))
+
+    def _close_spill_file(self):
+        # the spill file becomes available for the replay
+        if self.spill_file is not None:
+            self.spill_file.close()
+            os.replace(self.spill_file.name, self.spill_file.name[:-len(".part")] + ".ndjson")
+            self.spill_file = None
+
+    def _take(self) -> List[Item]:
+        with self.cond:
+            if len(self.queue) < self.batch_size and self.replay is None:
+                self.cond.wait(self.flush_interval)
+
+            batch = [self.queue.popleft() for _ in range(min(self.batch_size, len(self.queue)))]
+            self.stats.set("queue_depth", len(self.queue))
+
+        return batch
+
+    def _deliver(self, items: List[Item], retries: Optional[int] = None) -> bool:
+        """
+        :return: whether the batch was delivered (otherwise it was dropped or spilled)
+        """
+        payload = b"".join(line for _, line in items)
+        retries = self.max_retries if retries is None else retries
+
+        for attempt in range(retries + 1):
+            try:
+                with self.send_lock:
+                    self.transport.send(payload)
+            except (OSError, http.client.HTTPException):
+                with self.send_lock:
+                    self.transport.close()
+
+                if attempt < retries:
+                    self.stats.add("retries")
+                    self.sleep(self.rand() * min(self.retry_max, self.retry_base * 2 ** attempt))
+
+                continue
+
+            now = time.time()
+            lags = [max(0.0, now - timestamp) for timestamp, _ in items]
+            self.stats.add("delivered", len(items))
+            self.stats.add("lag_sum", sum(lags))
+            self.stats.add("lag_count", len(lags))
+            self.stats.set("last_lag", max(lags))
+            self.healthy = True
+            return True
+
+        self.healthy = False
+        self.stats.add("failed_batches")
+        self._overflow([line for _, line in items])
+        return False
+
+    def _spill_files(self) -> Iterator[str]:
+        with self.cond:
+            self._close_spill_file()
+
+        # left behind by processes which exited while writing or replaying them
+        for pattern, field in (("spill.*.part", 1), ("spill.*.replay", -2)):
+            for path in sorted(glob.glob(os.path.join(self.spill_dir, pattern))):
+                pid = int(os.path.basename(path).split(".")[field])
+
+                if pid != os.getpid() and not _pid_alive(pid):
+                    yield path
+
+        yield from sorted(glob.glob(os.path.join(self.spill_dir, "spill.*.ndjson")))
+
+    def _claim_spill_file(self) -> Optional[Iterator[bytes]]:
+        for path in self._spill_files():
+            claimed = f"{path}.{os.getpid()}.replay"
+
+            try:
+                # another process may be claiming the same file
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                continue
+
+            return _read_spill_file(claimed)
+
+        return None
+
+    def _replay_batch(self):
+        if self.replay is None:
+            self.replay = self._claim_spill_file()
+
+            if self.replay is None:
+                return
+
+        items = []
+
+        for line in self.replay:
+            try:
+                timestamp = float(json.loads(line)["timestamp"])
+            except (ValueError, KeyError, TypeError):
+                continue
+
+            items.append((timestamp, line))
+
+            if len(items) >= self.batch_size:
+                break
+
+        if not items:
+            self.replay = None
+            return
+
+        if not self._deliver(items):
+            # spilled again, together with the rest of the file
+            self._overflow(list(self.replay))
+            self.replay = None
+
+    def _probe_replay(self):
+        """
+        Replay a batch of the spilled events. While the sink is unhealthy, this is also the probe whether
+        it accepts the batches again, so that the spill files don't wait for the next live event.
+        """
+        self._replay_batch()
+
+        if self.healthy:
+            self.probes = 0
+        else:
+            self.probes += 1
+            self.probe_at = time.monotonic() + self.rand() * min(self.retry_max, self.retry_base * 2 ** self.probes)
+
+    def _deliver_loop(self):
+        pid = os.getpid()
+
+        while self.pid == pid:
+            batch = self._take()
+
+            try:
+                if batch:
+                    self._deliver(batch)
+                elif self.spill_dir and (self.healthy or time.monotonic() >= self.probe_at):
+                    self._probe_replay()
+            except Exception:  # pylint: disable=broad-exception-caught
+                # the thread isn't restarted, so keep delivering the later events
+                self.stats.add("failed_batches")
+                self.stats.add("dropped", len(batch))
+                self.sleep(self.retry_base)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+
+    return True
+
+
+def _read_spill_file(path: str) -> Iterator[bytes]:
+    try:
+        with open(path, "rb") as f:
+            for line in f:
+                if line.endswith(b"\n"):
+                    yield line
+    finally:
+        os.unlink(path)
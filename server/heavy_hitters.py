@@ -0,0 +1,209 @@
+"""
+Bounded-memory scan statistics: the most scanned tags and the tags which are suddenly hot
+(e.g. a SUN URL of a cloned tag shared online), without storing every scan.
+
+The number of scans per UID is estimated with two count-min sketches, one with all the scans and one
+with the recent scans (halved every half-life), and the UIDs with the highest estimates are kept
+in a top-k heap of each. The last read counter and the last scan time are tracked in a fixed-size
+direct-mapped table (a colliding UID replaces the previous one), so the memory usage depends only
+on the configuration, not on the number of tags.
+
+The statistics are kept in the memory of each worker process, so a report covers only the scans
+handled by that worker (the estimated counts are about 1/N of the totals with N workers).
+"""
+
+import datetime
+import hashlib
+import heapq
+import threading
+import time
+from array import array
+from typing import Callable, Dict, List, Optional, Tuple
+
+MAX_UID_LENGTH = 10
+_SLOT = MAX_UID_LENGTH + 1
+
+
+class CountMinSketch:
+    def __init__(self, width: int = 4096, depth: int = 4):
+        """
+        :param width: counters per row (error of the estimate is about 2 * total / width)
+        :param depth: number of rows (probability of a larger error is about 2^-depth)
+        """
+        if depth > 8:
+            raise RuntimeError("Count-min sketch depth must not exceed 8.")
+
+        self.width = width
+        self.depth = depth
+        self.counts = array('d', bytes(8 * width * depth))
+
+    def indexes(self, key: bytes) -> List[int]:
+        digest = hashlib.blake2b(key, digest_size=4 * self.depth).digest()
+        return [row * self.width + int.from_bytes(digest[4 * row:4 * row + 4], 'little') % self.width
+                for row in range(self.depth)]
+
+    def add(self, indexes: List[int], count: float = 1.0) -> float:
+        """
+        Conservative update (only the minimal counters are incremented)
+        :return: new estimate
+        """
+        counts = self.counts
+        estimate = min(counts[i] for i in indexes) + count
+
+        for i in indexes:
+            if counts[i] < estimate:
+                counts[i] = estimate
+
+        return estimate
+
+    def estimate(self, indexes: List[int]) -> float:
+        return min(self.counts[i] for i in indexes)
+
+    def scale(self, factor: float):
+        counts = self.counts
+
+        for i in range(len(counts)):
+            counts[i] *= factor
+
+
+class TopK:
+    def __init__(self, k: int):
+        self.k = k
+        self.counts: Dict[bytes, float] = {}
+        # (count, uid), entries are stale if the count doesn't match self.counts
+        self.heap: List[Tuple[float, bytes]] = []
+
+    def _min(self) -> Tuple[float, bytes]:
+        heap = self.heap
+
+        while heap[0][0] != self.counts.get(heap[0][1]):
+            heapq.heappop(heap)
+
+        return heap[0]
+
+    def offer(self, uid: bytes, count: float):
+        if uid not in self.counts:
+            if len(self.counts) >= self.k:
+                if count <= self._min()[0]:
+                    return
+
+                del self.counts[heapq.heappop(self.heap)[1]]
+
+        self.counts[uid] = count
+        heapq.heappush(self.heap, (count, uid))
+
+        if len(self.heap) > 4 * self.k:
+            self._rebuild()
+
+    def scale(self, factor: float):
+        self.counts = {uid: count * factor for uid, count in self.counts.items()}
+        self._rebuild()
+
+    def _rebuild(self):
+        self.heap = [(count, uid) for uid, count in self.counts.items()]
+        heapq.heapify(self.heap)
+
+    def items(self) -> List[Tuple[bytes, float]]:
+        return sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+
+
+class HeavyHitters:
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self,
+                 k: int = 100,
+                 width: int = 4096,
+                 depth: int = 4,
+                 half_life: float = 300.0,
+                 slots: int = 65536,
+                 clock: Callable[[], float] = time.time):
+        """
+        :param k: number of tracked heavy hitters (of all the scans and of the recent scans)
+        :param width: width of the count-min sketches
+        :param depth: depth of the count-min sketches
+        :param half_life: the recent scan counts are halved every this many seconds
+        :param slots: size of the last read counter/last seen table
+        """
+        self.half_life = half_life
+        self.slots = slots
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.total = CountMinSketch(width, depth)
+        self.recent = CountMinSketch(width, depth)
+        self.top_total = TopK(k)
+        self.top_recent = TopK(k)
+        self.last_decay = clock()
+        self.scans = 0
+
+        self.uids = bytearray(slots * _SLOT)
+        self.read_ctrs = array('q', bytes(8 * slots))
+        self.last_seen = array('d', bytes(8 * slots))
+
+    def _decay(self, now: float):
+        halvings = int((now - self.last_decay) // self.half_life)
+
+        if halvings > 0:
+            factor = 0.5 ** min(halvings, 64)
+            self.recent.scale(factor)
+            self.top_recent.scale(factor)
+            self.last_decay += halvings * self.half_life
+
+    def _slot(self, indexes: List[int]) -> int:
+        # reuse the first hash of the sketches
+        return indexes[0] % self.slots
+
+    def observe(self, uid: bytes, read_ctr: Optional[int] = None):
+        """
+        Record a verified scan
+        """
+        uid = uid[:MAX_UID_LENGTH]
+        now = self.clock()
+        indexes = self.total.indexes(uid)
+        slot = self._slot(indexes)
+
+        with self.lock:
+            self._decay(now)
+            self.scans += 1
+            self.top_total.offer(uid, self.total.add(indexes))
+            self.top_recent.offer(uid, self.recent.add(indexes))
+
+            self.uids[slot * _SLOT:(slot + 1) * _SLOT] = bytes([len(uid)]) + uid.ljust(MAX_UID_LENGTH, b"\x00")
+            self.read_ctrs[slot] = read_ctr if read_ctr is not None else -1
+            self.last_seen[slot] = now
+
+    def _last(self, uid: bytes, indexes: List[int]) -> Tuple[Optional[int], Optional[float]]:
+        slot = self._slot(indexes)
+        stored = self.uids[slot * _SLOT:(slot + 1) * _SLOT]
+
+        if stored[1:1 + stored[0]] != uid or stored[0] != len(uid):
+            return None, None
+
+        read_ctr = self.read_ctrs[slot]
+        return read_ctr if read_ctr >= 0 else None, self.last_seen[slot]
+
+    def _entry(self, uid: bytes) -> dict:
+        indexes = self.total.indexes(uid)
+        read_ctr, last_seen = self._last(uid, indexes)
+
+        return {
+            "uid": uid.hex().upper(),
+            "scans": int(round(self.total.estimate(indexes))),
+            "recent_scans": round(self.recent.estimate(indexes), 2),
+            "last_read_ctr": read_ctr,
+            "last_seen": datetime.datetime.fromtimestamp(last_seen, datetime.timezone.utc).isoformat()
+            if last_seen is not None else None
+        }
+
+    def report(self, top: int = 25) -> dict:
+        """
+        :return: heavy hitters of all the scans ("top") and of the recent scans ("hot"), with the estimated counts
+        """
+        with self.lock:
+            self._decay(self.clock())
+
+            return {
+                "scans": self.scans,
+                "half_life": self.half_life,
+                "top": [self._entry(uid) for uid, _ in self.top_total.items()[:top]],
+                "hot": [self._entry(uid) for uid, _ in self.top_recent.items()[:top]]
+            }
@@ -0,0 +1,109 @@
+"""
+Per-request recording of the verification stages (see libsdm/stages.py).
+
+The recorder is installed only for the SUN endpoints and only if some consumer (metrics, Server-Timing header, ...)
+is enabled, otherwise the requests pass through untouched.
+"""
+
+from typing import Callable, Iterable, List, Tuple
+
+from libsdm.stages import StageRecorder, activate, deactivate
+
+# observer(recorder, path) -> additional response headers
+Observer = Callable[[StageRecorder, str], List[Tuple[str, str]]]
+
+
+class Instrumentation:
+    def __init__(self, paths: Iterable[str]):
+        """
+        :param paths: paths of the instrumented endpoints
+        """
+        self.paths = frozenset(paths)
+        self.observers: List[Observer] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.observers)
+
+    def add_observer(self, observer: Observer):
+        self.observers.append(observer)
+
+    def start(self, path: str):
+        """
+        :return: tuple (recorder, token) or None if the request is not instrumented
+        """
+        if not self.observers or path not in self.paths:
+            return None
+
+        recorder = StageRecorder()
+        recorder.labels["route"] = path
+        return recorder, activate(recorder)
+
+    def finish(self, started, path: str) -> List[Tuple[str, str]]:
+        """
+        :return: additional response headers
+        """
+        if started is None:
+            return []
+
+        recorder, token = started
+        deactivate(token)
+        recorder.finish()
+        headers = []
+
+        for observer in self.observers:
+            headers.extend(observer(recorder, path))
+
+        return headers
+
+
+def server_timing(recorder: StageRecorder, path: str) -> List[Tuple[str, str]]:  # pylint: disable=unused-argument
+    """
+    Observer producing the Server-Timing header (durations in milliseconds), e.g.
+    Server-Timing: parse;dur=0.015, picc_decrypt;dur=0.021, derive;dur=4.870, mac;dur=0.052, total;dur=5.201
+    """
+    metrics = [f"{name};dur={duration * 1000:.3f}" for name, duration in recorder.durations().items()]
+    metrics.append(f"total;dur={recorder.finish() * 1000:.3f}")
+    return [("Server-Timing", ", ".join(metrics))]
+
+
+class InstrumentMiddleware:
+    def __init__(self, app, instrumentation: Instrumentation):
+        """
+        WSGI middleware recording the stages of the requests to the instrumented endpoints.
+        The observers are invoked once the response headers are ready (the body is already rendered).
+        A server error (5xx response or exception) is recorded with the "error" outcome.
+        """
+        self.app = app
+        self.instrumentation = instrumentation
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        started = self.instrumentation.start(path)
+
+        if started is None:
+            return self.app(environ, start_response)
+
+        finished = []
+
+        def instrumented_start_response(status, headers, exc_info=None):
+            if not finished:
+                finished.append(True)
+                recorder = started[0]
+                recorder.labels.setdefault("status", status.split(" ", 1)[0])
+
+                if status.startswith("5"):
+                    recorder.labels["outcome"] = "error"
+
+                headers = list(headers) + self.instrumentation.finish(started, path)
+
+            return start_response(status, headers, exc_info)
+
+        try:
+            return self.app(environ, instrumented_start_response)
+        finally:
+            if not finished:
+                # the application failed before start_response()
+                finished.append(True)
+                started[0].labels["outcome"] = "error"
+                self.instrumentation.finish(started, path)
@@ -0,0 +1,180 @@
+"""
+Derived key cache shared by all worker processes on the host.
+
+The per-process cache of the key rings helps only when the same worker sees the tag again, so with N workers
+most of the repeated scans still derive the key (PBKDF2 in the legacy mode). This cache keeps the derived
+SDMFileReadKeys in a memory-mapped file (keycache.<name>.db) which all the workers consult before deriving,
+so a key derived by one worker is reused by all the others.
+
+The file is a fixed-capacity open-addressing hash table divided into stripes of STRIPE_SLOTS slots:
+the hash of the key selects a stripe and a home slot within it, and the key is stored in the first free
+slot probing from there (wrapping within the stripe). Entries are never removed, only replaced:
+when the probed slots are all occupied, a clock sweep over them picks the victim - the reference bit
+of an entry is set on every hit and cleared when the sweep passes it, so recently used keys survive.
+
+Writers of a stripe are serialized by a byte-range lock of the file (between the processes) and a per-process lock
+(between the threads). Readers take no locks: every slot has a sequence number which is odd while the slot
+is being written (seqlock), a reader retries when the number changed under it.
+
+Slot layout: fingerprint of the key (uint64, 0 = empty), sequence (uint32), reference bit (uint8),
+padding, derived key (16 bytes). The file holds secret keys, so it's created in a private directory,
+in memory (/dev/shm) when available.
+"""
+
+import atexit
+import fcntl
+import hashlib
+import mmap
+import os
+import shutil
+import struct
+import tempfile
+import threading
+from typing import Optional
+
+SLOT = struct.Struct("<QIB3x16s")
+SEQUENCE = struct.Struct("<I")
+SEQUENCE_OFFSET = 8
+REFERENCE_OFFSET = 12
+STRIPE_SLOTS = 64
+PROBES = 8
+READ_RETRIES = 16
+
+
+def _remove_directory(directory: str, pid: int):
+    if os.getpid() == pid:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class SharedKeyCache:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self, name: str, slots: int = 65536, directory: Optional[str] = None):
+        """
+        :param name: name of the cache (file name within the directory)
+        :param slots: capacity (rounded up to whole stripes)
+        :param directory: directory shared by all worker processes
+                          (None = new private temporary directory, shared by the processes forked later on
+                          and removed when this process exits)
+        """
+        self.stripes = max(1, -(-slots // STRIPE_SLOTS))
+        self.slots = self.stripes * STRIPE_SLOTS
+        self.size = self.slots * SLOT.size
+
+        if directory is None:
+            directory = tempfile.mkdtemp(prefix="sdm-key-cache-", dir="/dev/shm" if os.path.isdir("/dev/shm") else None)
+            # only by the process which created it, the forked workers run the exit handlers as well
+            atexit.register(_remove_directory, directory, os.getpid())
+
+        self.directory = directory
+        self.path = os.path.join(directory, f"keycache.{name}.db")
+
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            if os.fstat(fd).st_size != self.size:
+                # different layout (or new file), start empty
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+        finally:
+            os.close(fd)
+
+        self.lock = threading.Lock()
+        self.pid: Optional[int] = None
+        self.fd: Optional[int] = None
+        self.mapped = None
+
+    def _map(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # forked, open own descriptor (the byte-range locks belong to the process)
+                    self.fd = os.open(self.path, os.O_RDWR)
+                    self.mapped = mmap.mmap(self.fd, self.size)
+                    self.pid = os.getpid()
+
+        return self.mapped
+
+    def _locate(self, key: bytes):
+        fingerprint = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') | 1
+        stripe = (fingerprint >> 1) % self.stripes
+        home = (fingerprint >> 33) % STRIPE_SLOTS
+        return fingerprint, stripe, home
+
+    def get(self, key: bytes) -> Optional[bytes]:
+        """
+        :return: cached value of the key or None
+        """
+        fingerprint, stripe, home = self._locate(key)
+        mapped = self._map()
+        base = stripe * STRIPE_SLOTS
+
+        for probe in range(PROBES):
+            position = (base + (home + probe) % STRIPE_SLOTS) * SLOT.size
+
+            for _ in range(READ_RETRIES):
+                sequence = SEQUENCE.unpack_from(mapped, position + SEQUENCE_OFFSET)[0]
+                entry_fingerprint, _, referenced, value = SLOT.unpack_from(mapped, position)
+
+                if entry_fingerprint != fingerprint:
+                    break
+
+                if sequence & 1 == 0 and SEQUENCE.unpack_from(mapped, position + SEQUENCE_OFFSET)[0] == sequence:
+                    if not referenced:
+                        mapped[position + REFERENCE_OFFSET] = 1
+
+                    return value
+            else:
+                # the slot keeps changing, don't wait for it
+                return None
+
+            if entry_fingerprint == 0:
+                # entries are never removed, so the key can't be further
+                return None
+
+        return None
+
+    def put(self, key: bytes, value: bytes):
+        """
+        Store the value (16 bytes) of the key, replacing a not recently used entry if needed
+        """
+        fingerprint, stripe, home = self._locate(key)
+        mapped = self._map()
+        base = stripe * STRIPE_SLOTS
+        positions = [(base + (home + probe) % STRIPE_SLOTS) * SLOT.size for probe in range(PROBES)]
+
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, stripe)
+
+            try:
+                target = None
+
+                for position in positions:
+                    entry_fingerprint = SLOT.unpack_from(mapped, position)[0]
+
+                    if entry_fingerprint in (0, fingerprint):
+                        target = position
+                        break
+
+                if target is None:
+                    target = self._evict(mapped, positions)
+
+                sequence = SEQUENCE.unpack_from(mapped, target + SEQUENCE_OFFSET)[0] | 1
+                SEQUENCE.pack_into(mapped, target + SEQUENCE_OFFSET, sequence)
+                SLOT.pack_into(mapped, target, fingerprint, sequence, 0, value)
+                SEQUENCE.pack_into(mapped, target + SEQUENCE_OFFSET, (sequence + 1) & 0xFFFFFFFF)
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, stripe)
+
+    @staticmethod
+    def _evict(mapped, positions) -> int:
+        """
+        Clock sweep over the probed slots: clear the reference bits until an unreferenced entry is found
+        """
+        for position in positions + positions[:1]:
+            if not mapped[position + REFERENCE_OFFSET]:
+                return position
+
+            mapped[position + REFERENCE_OFFSET] = 0
+
+        return positions[0]
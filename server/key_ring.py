@@ -0,0 +1,263 @@
+"""
+Master key rotation.
+
+A tenant may have several active master keys: the current one (used for newly personalized tags)
+followed by the previous ones (tags which were not re-personalized yet). Verification tries the keys
+in the order of recent success within the bucket of the UID, so the tags of an old batch cost a single
+attempt once their bucket has seen it. For encrypted SUN messages the UID is not known before decryption,
+so a separate global bucket is used and the decrypted PICCDataTag is checked for plausibility:
+a wrong key is discarded without deriving the key of the UID, after the same fake MAC calculation
+(with the cached key of a dummy UID) as any other malformed message, so the timing doesn't tell which key failed.
+
+Derived SDMFileReadKeys are kept in a bounded per-process cache, optionally backed by a cache shared by all
+worker processes on the host (see server.key_cache). After a tag was verified with one of
+the previous keys, a background thread of the worker derives its key for the current master key, so that
+re-personalization of the tags doesn't cause a burst of key derivations (PBKDF2 in case of the legacy
+derivation mode) on the request path. The thread is started on first use in each process, never before the fork:
+the keys of the recently active tags are preloaded synchronously by server.warmup instead.
+"""
+
+import hashlib
+import os
+import queue
+import threading
+from collections import OrderedDict
+from typing import Callable, Iterable, List, Optional, Sequence
+
+from libsdm.sdm import ImplausiblePICCData, InvalidMessage, decrypt_sun_message, validate_plain_sun
+from libsdm.stages import stage
+from server.key_cache import SharedKeyCache
+
+
+class KeyRing:
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self,
+                 master_keys: Sequence[bytes],
+                 derive_tag_key: Callable[[bytes, bytes, int], bytes],
+                 derive_undiversified_key: Callable[[bytes, int], bytes],
+                 buckets: int = 256,
+                 cache_size: int = 100000,
+                 max_queued: int = 10000,
+                 shared_cache: Optional[SharedKeyCache] = None,
+                 namespace: bytes = b""):
+        """
+        :param master_keys: active master keys, the current one first
+        :param derive_tag_key: derive_tag_key(master_key, uid, key_no)
+        :param derive_undiversified_key: derive_undiversified_key(master_key, key_no)
+        :param buckets: number of UID buckets with independent key order
+        :param cache_size: maximum number of cached SDMFileReadKeys
+        :param max_queued: maximum number of queued background derivations (further ones are dropped)
+        :param shared_cache: cache of the SDMFileReadKeys shared by the worker processes, consulted before deriving
+        :param namespace: distinguishes the key derivation methods within the shared cache
+        """
+        if not master_keys:
+            raise RuntimeError("At least one master key is required.")
+
+        self.master_keys = list(master_keys)
+        self.derive_tag_key = derive_tag_key
+        # doesn't depend on the message, so derive only once
+        self.meta_read_keys = [derive_undiversified_key(master_key, 1) for master_key in self.master_keys]
+        self.buckets = buckets
+        self.cache_size = cache_size
+        self.shared_cache = shared_cache
+        # prefixes of the shared cache keys, not the master keys themselves
+        self.shared_prefixes = [hashlib.sha256(namespace + b"\x00" + master_key).digest()[:16]
+                                for master_key in self.master_keys]
+
+        self.lock = threading.Lock()
+        # bucket -> key indexes, the most recently successful first; the last bucket is for unknown UIDs
+        self.orders: List[List[int]] = [list(range(len(self.master_keys))) for _ in range(buckets + 1)]
+        # (key index, uid) -> SDMFileReadKey
+        self.file_keys: OrderedDict = OrderedDict()
+        self.jobs: queue.Queue = queue.Queue(maxsize=max_queued)
+        self.pid: Optional[int] = None
+
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.attempts = 0
+        self.verified = 0
+        self.dropped = 0
+
+    def order(self, uid: Optional[bytes] = None) -> List[int]:
+        bucket = hash(uid) % self.buckets if uid is not None else self.buckets
+
+        with self.lock:
+            return list(self.orders[bucket])
+
+    def file_key(self, index: int, uid: bytes) -> bytes:
+        """
+        SDMFileReadKey of the given tag for the master key with given index (cached)
+        """
+        entry = (index, uid)
+
+        with self.lock:
+            key = self.file_keys.get(entry)
+
+            if key is not None:
+                self.file_keys.move_to_end(entry)
+                self.hits += 1
+                return key
+
+            self.misses += 1
+
+        if self.shared_cache is None:
+            key = self.derive_tag_key(self.master_keys[index], uid, 2)
+        else:
+            # derived by another worker?
+            shared_key = self.shared_prefixes[index] + uid + b"\x02"
+            key = self.shared_cache.get(shared_key)
+
+            if key is None:
+                key = self.derive_tag_key(self.master_keys[index], uid, 2)
+                self.shared_cache.put(shared_key, key)
+            else:
+                with self.lock:
+                    self.shared_hits += 1
+
+        with self.lock:
+            self.file_keys[entry] = key
+
+            while len(self.file_keys) > self.cache_size:
+                self.file_keys.popitem(last=False)
+
+        return key
+
+    def preferred_file_key(self, uid: bytes) -> bytes:
+        """
+        SDMFileReadKey for the master key which was most recently successful in the bucket of the UID
+        """
+        return self.file_key(self.order(uid)[0], uid)
+
+    def success(self, uid: bytes, index: int):
+        with self.lock:
+            self.verified += 1
+
+            for bucket in (hash(uid) % self.buckets, self.buckets):
+                order = self.orders[bucket]
+
+                if order[0] != index:
+                    order.remove(index)
+                    order.insert(0, index)
+
+        if index != 0:
+            # the tag is likely to be re-personalized with the current key
+            self.warm([uid], indexes=[0])
+
+    def warm(self, uids: Iterable[bytes], indexes: Optional[Iterable[int]] = None):
+        """
+        Derive the SDMFileReadKeys of the given tags in the background. Never blocks.
+        :param indexes: master key indexes to derive the keys for (default: all active keys)
+        """
+        indexes = list(indexes) if indexes is not None else list(range(len(self.master_keys)))
+        self._ensure_started()
+
+        for uid in uids:
+            for index in indexes:
+                with self.lock:
+                    if (index, uid) in self.file_keys:
+                        continue
+
+                try:
+                    self.jobs.put_nowait((index, uid))
+                except queue.Full:
+                    self.dropped += 1
+                    return
+
+    def _ensure_started(self):
+        if self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            # threads don't survive fork
+            self.pid = os.getpid()
+            threading.Thread(target=self._worker, name="key-ring-warm", daemon=True).start()
+
+    def _worker(self):
+        pid = os.getpid()
+
+        while self.pid == pid:
+            index, uid = self.jobs.get()
+
+            try:
+                self.file_key(index, uid)
+            except Exception:  # pylint: disable=broad-exception-caught
+                # speculative work only, the request path derives the key itself
+                pass
+
+    def decrypt_sun_message(self, **kwargs) -> dict:
+        """
+        decrypt_sun_message() trying all active master keys
+        :param kwargs: arguments of decrypt_sun_message(), except of the keys
+        """
+        if len(self.master_keys) == 1:
+            self.attempts += 1
+            res = decrypt_sun_message(sdm_meta_read_key=self.meta_read_keys[0],
+                                      sdm_file_read_key=lambda uid: self.file_key(0, uid),
+                                      **kwargs)
+            self.success(res['uid'], 0)
+            return res
+
+        error = None
+
+        for index in self.order():
+            self.attempts += 1
+
+            try:
+                res = decrypt_sun_message(sdm_meta_read_key=self.meta_read_keys[index],
+                                          sdm_file_read_key=lambda uid, index=index: self.file_key(index, uid),
+                                          check_picc_data_tag=True,
+                                          **kwargs)
+            except ImplausiblePICCData as err:
+                error = error or err
+                continue
+            except InvalidMessage as err:
+                # PICCData looked fine, so this is the most relevant error (e.g. invalid MAC, replay)
+                error = err if error is None or isinstance(error, ImplausiblePICCData) else error
+                continue
+
+            self.success(res['uid'], index)
+            return res
+
+        raise error
+
+    def validate_plain_sun(self, uid: bytes, read_ctr: bytes, sdmmac: bytes) -> dict:
+        """
+        validate_plain_sun() trying all active master keys
+        :return: dict as returned by validate_plain_sun(), with key_index - index of the master key which verified it
+        """
+        error = None
+
+        for index in self.order(uid):
+            self.attempts += 1
+
+            with stage("derive"):
+                file_key = self.file_key(index, uid)
+
+            try:
+                res = validate_plain_sun(uid=uid, read_ctr=read_ctr, sdmmac=sdmmac, sdm_file_read_key=file_key)
+            except InvalidMessage as err:
+                error = error or err
+                continue
+
+            self.success(uid, index)
+            res['key_index'] = index
+            return res
+
+        raise error
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "keys": len(self.master_keys),
+                "cached_keys": len(self.file_keys),
+                "cache_hits": self.hits,
+                "shared_cache_hits": self.shared_hits,
+                "cache_misses": self.misses,
+                "attempts": self.attempts,
+                "verified": self.verified,
+                "dropped": self.dropped
+            }
@@ -0,0 +1,157 @@
+"""
+Speculative SDMMAC precomputation for plaintext SUN messages.
+
+In plaintext SUN mode the expected SDMMAC depends only on the tag key, UID and read counter, and the next
+counter values of a recently seen tag are easy to predict. After a successful verification, a background
+thread derives the tag key once and fills a bounded table with the expected MACs for counters
+ctr+1..ctr+depth. A later request is then verified with a table lookup and a constant-time comparison.
+A SDMMAC which doesn't match the table is verified the usual way, it's never rejected by the table alone.
+"""
+
+import hmac
+import os
+import queue
+import threading
+from collections import OrderedDict
+from typing import Callable, Optional
+
+
+class MacPrecomputer:
+    # pylint: disable=too-many-instance-attributes
+    def __init__(self,
+                 derive_key: Callable[[bytes, int], bytes],
+                 calculate_mac: Callable[[bytes, bytes, bytes], bytes],
+                 depth: int = 8,
+                 max_entries: int = 100000,
+                 max_queued: int = 1000):
+        """
+        :param derive_key: derive_key(uid, key_index) -> SDMFileReadKey for the master key with the given index
+        :param calculate_mac: calculate_mac(uid, read_ctr, key) -> SDMMAC (read_ctr as 3 bytes, MSB first)
+        :param depth: number of future counter values to precompute
+        :param max_entries: maximum number of precomputed MACs
+        :param max_queued: maximum number of queued precomputation jobs (further jobs are dropped)
+        """
+        self.derive_key = derive_key
+        self.calculate_mac = calculate_mac
+        self.depth = depth
+        self.max_entries = max_entries
+
+        self.lock = threading.Lock()
+        # (uid, read_ctr) -> (expected SDMMAC, master key index)
+        self.table: OrderedDict = OrderedDict()
+        # uid -> (highest precomputed read_ctr, master key index)
+        self.horizon: OrderedDict = OrderedDict()
+        self.jobs: queue.Queue = queue.Queue(maxsize=max_queued)
+        self.pid: Optional[int] = None
+
+        self.hits = 0
+        self.misses = 0
+        self.mismatches = 0
+        self.dropped = 0
+        # counters shared with the /metrics endpoint (ProcessValues with "hits", "misses" and "mismatches" slots),
+        # set up by the application
+        self.counters = None
+
+    def verify(self, uid: bytes, read_ctr: bytes, sdmmac: bytes) -> Optional[int]:
+        """
+        Check the SDMMAC against the precomputed table
+        :return: index of the master key if it matches the precomputed SDMMAC, None otherwise (the caller verifies it
+                 the usual way, the precomputed entry may be stale or made with another key)
+        """
+        entry = (uid, read_ctr)
+
+        with self.lock:
+            expected = self.table.get(entry)
+
+            if expected is None:
+                result = "misses"
+                self.misses += 1
+            elif hmac.compare_digest(expected[0], sdmmac):
+                result = "hits"
+                self.hits += 1
+                del self.table[entry]
+            else:
+                result = "mismatches"
+                self.mismatches += 1
+
+        if self.counters is not None:
+            self.counters.add(result)
+
+        return expected[1] if result == "hits" else None
+
+    def schedule(self, uid: bytes, read_ctr: int, key_index: int = 0):
+        """
+        Request precomputation after successful verification of read_ctr. Never blocks.
+        :param key_index: index of the master key which verified the message
+        """
+        with self.lock:
+            horizon, horizon_key_index = self.horizon.get(uid, (-1, key_index))
+
+            # still enough counters ahead (with the same key), avoid deriving the key again
+            if horizon >= read_ctr + self.depth // 2 and horizon_key_index == key_index:
+                return
+
+        self._ensure_started()
+
+        try:
+            self.jobs.put_nowait((uid, read_ctr, key_index))
+        except queue.Full:
+            self.dropped += 1
+
+    def _ensure_started(self):
+        if self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            # threads don't survive fork
+            self.pid = os.getpid()
+            threading.Thread(target=self._worker, name="mac-precompute", daemon=True).start()
+
+    def precompute(self, uid: bytes, read_ctr: int, key_index: int = 0):
+        key = self.derive_key(uid, key_index)
+        macs = []
+
+        for ctr in range(read_ctr + 1, min(read_ctr + self.depth, 0xFFFFFF) + 1):
+            ctr_b = ctr.to_bytes(3, 'big')
+            macs.append(((uid, ctr_b), (self.calculate_mac(uid, ctr_b, key), key_index)))
+
+        with self.lock:
+            for entry, mac in macs:
+                self.table[entry] = mac
+                self.table.move_to_end(entry)
+
+            self.horizon[uid] = (read_ctr + self.depth, key_index)
+            self.horizon.move_to_end(uid)
+
+            while len(self.table) > self.max_entries:
+                self.table.popitem(last=False)
+
+            while len(self.horizon) > self.max_entries // max(self.depth, 1):
+                self.horizon.popitem(last=False)
+
+    def _worker(self):
+        pid = os.getpid()
+
+        while self.pid == pid:
+            uid, read_ctr, key_index = self.jobs.get()
+
+            try:
+                self.precompute(uid, read_ctr, key_index)
+            except Exception:  # pylint: disable=broad-exception-caught
+                # speculative work only, the request path falls back to the live computation
+                pass
+
+    def stats(self) -> dict:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self.table),
+                "hits": self.hits,
+                "misses": self.misses,
+                "mismatches": self.mismatches,
+                "hit_rate": self.hits / total if total else 0.0,
+                "dropped": self.dropped
+            }
@@ -0,0 +1,256 @@
+"""
+Latency histograms of the verification stages, exported in Prometheus text format.
+
+Every process (e.g. uWSGI worker) accumulates its observations in its own memory-mapped file
+(metrics.<pid>.db) inside a directory shared by all processes, so the hot path is a few in-place
+float additions without any locking between the processes. The /metrics endpoint sums the files
+of all processes, including the ones which already exited (their counts must not go backwards).
+
+The label space is fixed (stage x encryption mode x derive mode x outcome), so each file has a constant
+layout: for each series, the per-bucket counts followed by the total count and the sum of the durations.
+"""
+
+import atexit
+import glob
+import mmap
+import os
+import tempfile
+import threading
+from array import array
+from typing import Iterable, Optional, Sequence, Tuple
+
+from libsdm.stages import StageRecorder
+from server.key_cache import _remove_directory
+
+STAGES = ("request", "parse", "verify", "picc_decrypt", "derive", "mac", "file_decrypt", "render")
+ENCRYPTION_MODES = ("AES", "LRP", "unknown")
+DERIVE_MODES = ("legacy", "standard")
+OUTCOMES = ("ok", "invalid", "replayed", "bad_request", "error")
+# upper bounds of the histogram buckets (in seconds)
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+# bucket counts, count, sum
+SLOTS = len(BUCKETS) + 2
+SERIES = len(STAGES) * len(ENCRYPTION_MODES) * len(DERIVE_MODES) * len(OUTCOMES)
+FILE_SIZE = SERIES * SLOTS * 8
+
+
+def series_index(stage: int, encryption_mode: int, derive_mode: int, outcome: int) -> int:
+    return ((stage * len(ENCRYPTION_MODES) + encryption_mode) * len(DERIVE_MODES) + derive_mode) \
+        * len(OUTCOMES) + outcome
+
+
+def _label_index(values: Tuple[str, ...], value: Optional[str], default: int) -> int:
+    try:
+        return values.index(value)
+    except ValueError:
+        return default
+
+
+class MetricsStore:
+    def __init__(self, directory: Optional[str] = None):
+        """
+        :param directory: directory shared by all worker processes
+                          (None = new temporary directory, shared by the processes forked later on
+                          and removed when this process exits)
+        """
+        if not directory:
+            directory = tempfile.mkdtemp(prefix="sdm-metrics-")
+            # only by the process which created it, the forked workers run the exit handlers as well
+            atexit.register(_remove_directory, directory, os.getpid())
+
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.pid: Optional[int] = None
+        self.values = None
+
+    def _values(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # forked, the mapping of the parent must not be written to
+                    path = os.path.join(self.directory, f"metrics.{os.getpid()}.db")
+                    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+                    try:
+                        os.ftruncate(fd, FILE_SIZE)
+                        self.values = memoryview(mmap.mmap(fd, FILE_SIZE)).cast('d')
+                    finally:
+                        os.close(fd)
+
+                    self.pid = os.getpid()
+
+        return self.values
+
+    def observe(self, stage: str, duration: float, encryption_mode: Optional[str],
+                derive_mode: Optional[str], outcome: Optional[str]):
+        values = self._values()
+        offset = series_index(STAGES.index(stage),
+                              _label_index(ENCRYPTION_MODES, encryption_mode, 2),
+                              _label_index(DERIVE_MODES, derive_mode, 0),
+                              _label_index(OUTCOMES, outcome, 4)) * SLOTS
+        bucket = len(BUCKETS)
+
+        for i, bound in enumerate(BUCKETS):
+            if duration <= bound:
+                bucket = i
+                break
+
+        with self.lock:
+            if bucket < len(BUCKETS):
+                values[offset + bucket] += 1
+
+            values[offset + SLOTS - 2] += 1
+            values[offset + SLOTS - 1] += duration
+
+    def observe_request(self, recorder: StageRecorder):
+        """
+        Record the stages of a finished request.
+        """
+        total = recorder.finish()
+        labels = recorder.labels
+        encryption_mode = labels.get("encryption_mode")
+        derive_mode = labels.get("derive_mode")
+        outcome = labels.get("outcome")
+
+        self.observe("request", total, encryption_mode, derive_mode, outcome)
+
+        for item in recorder.stages:
+            if item.end is not None and item.name in STAGES:
+                self.observe(item.name, item.end - item.start, encryption_mode, derive_mode, outcome)
+
+    def collect(self) -> array:
+        """
+        :return: sum of the values of all processes
+        """
+        total = array('d', bytes(FILE_SIZE))
+
+        for path in glob.glob(os.path.join(self.directory, "metrics.*.db")):
+            with open(path, "rb") as f:
+                data = f.read()
+
+            if len(data) != FILE_SIZE:
+                continue
+
+            for i, value in enumerate(array('d', data)):
+                if value:
+                    total[i] += value
+
+        return total
+
+    def render(self) -> str:
+        """
+        :return: metrics in Prometheus text exposition format
+        """
+        values = self.collect()
+        lines = [
+            "# HELP sdm_stage_duration_seconds Duration of the SUN verification stages.",
+            "# TYPE sdm_stage_duration_seconds histogram",
+        ]
+
+        for stage, encryption_mode, derive_mode, outcome, offset in _iter_series():
+            count = values[offset + SLOTS - 2]
+
+            if not count:
+                continue
+
+            labels = f'stage="{stage}",encryption_mode="{encryption_mode}",' \
+                     f'derive_mode="{derive_mode}",outcome="{outcome}"'
+            cumulative = 0.0
+
+            for i, bound in enumerate(BUCKETS):
+                cumulative += values[offset + i]
+                lines.append(f'sdm_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {int(cumulative)}')
+
+            lines.append(f'sdm_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {int(count)}')
+            lines.append(f'sdm_stage_duration_seconds_count{{{labels}}} {int(count)}')
+            lines.append(f'sdm_stage_duration_seconds_sum{{{labels}}} {values[offset + SLOTS - 1]!r}')
+
+        lines.append("# HELP sdm_requests_total Number of SUN verification requests.")
+        lines.append("# TYPE sdm_requests_total counter")
+
+        for stage, encryption_mode, derive_mode, outcome, offset in _iter_series():
+            count = values[offset + SLOTS - 2]
+
+            if stage == "request" and count:
+                lines.append(f'sdm_requests_total{{encryption_mode="{encryption_mode}",'
+                             f'derive_mode="{derive_mode}",outcome="{outcome}"}} {int(count)}')
+
+        return "\n".join(lines) + "\n"
+
+
+def _iter_series() -> Iterable[Tuple[str, str, str, str, int]]:
+    for s, stage in enumerate(STAGES):
+        for e, encryption_mode in enumerate(ENCRYPTION_MODES):
+            for d, derive_mode in enumerate(DERIVE_MODES):
+                for o, outcome in enumerate(OUTCOMES):
+                    yield stage, encryption_mode, derive_mode, outcome, series_index(s, e, d, o) * SLOTS
+
+
+class ProcessValues:
+    def __init__(self, name: str, slots: Sequence[str], directory: Optional[str] = None):
+        """
+        Named counters and gauges, each process keeps them in its own memory-mapped file (<name>.<pid>.db)
+        :param directory: directory shared by all worker processes
+                          (None = new temporary directory, shared by the processes forked later on
+                          and removed when this process exits)
+        """
+        self.name = name
+        self.slots = tuple(slots)
+        if not directory:
+            directory = tempfile.mkdtemp(prefix=f"sdm-{name.replace('_', '-')}-")
+            # only by the process which created it, the forked workers run the exit handlers as well
+            atexit.register(_remove_directory, directory, os.getpid())
+
+        self.directory = directory
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.pid: Optional[int] = None
+        self.values = None
+
+    def _values(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    path = os.path.join(self.directory, f"{self.name}.{os.getpid()}.db")
+                    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+
+                    try:
+                        os.ftruncate(fd, len(self.slots) * 8)
+                        self.values = memoryview(mmap.mmap(fd, len(self.slots) * 8)).cast('d')
+                    finally:
+                        os.close(fd)
+
+                    self.pid = os.getpid()
+
+        return self.values
+
+    def add(self, name: str, value: float = 1.0):
+        values = self._values()
+
+        with self.lock:
+            values[self.slots.index(name)] += value
+
+    def set(self, name: str, value: float):
+        self._values()[self.slots.index(name)] = value
+
+    def collect(self, maxima: Iterable[str] = ()) -> dict:
+        """
+        :param maxima: values to take the maximum of (the other ones are summed)
+        :return: values of all processes, including the ones which already exited
+        """
+        maxima = frozenset(maxima)
+        total = dict.fromkeys(self.slots, 0.0)
+
+        for path in glob.glob(os.path.join(self.directory, f"{self.name}.*.db")):
+            with open(path, "rb") as f:
+                data = f.read()
+
+            if len(data) != len(self.slots) * 8:
+                continue
+
+            for name, value in zip(self.slots, memoryview(data).cast('d')):
+                total[name] = max(total[name], value) if name in maxima else total[name] + value
+
+        return total
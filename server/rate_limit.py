@@ -0,0 +1,171 @@
+"""
+Token-bucket rate limiting of the SUN endpoints, shared by all worker processes.
+
+Two kinds of limits keep abusive traffic away from the expensive key derivation (PBKDF2 in the legacy mode):
+* per client IP - checked by RateLimitMiddleware before the request reaches the application
+* per UID - checked right after PICC decryption (or parsing of the plaintext UID), before the key derivation
+  and MAC calculation
+
+The buckets live in a memory-mapped file (ratelimit.<name>.db) shared by all processes, organized as
+a set-associative table: the hash of the key selects a set of WAYS entries and a new key replaces
+the least recently updated entry of its set, so the state is bounded by the size of the table.
+A set is guarded by a byte-range lock of the file (between the processes) and a per-process lock
+(between the threads), so a check costs a hash, two system calls and a few memory accesses.
+
+Entry layout: key fingerprint (uint64, 0 = empty), tokens (double), last update (double, seconds since epoch).
+"""
+
+import atexit
+import fcntl
+import hashlib
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from typing import Callable, Iterable, Optional
+
+from werkzeug.exceptions import TooManyRequests
+
+from api_wsgi import json_error_response
+from server.key_cache import _remove_directory
+
+ENTRY = struct.Struct("<Qdd")
+WAYS = 4
+
+
+class TokenBuckets:
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self,
+                 name: str,
+                 rate: float,
+                 burst: float,
+                 slots: int = 65536,
+                 directory: Optional[str] = None,
+                 clock: Callable[[], float] = time.time):
+        """
+        :param name: name of the limiter (file name within the directory)
+        :param rate: tokens added per second
+        :param burst: capacity of a bucket
+        :param slots: maximum number of tracked keys
+        :param directory: directory shared by all worker processes
+                          (None = new temporary directory, shared by the processes forked later on
+                          and removed when this process exits)
+        """
+        if rate <= 0 or burst < 1:
+            raise RuntimeError("Rate must be positive and burst at least 1.")
+
+        self.rate = rate
+        self.burst = burst
+        self.sets = max(1, slots // WAYS)
+        self.clock = clock
+
+        if not directory:
+            directory = tempfile.mkdtemp(prefix="sdm-rate-limit-")
+            # only by the process which created it, the forked workers run the exit handlers as well
+            atexit.register(_remove_directory, directory, os.getpid())
+
+        self.directory = directory
+        self.path = os.path.join(self.directory, f"ratelimit.{name}.db")
+        self.size = self.sets * WAYS * ENTRY.size
+
+        os.makedirs(self.directory, exist_ok=True)
+
+        with open(self.path, "ab") as f:
+            if os.fstat(f.fileno()).st_size != self.size:
+                # different layout (or new file), start with full buckets
+                f.truncate(0)
+                f.truncate(self.size)
+
+        self.lock = threading.Lock()
+        self.pid: Optional[int] = None
+        self.fd: Optional[int] = None
+        self.mapped = None
+
+    def _map(self):
+        if self.pid != os.getpid():
+            with self.lock:
+                if self.pid != os.getpid():
+                    # forked, open own descriptor (the byte-range locks belong to the process)
+                    self.fd = os.open(self.path, os.O_RDWR)
+                    self.mapped = mmap.mmap(self.fd, self.size)
+                    self.pid = os.getpid()
+
+        return self.mapped
+
+    def acquire(self, key: bytes, cost: float = 1.0) -> float:
+        """
+        Take tokens from the bucket of the key
+        :return: 0 if allowed, otherwise how many seconds to wait until the tokens are available
+        """
+        fingerprint = int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little') | 1
+        set_index = (fingerprint >> 1) % self.sets
+        offset = set_index * WAYS * ENTRY.size
+        mapped = self._map()
+        now = self.clock()
+
+        with self.lock:
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, 1, set_index)
+
+            try:
+                victim = offset
+                victim_last = math.inf
+
+                for position in range(offset, offset + WAYS * ENTRY.size, ENTRY.size):
+                    entry_fingerprint, tokens, last = ENTRY.unpack_from(mapped, position)
+
+                    if entry_fingerprint == fingerprint:
+                        tokens = min(self.burst, tokens + max(0.0, now - last) * self.rate)
+                        break
+
+                    if last < victim_last:
+                        victim, victim_last = position, last
+                else:
+                    position = victim
+                    tokens = self.burst
+
+                if tokens >= cost:
+                    ENTRY.pack_into(mapped, position, fingerprint, tokens - cost, now)
+                    return 0.0
+
+                ENTRY.pack_into(mapped, position, fingerprint, tokens, now)
+                return (cost - tokens) / self.rate
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, 1, set_index)
+
+    def check(self, key: bytes):
+        """
+        :raises:
+            TooManyRequests: if the bucket of the key is empty
+        """
+        wait = self.acquire(key)
+
+        if wait:
+            raise TooManyRequests("Rate limit exceeded, try again later.", retry_after=math.ceil(wait))
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, buckets: TokenBuckets, paths: Iterable[str]):
+        """
+        WSGI middleware which answers 429 to the clients (by REMOTE_ADDR) exceeding the rate limit
+        on the given paths, JSON for the /api/ paths
+        """
+        self.app = app
+        self.buckets = buckets
+        self.paths = frozenset(paths)
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+
+        if path in self.paths:
+            try:
+                self.buckets.check(environ.get('REMOTE_ADDR', '').encode('ascii', 'replace'))
+            except TooManyRequests as err:
+                if path.startswith('/api/'):
+                    return json_error_response(err, environ, start_response)
+
+                return err(environ, start_response)
+
+        return self.app(environ, start_response)
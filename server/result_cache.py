@@ -0,0 +1,114 @@
+"""
+Short-TTL cache of verification results.
+
+Browsers reloading the page, link preview bots and messaging apps routinely fetch the exact same SUN URL
+several times in a row. The cache is keyed by the decoded (canonical) parameter bytes, so such repeated
+requests are served without key derivation, decryption and MAC calculation.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional, Tuple, Type
+
+
+class ResultCache:
+    def __init__(self,
+                 max_size: int,
+                 ttl: float,
+                 cache_rejections: bool = False,
+                 rejection: Type[Exception] = Exception,
+                 clock: Callable[[], float] = time.monotonic):
+        """
+        Bounded LRU cache with per-entry expiry
+        :param max_size: maximum number of cached results
+        :param ttl: how long (in seconds) the result is served from the cache
+        :param cache_rejections: whether to also cache rejections (exceptions of type `rejection`)
+        :param rejection: exception type which denotes rejected message
+        :param clock: monotonic clock (for testing)
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.cache_rejections = cache_rejections
+        self.rejection = rejection
+        self.clock = clock
+
+        self.lock = threading.Lock()
+        self.entries: OrderedDict = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        # counters shared with the /metrics endpoint (ProcessValues with "cached" and "computed" slots),
+        # set up by the application
+        self.counters = None
+
+    def _get(self, key: Hashable) -> Optional[tuple]:
+        now = self.clock()
+
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            if entry[0] <= now:
+                del self.entries[key]
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def _put(self, key: Hashable, is_rejection: bool, value: Any):
+        expires = self.clock() + self.ttl
+
+        with self.lock:
+            self.entries[key] = (expires, is_rejection, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def lookup(self, key: Hashable, compute: Callable[[], Any]) -> Any:
+        """
+        Return the cached result for `key` or call `compute()` and cache its result.
+        Cached rejections are re-raised.
+        """
+        return self.fetch(key, compute)[0]
+
+    def fetch(self, key: Hashable, compute: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Same as lookup, but also tells whether the result was served from the cache.
+        :return: tuple (result, whether it was cached)
+        """
+        entry = self._get(key)
+
+        if self.counters is not None:
+            self.counters.add("cached" if entry is not None else "computed")
+
+        if entry is not None:
+            if entry[1]:
+                raise entry[2].with_traceback(None)
+
+            return entry[2], True
+
+        try:
+            value = compute()
+        except self.rejection as err:
+            if self.cache_rejections:
+                self._put(key, True, err)
+
+            raise
+
+        self._put(key, False, value)
+        return value, False
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "cached": self.hits,
+                "computed": self.misses
+            }
@@ -0,0 +1,134 @@
+"""
+Parsing of the SUN message parameters.
+
+Shared by the application and the offline verification (verify_logs.py), so it must stay free of side effects:
+no configuration, no keys, no application state.
+"""
+
+import binascii
+import io
+
+from werkzeug.exceptions import BadRequest
+
+from libsdm.sdm import ParamMode
+
+
+def parse_parameters(args, tenant):
+    """
+    Extract SUN parameters from the query arguments.
+    :param args: mapping of query arguments (e.g. request.args)
+    :param tenant: tenant defining the parameter names
+    :return: tuple (param_mode, enc_picc_data_b, enc_file_data_b, sdmmac_b)
+    """
+    arg_e = args.get('e')
+    if arg_e:
+        param_mode = ParamMode.BULK
+
+        try:
+            e_b = binascii.unhexlify(arg_e)
+        except binascii.Error:
+            raise BadRequest("Failed to decode parameters.") from None
+
+        e_buf = io.BytesIO(e_b)
+
+        if (len(e_b) - 8) % 16 == 0:
+            # using AES (16 byte PICCEncData)
+            file_len = len(e_b) - 16 - 8
+            enc_picc_data_b = e_buf.read(16)
+
+            if file_len > 0:
+                enc_file_data_b = e_buf.read(file_len)
+            else:
+                enc_file_data_b = None
+
+            sdmmac_b = e_buf.read(8)
+        elif (len(e_b) - 8) % 16 == 8:
+            # using LRP (24 byte PICCEncData)
+            file_len = len(e_b) - 24 - 8
+            enc_picc_data_b = e_buf.read(24)
+
+            if file_len > 0:
+                enc_file_data_b = e_buf.read(file_len)
+            else:
+                enc_file_data_b = None
+
+            sdmmac_b = e_buf.read(8)
+        else:
+            raise BadRequest("Incorrect length of the dynamic parameter.")
+    else:
+        param_mode = ParamMode.SEPARATED
+        enc_picc_data = args.get(tenant.enc_picc_data_param)
+        enc_file_data = args.get(tenant.enc_file_data_param)
+        sdmmac = args.get(tenant.sdmmac_param)
+
+        if not enc_picc_data:
+            raise BadRequest(f"Parameter {tenant.enc_picc_data_param} is required")
+
+        if not sdmmac:
+            raise BadRequest(f"Parameter {tenant.sdmmac_param} is required")
+
+        try:
+            enc_file_data_b = None
+            enc_picc_data_b = binascii.unhexlify(enc_picc_data)
+            sdmmac_b = binascii.unhexlify(sdmmac)
+
+            if enc_file_data:
+                enc_file_data_b = binascii.unhexlify(enc_file_data)
+        except binascii.Error:
+            raise BadRequest("Failed to decode parameters.") from None
+
+    return param_mode, enc_picc_data_b, enc_file_data_b, sdmmac_b
+
+
+def parse_plain_parameters(args, tenant):
+    """
+    Extract plaintext SUN parameters from the query arguments.
+    :param args: mapping of query arguments (e.g. request.args)
+    :param tenant: tenant defining the parameter names
+    :return: tuple (uid_b, read_ctr_b, sdmmac_b)
+    """
+    try:
+        uid = binascii.unhexlify(args[tenant.uid_param])
+        read_ctr = binascii.unhexlify(args[tenant.ctr_param])
+        cmac = binascii.unhexlify(args[tenant.sdmmac_param])
+    except binascii.Error:
+        raise BadRequest("Failed to decode parameters.") from None
+
+    return uid, read_ctr, cmac
+
+
+def tag_tamper_status(file_data):
+    """
+    Interpret TagTamper status mirrored at the beginning of the file data.
+    :param file_data: decrypted SDMFileData
+    :return: tuple (status for the API, human-readable status, color)
+    """
+    tt_perm_status = file_data[0:1].decode('ascii', 'replace')
+    tt_cur_status = file_data[1:2].decode('ascii', 'replace')
+
+    if tt_perm_status == 'C' and tt_cur_status == 'C':
+        tt_status_api = 'secure'
+        tt_status = 'OK (not tampered)'
+        tt_color = 'green'
+    elif tt_perm_status == 'O' and tt_cur_status == 'C':
+        tt_status_api = 'tampered_closed'
+        tt_status = 'Tampered! (loop closed)'
+        tt_color = 'red'
+    elif tt_perm_status == 'O' and tt_cur_status == 'O':
+        tt_status_api = 'tampered_open'
+        tt_status = 'Tampered! (loop open)'
+        tt_color = 'red'
+    elif tt_perm_status == 'I' and tt_cur_status == 'I':
+        tt_status_api = 'not_initialized'
+        tt_status = 'Not initialized'
+        tt_color = 'orange'
+    elif tt_perm_status == 'N' and tt_cur_status == 'T':
+        tt_status_api = 'not_supported'
+        tt_status = 'Not supported by the tag'
+        tt_color = 'orange'
+    else:
+        tt_status_api = 'unknown'
+        tt_status = 'Unknown'
+        tt_color = 'orange'
+
+    return tt_status_api, tt_status, tt_color
@@ -0,0 +1,214 @@
+"""
+Multi-tenant key registry.
+
+Each tenant has its own master key, key derivation mode, URL parameter names and LRP requirement,
+and is selected by the request host or by the first segment of the URL path (e.g. /acme/tag?...).
+Tenants and their verifier contexts (undiversified keys, caches) are built once at startup,
+so dispatching a request is a dictionary lookup.
+
+Example tenants file (JSON), missing fields default to the values from config.py:
+{
+    "acme": {
+        "master_key": "00112233445566778899AABBCCDDEEFF",
+        "previous_master_keys": ["FFEEDDCCBBAA99887766554433221100"],
+        "derive_mode": "standard",
+        "path_prefix": "/acme",
+        "hosts": ["sdm.acme.example"],
+        "sdmmac_param": "mac",
+        "require_lrp": true
+    }
+}
+"""
+
+import binascii
+import json
+from typing import Dict, Optional, Sequence, Tuple
+
+from libsdm import derive, legacy_derive
+from server.key_cache import SharedKeyCache
+from server.key_ring import KeyRing
+
+DERIVE_MODES = {
+    "legacy": legacy_derive,
+    "standard": derive,
+}
+
+ENVIRON_KEY = "sdm.tenant"
+
+
+class Tenant:
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self,
+                 name: str,
+                 master_key: bytes,
+                 derive_mode: str,
+                 enc_picc_data_param: str,
+                 enc_file_data_param: str,
+                 uid_param: str,
+                 ctr_param: str,
+                 sdmmac_param: str,
+                 require_lrp: bool,
+                 previous_master_keys: Sequence[bytes] = (),
+                 key_cache_size: int = 100000,
+                 shared_key_cache: Optional[SharedKeyCache] = None):
+        if derive_mode not in DERIVE_MODES:
+            raise RuntimeError("Invalid DERIVE_MODE.")
+
+        self.name = name
+        self.master_key = master_key
+        self.previous_master_keys = list(previous_master_keys)
+        self.derive_mode = derive_mode
+        self.enc_picc_data_param = enc_picc_data_param
+        self.enc_file_data_param = enc_file_data_param
+        self.uid_param = uid_param
+        self.ctr_param = ctr_param
+        self.sdmmac_param = sdmmac_param
+        self.require_lrp = require_lrp
+        self.demo_mode = master_key == (b"\x00" * 16)
+
+        self.keys = KeyRing(master_keys=[master_key] + self.previous_master_keys,
+                            derive_tag_key=DERIVE_MODES[derive_mode].derive_tag_key,
+                            derive_undiversified_key=DERIVE_MODES[derive_mode].derive_undiversified_key,
+                            cache_size=key_cache_size,
+                            shared_cache=shared_key_cache,
+                            namespace=derive_mode.encode('ascii'))
+
+        # per-tenant caches, set up by the application
+        self.result_cache = None
+        self.mac_precomputer = None
+        self.token_signer = None
+
+    def sdm_file_read_key(self, uid: bytes, key_index: int = 0) -> bytes:
+        """
+        SDMFileReadKey of the tag for the active master key with the given index (0 = current)
+        """
+        return self.keys.file_key(key_index, uid)
+
+
+class TenantRegistry:
+    def __init__(self, default: Tenant):
+        """
+        :param default: tenant used when neither host nor path prefix matches
+        """
+        self.default = default
+        self.tenants: Dict[str, Tenant] = {default.name: default}
+        self.by_host: Dict[str, Tenant] = {}
+        self.by_prefix: Dict[str, Tenant] = {}
+
+    def add(self, tenant: Tenant, hosts=(), path_prefix: Optional[str] = None):
+        if tenant.name in self.tenants:
+            raise RuntimeError(f"Duplicate tenant: {tenant.name}")
+
+        self.tenants[tenant.name] = tenant
+
+        for host in hosts:
+            self.by_host[host.lower()] = tenant
+
+        if path_prefix:
+            if path_prefix.count("/") != 1 or not path_prefix.startswith("/"):
+                raise RuntimeError(f"Path prefix must be a single segment: {path_prefix}")
+
+            self.by_prefix[path_prefix] = tenant
+
+    def resolve(self, host: str, path: str) -> Tuple[Tenant, str, str]:
+        """
+        Find the tenant for the request
+        :param host: value of the Host header
+        :param path: request path
+        :return: tuple (tenant, path prefix, remaining path)
+        """
+        if self.by_prefix:
+            end = path.find("/", 1)
+            prefix = path if end == -1 else path[:end]
+            tenant = self.by_prefix.get(prefix)
+
+            if tenant is not None:
+                return tenant, prefix, path[len(prefix):] or "/"
+
+        if self.by_host:
+            tenant = self.by_host.get(host.rsplit(":", 1)[0].lower())
+
+            if tenant is not None:
+                return tenant, "", path
+
+        return self.default, "", path
+
+
+def load_tenants(path: str, default: Tenant) -> TenantRegistry:
+    """
+    Build the registry out of the JSON tenants file.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        definitions = json.load(f)
+
+    registry = TenantRegistry(default)
+
+    for name, spec in definitions.items():
+        if "master_key" in spec:
+            master_key = binascii.unhexlify(spec["master_key"])
+            previous_master_keys = [binascii.unhexlify(key) for key in spec.get("previous_master_keys", [])]
+        else:
+            master_key = default.master_key
+            previous_master_keys = default.previous_master_keys
+
+        tenant = Tenant(
+            name=name,
+            master_key=master_key,
+            previous_master_keys=previous_master_keys,
+            derive_mode=spec.get("derive_mode", default.derive_mode),
+            enc_picc_data_param=spec.get("enc_picc_data_param", default.enc_picc_data_param),
+            enc_file_data_param=spec.get("enc_file_data_param", default.enc_file_data_param),
+            uid_param=spec.get("uid_param", default.uid_param),
+            ctr_param=spec.get("ctr_param", default.ctr_param),
+            sdmmac_param=spec.get("sdmmac_param", default.sdmmac_param),
+            require_lrp=spec.get("require_lrp", default.require_lrp),
+            key_cache_size=default.keys.cache_size,
+            shared_key_cache=default.keys.shared_cache)
+        registry.add(tenant, hosts=spec.get("hosts", []), path_prefix=spec.get("path_prefix"))
+
+    return registry
+
+
+def config_tenants(config, shared_key_cache: Optional[SharedKeyCache] = None) -> TenantRegistry:
+    """
+    Build the registry out of the configuration: the default tenant and the tenants of TENANTS_FILE.
+    :param config: configuration module (config.py)
+    :param shared_key_cache: derived key cache shared by the worker processes
+    """
+    default = Tenant(name="default",
+                     master_key=config.MASTER_KEY,
+                     derive_mode=config.DERIVE_MODE,
+                     enc_picc_data_param=config.ENC_PICC_DATA_PARAM,
+                     enc_file_data_param=config.ENC_FILE_DATA_PARAM,
+                     uid_param=config.UID_PARAM,
+                     ctr_param=config.CTR_PARAM,
+                     sdmmac_param=config.SDMMAC_PARAM,
+                     require_lrp=config.REQUIRE_LRP,
+                     previous_master_keys=config.PREVIOUS_MASTER_KEYS,
+                     key_cache_size=config.DERIVED_KEY_CACHE_SIZE,
+                     shared_key_cache=shared_key_cache)
+
+    if config.TENANTS_FILE:
+        return load_tenants(config.TENANTS_FILE, default)
+
+    return TenantRegistry(default)
+
+
+class TenantMiddleware:
+    def __init__(self, app, registry: TenantRegistry):
+        """
+        WSGI middleware which selects the tenant and strips its path prefix
+        (the prefix is moved to SCRIPT_NAME, so the routes of the wrapped application match).
+        """
+        self.app = app
+        self.registry = registry
+
+    def __call__(self, environ, start_response):
+        tenant, prefix, path = self.registry.resolve(environ.get('HTTP_HOST', ''), environ.get('PATH_INFO', ''))
+        environ[ENVIRON_KEY] = tenant
+
+        if prefix:
+            environ['SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '') + prefix
+            environ['PATH_INFO'] = path
+
+        return self.app(environ, start_response)
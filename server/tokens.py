@@ -0,0 +1,110 @@
+"""
+Signed short-lived verification tokens.
+
+After a SUN message was verified, the server can issue a compact token (HMAC-SHA256 over UID, read counter,
+encryption mode, TagTamper status and expiry). Follow-up requests concerning the same scan may present
+the token instead of the SUN parameters, which requires only a single HMAC to validate.
+"""
+
+import base64
+import binascii
+import hashlib
+import hmac
+import struct
+import time
+from typing import Callable, Optional
+
+from libsdm.sdm import EncMode
+
+TOKEN_VERSION = 1
+MAC_LENGTH = 16
+NO_READ_CTR = 0xFFFFFFFF
+
+# TagTamper status as reported by the JSON API
+TT_STATUSES = ["", "secure", "tampered_closed", "tampered_open", "not_initialized", "not_supported", "unknown"]
+
+
+class InvalidToken(RuntimeError):
+    pass
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode('ascii')
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+class TokenSigner:
+    def __init__(self, key: bytes, ttl: int, clock: Callable[[], float] = time.time):
+        """
+        Issue and verify verification tokens
+        :param key: server secret used to sign the tokens
+        :param ttl: token validity (in seconds)
+        :param clock: wall clock (for testing)
+        """
+        self.key = key
+        self.ttl = ttl
+        self.clock = clock
+
+    def _mac(self, payload: bytes) -> bytes:
+        return hmac.new(self.key, payload, digestmod=hashlib.sha256).digest()[0:MAC_LENGTH]
+
+    def issue(self, uid: bytes, read_ctr: Optional[int], encryption_mode: EncMode, tt_status: str = "") -> str:
+        """
+        Issue token for the verified scan
+        :param uid: tag UID
+        :param read_ctr: SDMReadCtr (None if not mirrored)
+        :param encryption_mode: EncMode.AES or EncMode.LRP
+        :param tt_status: TagTamper status as reported by the API (empty if not applicable)
+        :return: URL-safe token
+        """
+        expires = int(self.clock()) + self.ttl
+        payload = struct.pack(">BB", TOKEN_VERSION, len(uid)) + uid \
+            + struct.pack(">IBBI",
+                          NO_READ_CTR if read_ctr is None else read_ctr,
+                          encryption_mode.value,
+                          TT_STATUSES.index(tt_status),
+                          expires)
+        return _b64encode(payload + self._mac(payload))
+
+    def verify(self, token: str) -> dict:
+        """
+        Verify the token
+        :param token: token returned by issue()
+        :return: dict: uid (bytes), read_ctr (int or None), encryption_mode (EncMode), tt_status (str), expires (int)
+        :raises:
+            InvalidToken: if token is malformed, not properly signed or expired
+        """
+        try:
+            raw = _b64decode(token)
+        except (binascii.Error, ValueError):
+            raise InvalidToken("Malformed token.") from None
+
+        if len(raw) < 2 + 10 + MAC_LENGTH:
+            raise InvalidToken("Malformed token.")
+
+        payload, mac = raw[:-MAC_LENGTH], raw[-MAC_LENGTH:]
+
+        if not hmac.compare_digest(mac, self._mac(payload)):
+            raise InvalidToken("Token is not properly signed.")
+
+        version, uid_length = struct.unpack(">BB", payload[0:2])
+
+        if version != TOKEN_VERSION or len(payload) != 2 + uid_length + 10:
+            raise InvalidToken("Malformed token.")
+
+        uid = payload[2:2 + uid_length]
+        read_ctr, mode, tt_status, expires = struct.unpack(">IBBI", payload[2 + uid_length:])
+
+        if expires <= self.clock():
+            raise InvalidToken("Token has expired.")
+
+        return {
+            "uid": uid,
+            "read_ctr": None if read_ctr == NO_READ_CTR else read_ctr,
+            "encryption_mode": EncMode(mode),
+            "tt_status": TT_STATUSES[tt_status],
+            "expires": expires
+        }
@@ -0,0 +1,214 @@
+"""
+Per-request traces of the verification pipeline.
+
+The stages recorded for a request (see libsdm/stages.py) are converted into nested spans
+in the OpenTelemetry (OTLP/JSON) shape, one span per line:
+{"traceId": "...", "spanId": "...", "parentSpanId": "...", "name": "mac", "kind": "SPAN_KIND_INTERNAL",
+ "startTimeUnixNano": "...", "endTimeUnixNano": "...", "attributes": [...], "status": {...}}
+
+Requests are sampled with the configured probability, requests slower than the threshold are always sampled.
+The sampled spans are queued and written by a background thread into a size-rotated file per process
+(spans.<pid>.jsonl, spans.<pid>.jsonl.1, ...), so the request thread never waits for disk I/O.
+"""
+
+import json
+import os
+import queue
+import random
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+from libsdm.stages import StageRecorder
+
+STATUS_OK = {"code": "STATUS_CODE_OK"}
+STATUS_UNSET = {"code": "STATUS_CODE_UNSET"}
+
+
+def _attributes(values: dict) -> List[dict]:
+    return [{"key": key, "value": {"stringValue": str(value)}} for key, value in sorted(values.items())]
+
+
+class Tracer:
+    # pylint: disable=too-many-instance-attributes, too-many-arguments
+    def __init__(self,
+                 directory: str,
+                 sample_rate: float = 0.01,
+                 slow_threshold: Optional[float] = 0.1,
+                 max_bytes: int = 10 * 1024 * 1024,
+                 backup_count: int = 5,
+                 max_queued: int = 10000,
+                 rand: Callable[[], float] = random.random):
+        """
+        :param directory: where to write the span files
+        :param sample_rate: probability of sampling a request
+        :param slow_threshold: always sample requests which took at least this long (in seconds; None = never)
+        :param max_bytes: rotate the span file once it reaches this size
+        :param backup_count: number of rotated files to keep
+        :param max_queued: maximum number of traces waiting to be written (further ones are dropped)
+        """
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rand = rand
+
+        self.lock = threading.Lock()
+        self.jobs: queue.Queue = queue.Queue(maxsize=max_queued)
+        self.pid: Optional[int] = None
+        self.path = ""
+        self.file = None
+
+        self.pending = 0
+        self.sampled = 0
+        self.dropped = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def sample(self, duration: float) -> bool:
+        if self.slow_threshold is not None and duration >= self.slow_threshold:
+            return True
+
+        return self.rand() < self.sample_rate
+
+    def observe(self, recorder: StageRecorder, path: str) -> List[Tuple[str, str]]:
+        """
+        Observer for server.instrument.Instrumentation.
+        """
+        if not self.sample(recorder.finish()):
+            return []
+
+        self._ensure_started()
+
+        with self.lock:
+            self.sampled += 1
+            self.pending += 1
+
+        try:
+            self.jobs.put_nowait((recorder, path, time.time_ns(), recorder.clock()))
+        except queue.Full:
+            with self.lock:
+                self.dropped += 1
+                self.pending -= 1
+
+        return []
+
+    @staticmethod
+    def spans(recorder: StageRecorder, path: str, now_ns: int, now_clock: float) -> List[dict]:
+        """
+        Convert the recorded stages into spans.
+        :param now_ns: wall clock time (time.time_ns()) corresponding to now_clock
+        :param now_clock: reading of the recorder clock
+        """
+        def unix_nano(timestamp: float) -> str:
+            return str(now_ns - int((now_clock - timestamp) * 1e9))
+
+        trace_id = random.getrandbits(128).to_bytes(16, 'big').hex()
+        span_ids = [random.getrandbits(64).to_bytes(8, 'big').hex() for _ in range(len(recorder.stages) + 1)]
+        labels = dict(recorder.labels)
+        labels.pop("route", None)
+        error = labels.get("outcome") not in (None, "ok")
+
+        spans = [{
+            "traceId": trace_id,
+            "spanId": span_ids[0],
+            "parentSpanId": "",
+            "name": f"GET {path}",
+            "kind": "SPAN_KIND_SERVER",
+            "startTimeUnixNano": unix_nano(recorder.start),
+            "endTimeUnixNano": unix_nano(recorder.end if recorder.end is not None else now_clock),
+            "attributes": _attributes(dict({"http.route": path}, **labels)),
+            "status": {"code": "STATUS_CODE_ERROR", "message": labels.get("outcome", "")} if error else STATUS_OK
+        }]
+
+        for index, item in enumerate(recorder.stages):
+            spans.append({
+                "traceId": trace_id,
+                "spanId": span_ids[index + 1],
+                "parentSpanId": span_ids[item.parent + 1 if item.parent is not None else 0],
+                "name": item.name,
+                "kind": "SPAN_KIND_INTERNAL",
+                "startTimeUnixNano": unix_nano(item.start),
+                "endTimeUnixNano": unix_nano(item.end if item.end is not None else now_clock),
+                "attributes": [],
+                "status": {"code": "STATUS_CODE_ERROR", "message": item.error} if item.error else STATUS_UNSET
+            })
+
+        return spans
+
+    def _ensure_started(self):
+        if self.pid == os.getpid():
+            return
+
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+
+            # threads don't survive fork, the file of the parent must not be written to
+            self.pid = os.getpid()
+            self.path = os.path.join(self.directory, f"spans.{self.pid}.jsonl")
+            self.file = None
+            threading.Thread(target=self._worker, name="trace-writer", daemon=True).start()
+
+    def _worker(self):
+        pid = os.getpid()
+
+        while self.pid == pid:
+            batch = [self.jobs.get()]
+
+            while len(batch) < 1000:
+                try:
+                    batch.append(self.jobs.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.write(batch)
+            except OSError:
+                self.dropped += len(batch)
+            finally:
+                with self.lock:
+                    self.pending -= len(batch)
+
+    def write(self, batch):
+        traces = []
+
+        for recorder, path, now_ns, now_clock in batch:
+            spans = self.spans(recorder, path, now_ns, now_clock)
+            traces.append("".join(json.dumps(span, separators=(",", ":")) + "\n" for span in spans).encode('utf-8'))
+
+        with self.lock:
+            if self.file is None:
+                self.file = open(self.path, "ab")  # pylint: disable=consider-using-with
+
+            for data in traces:
+                # spans of a trace are never split between two files
+                if self.file.tell() and self.file.tell() + len(data) > self.max_bytes:
+                    self._rotate()
+
+                self.file.write(data)
+
+            self.file.flush()
+
+    def _rotate(self):
+        self.file.close()
+
+        for i in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+
+        if self.backup_count > 0:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.unlink(self.path)
+
+        self.file = open(self.path, "ab")  # pylint: disable=consider-using-with
+
+    def flush(self, timeout: float = 5.0):
+        """
+        Wait until the queued traces are written (e.g. in tests or on shutdown).
+        """
+        deadline = time.monotonic() + timeout
+
+        while self.pending and time.monotonic() < deadline:
+            time.sleep(0.01)
@@ -0,0 +1,98 @@
+"""
+Pre-fork warmup.
+
+Under uWSGI the application is imported once in the master process and the workers are forked from it
+(unless lazy-apps is enabled), so whatever is initialized before the fork is shared by all the workers
+copy-on-write instead of being rebuilt by every worker (and again after every respawn):
+* compiled Jinja templates
+* undiversified keys (derived by the key rings) and the LRP plaintexts and updated keys of the SDMMetaReadKeys
+* code paths of the verification (lazily loaded modules, native libraries, cached lookups)
+* optionally the SDMFileReadKeys of the recently active tags (PBKDF2 in the legacy mode)
+
+Finally gc.freeze() moves all the objects to the permanent generation, so the garbage collections
+in the workers neither scan them nor write to their headers, which would copy the shared pages.
+"""
+
+import gc
+import time
+from typing import Iterable
+
+from libsdm.encoder import encode_sun_message
+from libsdm.lrp import LRP
+from libsdm.sdm import EncMode, ParamMode, decrypt_sun_message
+
+# UID of the synthetic messages, not a real tag
+WARMUP_UID = b"\x04" + b"\x00" * 6
+
+
+def warm_templates(app) -> int:
+    """
+    Compile all the templates of the Flask application
+    :return: number of templates
+    """
+    names = app.jinja_env.list_templates()
+
+    for name in names:
+        app.jinja_env.get_template(name)
+
+    return len(names)
+
+
+def warm_tenant(tenant, preload_uids: Iterable[bytes] = ()) -> int:
+    """
+    Precompute the LRP tables of the SDMMetaReadKeys, verify synthetic messages (AES and LRP)
+    and derive the SDMFileReadKeys of the given tags for all active master keys
+    :return: number of preloaded SDMFileReadKeys
+    """
+    keys = tenant.keys
+
+    for meta_read_key in keys.meta_read_keys:
+        LRP.remember(meta_read_key)
+
+    # not through the key ring, so that neither its cache nor the key order are affected
+    file_key = keys.derive_tag_key(keys.master_keys[0], WARMUP_UID, 2)
+
+    for mode in (EncMode.AES, EncMode.LRP):
+        message = encode_sun_message(ParamMode.SEPARATED, keys.meta_read_keys[0], file_key, WARMUP_UID, 1,
+                                     mode=mode, sdmmac_param=tenant.sdmmac_param)
+        decrypt_sun_message(param_mode=ParamMode.SEPARATED,
+                            sdm_meta_read_key=keys.meta_read_keys[0],
+                            sdm_file_read_key=lambda uid: file_key,
+                            sdmmac_param=tenant.sdmmac_param,
+                            **message)
+
+    preloaded = 0
+
+    for uid in preload_uids:
+        for index in range(len(keys.master_keys)):
+            keys.file_key(index, uid)
+            preloaded += 1
+
+    return preloaded
+
+
+def warmup(app, tenants: Iterable, preload_uids: Iterable[bytes] = (), freeze: bool = True) -> dict:
+    """
+    Warm up the application in the master process, before the workers are forked
+    :param app: Flask application
+    :param tenants: tenants to warm up
+    :param preload_uids: tags whose SDMFileReadKeys should be derived for every tenant (the most recently active first)
+    :param freeze: call gc.freeze() at the end (must be the last thing before the fork)
+    :return: summary of the warmup
+    """
+    started = time.perf_counter()
+    preload_uids = list(preload_uids)
+    templates = warm_templates(app)
+    preloaded = sum(warm_tenant(tenant, preload_uids) for tenant in tenants)
+
+    if freeze:
+        # collect the garbage of the initialization first, it would stay in the frozen generation forever
+        gc.collect()
+        gc.freeze()
+
+    return {
+        "templates": templates,
+        "preloaded_keys": preloaded,
+        "frozen_objects": gc.get_freeze_count(),
+        "seconds": time.perf_counter() - started
+    }
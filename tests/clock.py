@@ -0,0 +1,9 @@
+class FakeClock:
+    """
+    Clock for the components taking a clock callable, advanced by setting the now attribute
+    """
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
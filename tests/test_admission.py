@@ -0,0 +1,90 @@
+import json
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from server.admission import API, DEMO, SUN, AdmissionControl, AdmissionMiddleware, parse_request_start
+from tests.clock import FakeClock
+
+
+def test_parse_request_start():
+    now = 1700000000.5
+    assert parse_request_start("t=1700000000.250", now) == 0.25
+    assert parse_request_start("t=1700000000250", now) == 0.25
+    assert parse_request_start("1700000000250000", now) == 0.25
+    assert parse_request_start("t=1700000001.000", now) == 0.0
+    assert parse_request_start("t=now", now) is None
+
+
+def test_in_flight_shares(tmp_path):
+    admission = AdmissionControl(max_in_flight=4, stats_directory=str(tmp_path))
+
+    assert admission.admit(DEMO)
+    assert admission.admit(DEMO)
+    # demo pages may use half of the in-flight limit
+    assert not admission.admit(DEMO)
+    assert admission.admit(SUN)
+    assert not admission.admit(SUN)
+    assert admission.admit(API)
+    assert not admission.admit(API)
+
+    admission.release()
+    assert admission.admit(API)
+
+    values = admission.stats.collect()
+    assert values["admitted_demo"] == 2
+    assert values["shed_in_flight_demo"] == 1
+    assert values["shed_in_flight_api"] == 1
+    assert values["in_flight"] == 4
+
+
+def test_queueing_delay(tmp_path):
+    clock = FakeClock()
+    admission = AdmissionControl(target_delay=0.05, interval=0.1, stats_directory=str(tmp_path), clock=clock)
+
+    # a short burst doesn't make the process overloaded
+    assert admission.admit(DEMO, 0.5)
+    assert admission.admit(DEMO, 0.01)
+    clock.now = 0.15
+    assert admission.admit(DEMO, 0.2)
+    assert not admission.overloaded
+
+    # standing queue: the smallest delay within the interval exceeds the target
+    assert admission.admit(DEMO, 0.06)
+    clock.now = 0.3
+    assert not admission.admit(DEMO, 0.01)
+    assert admission.overloaded
+    assert admission.admit(API, 0.09)
+    assert not admission.admit(API, 0.11)
+    assert admission.admit(SUN, 0.05)
+    assert not admission.admit(SUN, 0.06)
+
+    # the queue drained
+    clock.now = 0.45
+    assert admission.admit(DEMO, 0.01)
+    assert not admission.overloaded
+
+    assert 'sdm_admission_requests_total{priority="demo",decision="shed",reason="delay"} 1' in admission.render()
+
+
+def test_middleware(tmp_path):
+    def application(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"verified"]
+
+    admission = AdmissionControl(max_in_flight=1, stats_directory=str(tmp_path))
+    client = Client(AdmissionMiddleware(application, admission), Response)
+
+    assert client.get("/api/tag").status_code == 200
+    assert admission.in_flight == 0
+
+    # occupied by another request
+    admission.admit(API)
+    response = client.get("/api/tag")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+    assert json.loads(response.data) == {"error": "503 Service Unavailable: Server is overloaded, try again later."}
+
+    assert client.get("/").status_code == 503
+    # not under admission control
+    assert client.get("/static/style.css").status_code == 200
@@ -0,0 +1,33 @@
+import tracemalloc
+
+from server.alloc_profile import AllocationMiddleware, AllocationProfiler
+
+RETAINED = []
+
+
+def _app(environ, start_response):  # pylint: disable=unused-argument
+    RETAINED.append(bytearray(100000))
+    start_response("200 OK", [])
+    return [b"ok"]
+
+
+def test_profile_request():
+    profiler = AllocationProfiler(sample_rate=1.0, paths=["/tag"])
+    app = AllocationMiddleware(_app, profiler)
+
+    for path in ("/tag", "/tag", "/"):
+        assert app({"PATH_INFO": path}, lambda status, headers, exc_info=None: None) == [b"ok"]
+
+    # tracing is stopped after the sampled request
+    assert not tracemalloc.is_tracing()
+
+    report = profiler.report(top=1)
+    endpoint = report["endpoints"]["/tag"]
+    assert list(report["endpoints"]) == ["/tag"]
+    assert endpoint["requests"] == 2
+    assert endpoint["size"] >= 200000
+    assert endpoint["peak"] >= 100000
+    assert endpoint["top_lines"][0]["line"].endswith(f"test_alloc_profile.py:{_app.__code__.co_firstlineno + 1}")
+
+    profiler.reset()
+    assert profiler.report()["endpoints"] == {}
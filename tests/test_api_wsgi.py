@@ -0,0 +1,174 @@
+import binascii
+import functools
+import json
+
+from flask import Flask
+from werkzeug.exceptions import BadRequest, NotFound
+from werkzeug.http import dump_cookie
+from werkzeug.middleware.dispatcher import DispatcherMiddleware
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+import app as app_module
+from api_wsgi import APIApplication
+from libsdm.encoder import encode_plain_sun, encode_sun_message, format_query
+from libsdm.sdm import EncMode, ParamMode
+from server.rate_limit import TokenBuckets
+from server.result_cache import ResultCache
+from server.tokens import TokenSigner
+from tests.clock import FakeClock
+
+UID = binascii.unhexlify("04DE5F1EACC040")
+
+
+def _fallback(environ, start_response):
+    start_response("404 NOT FOUND", [("Content-Type", "text/html")])
+    return [f"{environ['SCRIPT_NAME']}|{environ['PATH_INFO']}".encode()]
+
+
+def _handler(args, environ):
+    if args.get("missing"):
+        raise NotFound()
+
+    if args.get("bad"):
+        raise BadRequest("Bad.")
+
+    return {"ok": True}
+
+
+def _client(fallback=None):
+    api_app = APIApplication(routes={'/api/tag': (_handler, 200)}, fallback=fallback)
+    return Client(DispatcherMiddleware(_fallback, {route: api_app.endpoint(route) for route in api_app.routes}),
+                  Response)
+
+
+def test_routes():
+    client = _client(fallback=_fallback)
+
+    response = client.get("/api/tag")
+    assert response.status_code == 200
+    assert json.loads(response.data) == {"ok": True}
+
+    response = client.get("/api/tag?bad=1")
+    assert response.status_code == 200
+    assert json.loads(response.data) == {"error": "400 Bad Request: Bad."}
+
+
+def test_fallback():
+    client = _client(fallback=_fallback)
+
+    # with the full path, e.g. below the path prefix of a tenant
+    response = client.get("/api/tag/foo", environ_overrides={"SCRIPT_NAME": "/acme"})
+    assert response.status_code == 404
+    assert response.data == b"/acme|/api/tag/foo"
+    assert client.get("/api/tag?missing=1").data == b"|/api/tag"
+
+
+def test_without_fallback():
+    client = _client()
+
+    response = client.get("/api/tag/foo")
+    assert response.status_code == 404
+    assert json.loads(response.data)["error"].startswith("404 Not Found")
+    assert client.get("/api/tag?missing=1").headers["Content-Type"] == "application/json"
+
+
+def _sun_query(tenant, read_ctr=1):
+    keys = tenant.keys
+    file_key = keys.derive_tag_key(tenant.master_key, UID, 2)
+    return format_query(encode_sun_message(ParamMode.SEPARATED, keys.meta_read_keys[0], file_key, UID, read_ctr,
+                                           mode=EncMode.AES, sdmmac_param=tenant.sdmmac_param),
+                        sdmmac_param=tenant.sdmmac_param)
+
+
+def _plain_query(tenant, read_ctr=1):
+    file_key = tenant.keys.derive_tag_key(tenant.master_key, UID, 2)
+    return format_query(encode_plain_sun(UID, read_ctr, file_key), sdmmac_param=tenant.sdmmac_param)
+
+
+def _assert_same(url, headers=None):
+    """
+    Compare the response of the fast path with the one of the Flask routes
+    """
+    # API_FAST_PATH is enabled in config.dist.py
+    assert app_module.api_app is not None
+    flask_app = functools.partial(Flask.wsgi_app, app_module.app)
+    fast = Client(app_module.app.wsgi_app, Response, use_cookies=False).get(url, headers=headers)
+    flask = Client(flask_app, Response, use_cookies=False).get(url, headers=headers)
+
+    assert fast.status == flask.status
+    assert fast.headers.to_wsgi_list() == flask.headers.to_wsgi_list()
+    assert fast.data == flask.data
+    return fast
+
+
+def test_same_as_flask(monkeypatch):
+    tenant = app_module.default_tenant
+    # Expires of the cookie would depend on the wall clock
+    monkeypatch.setattr(app_module, "dump_cookie", functools.partial(dump_cookie, sync_expires=False))
+    clock = FakeClock(1700000000.0)
+    monkeypatch.setattr(tenant, "token_signer", TokenSigner(key=b"\x01" * 32, ttl=300, clock=clock))
+
+    for path in ("/api/tag", "/api/tagtt"):
+        response = _assert_same(f"{path}?{_sun_query(tenant)}")
+        assert response.status_code == 200
+        assert "Set-Cookie" in response.headers
+
+        # malformed and invalid messages
+        assert _assert_same(f"{path}?picc_data=00").status_code == 200
+        assert _assert_same(f"{path}?{_sun_query(tenant)[:-2]}00").status_code == 200
+        assert _assert_same(path).status_code == 200
+
+    response = _assert_same(f"/api/tagpt?{_plain_query(tenant)}")
+    assert response.status_code == 200
+    assert "Set-Cookie" in response.headers
+    assert _assert_same("/api/tagpt?uid=00").status_code == 400
+    assert _assert_same(f"/api/tagpt?{_plain_query(tenant)[:-2]}00").status_code == 400
+
+    token = json.loads(response.data)["token"]
+    assert _assert_same(f"/api/token?token={token}").status_code == 200
+    assert _assert_same("/api/token", headers={"Cookie": f"sdm_token={token}"}).status_code == 200
+    assert _assert_same("/api/token").status_code == 403
+    assert _assert_same("/api/token?token=junk").status_code == 403
+
+    # tokens disabled
+    monkeypatch.setattr(tenant, "token_signer", None)
+    assert _assert_same("/api/token?token=junk").status_code == 404
+
+
+def test_same_as_flask_rate_limited(monkeypatch, tmp_path):
+    tenant = app_module.default_tenant
+    buckets = TokenBuckets("uid", rate=0.1, burst=1, directory=str(tmp_path), clock=FakeClock(1000.0))
+    monkeypatch.setattr(app_module, "uid_rate_limit", buckets)
+    # drain the bucket of the tag
+    buckets.check(UID)
+
+    for url in (f"/api/tag?{_sun_query(tenant)}", f"/api/tagtt?{_sun_query(tenant)}",
+                f"/api/tagpt?{_plain_query(tenant)}"):
+        response = _assert_same(url)
+        assert response.status_code == 429
+        assert response.headers["Retry-After"] == "10"
+
+
+class _Recorder:
+    def __init__(self):
+        self.scans = []
+
+    def record(self, route, outcome, **kwargs):  # pylint: disable=unused-argument
+        self.scans.append((route, outcome))
+
+
+def test_cache_hit_not_recorded(monkeypatch):
+    tenant = app_module.default_tenant
+    recorder = _Recorder()
+    monkeypatch.setattr(app_module, "event_log", recorder)
+    monkeypatch.setattr(tenant, "result_cache", ResultCache(max_size=10, ttl=60.0))
+    client = Client(app_module.app.wsgi_app, Response, use_cookies=False)
+
+    for url in (f"/api/tag?{_sun_query(tenant, read_ctr=5)}", f"/api/tagpt?{_plain_query(tenant, read_ctr=5)}"):
+        for _ in range(3):
+            assert client.get(url).status_code == 200
+
+    # the repeated fetches of the same URL were served from the cache and aren't new scans
+    assert recorder.scans == [("tag", "ok"), ("tagpt", "ok")]
+    assert tenant.result_cache.stats()["cached"] == 4
@@ -0,0 +1,226 @@
+import asyncio
+import binascii
+import json
+import threading
+
+import asgi
+from libsdm.encoder import encode_sun_message
+from libsdm.sdm import EncMode, ParamMode, calculate_plain_sdmmac
+from server.admission import AdmissionControl
+from server.rate_limit import TokenBuckets
+from server.tenants import Tenant, TenantRegistry
+
+UID = binascii.unhexlify("04DE5F1EACC040")
+
+
+def _request(application, path, query_string=b"", method="GET", headers=()):
+    """
+    Drive the ASGI application with a single HTTP request
+    :return: tuple (status, headers, body)
+    """
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': path,
+        'query_string': query_string,
+        'headers': [(b"host", b"localhost")] + list(headers),
+        'client': ("127.0.0.1", 40000),
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b"", 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(application(scope, receive, send))
+
+    assert [message['type'] for message in messages] == ['http.response.start', 'http.response.body']
+    return messages[0]['status'], dict(messages[0]['headers']), messages[1]['body']
+
+
+def _application():
+    return asgi.SDMApplication(executor="thread", max_workers=2, max_pending=4)
+
+
+def _sun_query(tenant, read_ctr=1):
+    keys = tenant.keys
+    file_key = keys.derive_tag_key(tenant.master_key, UID, 2)
+    message = encode_sun_message(ParamMode.SEPARATED, keys.meta_read_keys[0], file_key, UID, read_ctr,
+                                 mode=EncMode.AES, sdmmac_param=tenant.sdmmac_param)
+    return (f"{tenant.enc_picc_data_param}={message['picc_enc_data'].hex().upper()}"
+            f"&{tenant.sdmmac_param}={message['sdmmac'].hex().upper()}").encode('ascii')
+
+
+def _plain_query(tenant, read_ctr=1):
+    ctr = read_ctr.to_bytes(3, 'big')
+    sdmmac = calculate_plain_sdmmac(UID, ctr, tenant.keys.derive_tag_key(tenant.master_key, UID, 2))
+    return (f"{tenant.uid_param}={UID.hex().upper()}&{tenant.ctr_param}={ctr.hex().upper()}"
+            f"&{tenant.sdmmac_param}={sdmmac.hex().upper()}").encode('ascii')
+
+
+def test_api_routes():
+    application = _application()
+    tenant = asgi.tenants.default
+
+    try:
+        for path, query_string in (('/api/tag', _sun_query(tenant)),
+                                   ('/api/tagtt', _sun_query(tenant)),
+                                   ('/api/tagpt', _plain_query(tenant))):
+            status, headers, body = _request(application, path, query_string)
+            assert status == 200
+            assert headers[b"content-type"] == asgi.CT_JSON
+            assert headers[b"content-length"] == str(len(body)).encode('ascii')
+            result = json.loads(body)
+            assert result["uid"] == UID.hex().upper()
+            assert result["read_ctr"] == 1
+
+        # malformed messages: /api/tag responds with 200, /api/tagpt with 400
+        status, _, body = _request(application, '/api/tag', b"picc_data=00")
+        assert status == 200
+        assert "error" in json.loads(body)
+
+        status, _, body = _request(application, '/api/tagpt', b"uid=00")
+        assert status == 400
+        assert "error" in json.loads(body)
+    finally:
+        application.shutdown()
+
+
+def test_html_routes_and_head():
+    application = _application()
+    tenant = asgi.tenants.default
+
+    try:
+        status, headers, body = _request(application, '/tag', _sun_query(tenant))
+        assert status == 200
+        assert headers[b"content-type"] == asgi.CT_HTML
+        assert UID.hex().encode('ascii') in body
+
+        status, headers, body = _request(application, '/tagpt', _plain_query(tenant))
+        assert status == 200
+        assert UID.hex().encode('ascii') in body
+
+        # JSON output of the HTML route
+        status, headers, body = _request(application, '/tag', _sun_query(tenant) + b"&output=json")
+        assert status == 200
+        assert headers[b"content-type"] == asgi.CT_JSON
+
+        # same headers, no body
+        _, get_headers, get_body = _request(application, '/tag', b"picc_data=00")
+        status, headers, body = _request(application, '/tag', b"picc_data=00", method="HEAD")
+        assert status == 400
+        assert body == b""
+        assert headers[b"content-length"] == str(len(get_body)).encode('ascii')
+        assert headers[b"content-type"] == get_headers[b"content-type"]
+
+        status, _, _ = _request(application, '/missing')
+        assert status == 404
+
+        status, _, _ = _request(application, '/tag', method="POST")
+        assert status == 405
+    finally:
+        application.shutdown()
+
+
+def test_tenant_prefix(monkeypatch):
+    acme = Tenant(name="acme", master_key=binascii.unhexlify("00112233445566778899AABBCCDDEEFF"),
+                  derive_mode="standard", enc_picc_data_param="picc_data", enc_file_data_param="enc",
+                  uid_param="uid", ctr_param="ctr", sdmmac_param="mac", require_lrp=False)
+    registry = TenantRegistry(asgi.tenants.default)
+    registry.add(acme, path_prefix="/acme")
+    monkeypatch.setattr(asgi, "tenants", registry)
+    application = _application()
+
+    try:
+        status, _, body = _request(application, '/acme/api/tag', _sun_query(acme))
+        assert status == 200
+        assert json.loads(body)["uid"] == UID.hex().upper()
+
+        # the message of the tenant isn't valid for the default one
+        status, _, body = _request(application, '/api/tag', _sun_query(acme))
+        assert "error" in json.loads(body)
+    finally:
+        application.shutdown()
+
+
+def test_executor_handoff(monkeypatch):
+    threads = []
+    handle_queued_request = asgi.handle_queued_request
+
+    def recording_handle_queued_request(*args):
+        threads.append(threading.current_thread().name)
+        return handle_queued_request(*args)
+
+    monkeypatch.setattr(asgi, "handle_queued_request", recording_handle_queued_request)
+    application = _application()
+
+    try:
+        status, _, _ = _request(application, '/api/tag', _sun_query(asgi.tenants.default))
+        assert status == 200
+        assert len(threads) == 1
+        assert threads[0].startswith("sdm")
+        assert threads[0] != threading.current_thread().name
+    finally:
+        application.shutdown()
+
+
+def test_ip_rate_limit(monkeypatch, tmp_path):
+    monkeypatch.setattr(asgi, "ip_rate_limit", TokenBuckets("ip", rate=0.001, burst=1, directory=str(tmp_path)))
+    application = _application()
+    tenant = asgi.tenants.default
+
+    try:
+        status, _, _ = _request(application, '/api/tag', _sun_query(tenant))
+        assert status == 200
+
+        status, headers, body = _request(application, '/api/tag', _sun_query(tenant))
+        assert status == 429
+        assert headers[b"content-type"] == asgi.CT_JSON
+        assert b"retry-after" in headers
+        assert "error" in json.loads(body)
+
+        status, headers, _ = _request(application, '/tag', _sun_query(tenant))
+        assert status == 429
+        assert headers[b"content-type"] == asgi.CT_HTML
+    finally:
+        application.shutdown()
+
+
+def test_admission_in_flight(monkeypatch, tmp_path):
+    admission = AdmissionControl(max_in_flight=1, retry_after=2, stats_directory=str(tmp_path))
+    monkeypatch.setattr(asgi, "admission", admission)
+    application = _application()
+
+    try:
+        # another request is being processed
+        admission.in_flight = 1
+        status, headers, body = _request(application, '/api/tag', _sun_query(asgi.tenants.default))
+        assert status == 503
+        assert headers[b"retry-after"] == b"2"
+        assert "error" in json.loads(body)
+
+        admission.in_flight = 0
+        status, _, _ = _request(application, '/api/tag', _sun_query(asgi.tenants.default))
+        assert status == 200
+        assert admission.in_flight == 0
+    finally:
+        application.shutdown()
+
+
+def test_admission_executor_queue(monkeypatch, tmp_path):
+    # overloaded with no delay budget left, so the request is dropped once it leaves the executor queue
+    admission = AdmissionControl(target_delay=-1.0, stats_directory=str(tmp_path))
+    admission.overloaded = True
+    monkeypatch.setattr(asgi, "admission", admission)
+    application = _application()
+
+    try:
+        status, headers, _ = _request(application, '/tag', _sun_query(asgi.tenants.default))
+        assert status == 503
+        assert headers[b"content-type"] == asgi.CT_HTML
+        assert admission.in_flight == 0
+        assert admission.stats.collect()["shed_delay_sun"] == 1
+    finally:
+        application.shutdown()
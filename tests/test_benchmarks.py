@@ -0,0 +1,41 @@
+import itertools
+
+from benchmarks import runner
+from benchmarks.primitives import all_cases
+
+
+def test_percentile():
+    values = list(range(1, 101))
+    assert runner.percentile(values, 50) == 50
+    assert runner.percentile(values, 99) == 99
+    assert runner.percentile(values, 100) == 100
+    assert runner.percentile([7], 99) == 7
+    assert runner.percentile([], 50) == 0.0
+
+
+def test_measure():
+    ticks = itertools.count(0, 1000)
+    result = runner.measure(lambda: None, duration=0.00001, warmup=0, min_calls=5, clock=lambda: next(ticks))
+    # every call takes one tick (1 us) to measure
+    assert result["calls"] >= 5
+    assert result["p50_us"] == 1.0
+    assert result["ops_per_sec"] > 0
+
+
+def test_compare():
+    baseline = {"results": {"a": {"ops_per_sec": 100.0}, "b": {"ops_per_sec": 100.0}, "c": {"ops_per_sec": 100.0}}}
+    current = {"results": {"a": {"ops_per_sec": 85.0}, "b": {"ops_per_sec": 95.0}, "d": {"ops_per_sec": 1.0}}}
+    rows = {row["name"]: row for row in runner.compare(baseline, current, threshold=0.1)}
+    assert set(rows) == {"a", "b"}
+    assert rows["a"]["regression"]
+    assert not rows["b"]["regression"]
+    assert abs(rows["a"]["change"] + 0.15) < 1e-9
+
+
+def test_cases_verify():
+    cases = dict(all_cases())
+    assert {"verify.aes.file.bulk", "verify.lrp.separated", "lrp.eval_lrp", "legacy_derive.tag_key"} <= set(cases)
+
+    for name, func in cases.items():
+        if name.startswith("verify.") and name != "verify.plain":
+            assert func()["uid"]
@@ -0,0 +1,147 @@
+import binascii
+import multiprocessing
+import os
+import time
+
+from libsdm.sdm import ParamMode, decrypt_sun_message
+from server.counter_store import CounterStore, ReplayedMessage
+
+UID1 = binascii.unhexlify("04DE5F1EACC040")
+UID2 = binascii.unhexlify("041E3C8A2D6B80")
+
+
+def _expect_replayed(fn, *args):
+    try:
+        fn(*args)
+    except ReplayedMessage:
+        # this is expected
+        pass
+    else:
+        raise RuntimeError("ReplayedMessage was not thrown as expected")
+
+
+def test_counter_store_memory():
+    store = CounterStore()
+    store.check(UID1, 5)
+    store.update(UID1, 5)
+
+    _expect_replayed(store.check, UID1, 5)
+    _expect_replayed(store.check, UID1, 4)
+    _expect_replayed(store.update, UID1, 5)
+
+    store.check(UID1, 6)
+    store.check(UID2, 1)
+    store.check(UID1, None)
+    assert store.get(UID1) == 5
+    assert store.get(UID2) is None
+
+
+def test_counter_store_recovery(tmp_path):
+    store = CounterStore(directory=str(tmp_path), compact_every=1000)
+
+    for ctr in range(1, 11):
+        store.update(UID1, ctr)
+
+    store.update(UID2, 3)
+    store.close()
+
+    # simulate torn write after crash
+    wal_path = os.path.join(str(tmp_path), f"counters.{os.getpid()}.wal")
+    with open(wal_path, "ab") as f:
+        f.write(b"\x07\x04")
+
+    recovered = CounterStore(directory=str(tmp_path))
+    assert recovered.get(UID1) == 10
+    assert recovered.get(UID2) == 3
+    _expect_replayed(recovered.check, UID1, 10)
+
+
+def test_counter_store_compaction(tmp_path):
+    store = CounterStore(directory=str(tmp_path), compact_every=1000)
+
+    for ctr in range(1, 101):
+        store.update(UID1, ctr)
+
+    store.compact()
+    store.update(UID2, 7)
+    store.close()
+
+    wal_path = os.path.join(str(tmp_path), f"counters.{os.getpid()}.wal")
+    assert os.path.getsize(wal_path) < 100
+
+    recovered = CounterStore(directory=str(tmp_path))
+    assert recovered.get(UID1) == 100
+    assert recovered.get(UID2) == 7
+
+
+def _update(store, uid, read_ctr):
+    store.update(uid, read_ctr)
+
+
+def test_counter_store_shared_between_processes():
+    store = CounterStore()
+    context = multiprocessing.get_context("fork")
+    # the second worker sees the counter accepted by the first one
+    process = context.Process(target=_update, args=(store, UID1, 5))
+    process.start()
+    process.join()
+    assert process.exitcode == 0
+
+    process = context.Process(target=_update, args=(store, UID1, 5))
+    process.start()
+    process.join()
+    assert process.exitcode != 0
+
+    assert store.get(UID1) == 5
+    _expect_replayed(store.update, UID1, 5)
+    store.update(UID1, 6)
+    assert sorted(store.items()) == [(UID1, 6)]
+
+
+def test_counter_store_full_stripe():
+    store = CounterStore(slots=1)
+
+    for ctr in range(1, 101):
+        store.merge(ctr.to_bytes(7, 'big'), ctr)
+
+    assert store.overflowed == 100 - 64
+    assert len(store) == 100
+    assert store.get((100).to_bytes(7, 'big')) == 100
+    _expect_replayed(store.check, (100).to_bytes(7, 'big'), 100)
+
+
+def test_counter_store_recent(monkeypatch):
+    store = CounterStore()
+    uids = [ctr.to_bytes(7, 'big') for ctr in range(1, 11)]
+
+    for ctr, uid in enumerate(uids):
+        monkeypatch.setattr(time, "time", lambda ctr=ctr: 1000000 + ctr)
+        store.update(uid, 1)
+
+    # raising the counter of the oldest one makes it the most recent
+    monkeypatch.setattr(time, "time", lambda: 2000000)
+    store.update(uids[0], 2)
+    assert store.recent(3) == [uids[0], uids[9], uids[8]]
+    assert store.recent(0) == []
+    assert sorted(store.recent(20)) == sorted(uids)
+
+
+def test_replay_rejected_before_mac():
+    store = CounterStore()
+    store.update(UID1, 61)
+    derived = []
+
+    def sdm_file_read_key(uid):
+        derived.append(uid)
+        return b"\x00" * 16
+
+    # From AN12196 page 12, read_ctr = 61
+    _expect_replayed(decrypt_sun_message,
+                     ParamMode.SEPARATED,
+                     b"\x00" * 16,
+                     sdm_file_read_key,
+                     binascii.unhexlify("EF963FF7828658A599F3041510671E88"),
+                     binascii.unhexlify("94EED9EE65337086"),
+                     None,
+                     store.check)
+    assert not derived
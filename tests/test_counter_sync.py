@@ -0,0 +1,208 @@
+import binascii
+import multiprocessing
+import socket
+import time
+
+from server.counter_store import CounterStore
+from server.counter_sync import CounterSync, DirectoryTransport, UDPTransport, decode_batch, encode_batch
+
+UID1 = binascii.unhexlify("04DE5F1EACC040")
+UID2 = binascii.unhexlify("041E3C8A2D6B80")
+KEY = b"\x42" * 32
+
+
+def _wait_for(store, uid, read_ctr, timeout=10.0):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if store.get(uid) == read_ctr:
+            return True
+
+        time.sleep(0.05)
+
+    return False
+
+
+def _make_node(transport):
+    store = CounterStore()
+    sync = CounterSync(store, transport, KEY, interval=0.05)
+    store.listener = sync.enqueue
+    sync.ensure_started()
+    assert sync.started.wait(5.0)
+    return store, sync
+
+
+def test_batch_roundtrip():
+    payload = encode_batch(KEY, b"\x01" * 16, [(UID1, 5), (UID2, 0xFFFFFF)])
+    assert decode_batch(KEY, payload) == (b"\x01" * 16, [(UID1, 5), (UID2, 0xFFFFFF)])
+    assert decode_batch(KEY, payload[:-1] + bytes([payload[-1] ^ 1])) is None
+    assert decode_batch(b"\x43" * 32, payload) is None
+    assert decode_batch(KEY, b"junk") is None
+
+
+def test_max_register_merge():
+    store = CounterStore()
+    assert store.merge(UID1, 5)
+    assert not store.merge(UID1, 3)
+    assert not store.merge(UID1, 5)
+    assert store.get(UID1) == 5
+
+
+def test_udp_sync():
+    transport_a = UDPTransport(("127.0.0.1", 0), [])
+    transport_b = UDPTransport(("127.0.0.1", 0), [])
+    store_a, _ = _make_node(transport_a)
+    store_b, _ = _make_node(transport_b)
+    transport_a.peers.append(transport_b.sock.getsockname())
+    transport_b.peers.append(transport_a.sock.getsockname())
+
+    store_a.update(UID1, 10)
+    store_b.update(UID2, 20)
+
+    assert _wait_for(store_b, UID1, 10)
+    assert _wait_for(store_a, UID2, 20)
+
+
+def _directory_node(directory, own, other):
+    store, _ = _make_node(DirectoryTransport(directory, poll_interval=0.05))
+    store.update(*own)
+
+    if not _wait_for(store, *other):
+        raise SystemExit(1)
+
+    # give the other node time to pick up our batch
+    time.sleep(0.5)
+
+
+def test_directory_sync_multiprocess(tmp_path):
+    ctx = multiprocessing.get_context("spawn")
+    child = ctx.Process(target=_directory_node, args=(str(tmp_path), (UID1, 42), (UID2, 7)))
+    child.start()
+
+    _directory_node(str(tmp_path), (UID2, 7), (UID1, 42))
+
+    child.join(timeout=20)
+    assert child.exitcode == 0
+
+
+class _FailingTransport:
+    def __init__(self):
+        self.attempts = 0
+
+    def start(self, node_id):  # pylint: disable=unused-argument
+        self.attempts += 1
+
+        if self.attempts == 1:
+            raise OSError("Address already in use")
+
+    def send(self, payload):
+        pass
+
+    def receive(self):
+        time.sleep(0.05)
+        return []
+
+
+def test_forged_batch_dropped():
+    store = CounterStore()
+    sync = CounterSync(store, _FailingTransport(), KEY)
+    sync.transport.receive = lambda: [encode_batch(b"\x43" * 32, b"\x01" * 16, [(UID1, 0xFFFFFF)]),
+                                      encode_batch(KEY, b"\x01" * 16, [(UID2, 7)])]
+
+    sync.receive()
+    assert store.get(UID1) is None
+    assert store.get(UID2) == 7
+    assert sync.stats()["rejected_batches"] == 1
+    assert sync.stats()["received_batches"] == 1
+
+
+def test_start_retried():
+    transport = _FailingTransport()
+    sync = CounterSync(CounterStore(), transport, KEY, interval=0.05, retry_base=0.05)
+
+    # doesn't raise, the transport is started in the background
+    sync.ensure_started()
+    assert sync.started.wait(5.0)
+    sync.ensure_started()
+    assert transport.attempts == 2
+    assert sync.stats()["start_failures"] == 1
+    sync.stop()
+
+
+def test_layout_validated():
+    for bind, peers, kwargs in ((("127.0.0.1", 7400), [], {"workers": 0}),
+                                (("127.0.0.1", 0), [], {"workers": 2}),
+                                (("127.0.0.1", 7400), [("127.0.0.1", 65535)], {"workers": 2}),
+                                (("127.0.0.1", 7400), [], {"workers": 2, "worker_count": lambda: 3})):
+        try:
+            UDPTransport(bind, peers, **kwargs)
+        except ValueError:
+            # this is expected
+            pass
+        else:
+            raise RuntimeError("ValueError was not thrown as expected")
+
+    UDPTransport(("127.0.0.1", 7400), [], workers=2, worker_count=lambda: 2)
+
+
+def _free_ports(count):
+    """
+    Find a free range of consecutive UDP ports.
+    """
+    while True:
+        probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        probe.bind(("127.0.0.1", 0))
+        base = probe.getsockname()[1]
+        probe.close()
+
+        if base + count > 65536:
+            continue
+
+        socks = []
+
+        try:
+            for port in range(base, base + count):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                socks.append(sock)
+                sock.bind(("127.0.0.1", port))
+        except OSError:
+            continue
+        finally:
+            for sock in socks:
+                sock.close()
+
+        return base
+
+
+def test_udp_workers_receive_on_own_ports():
+    node_a, node_b = _free_ports(2), _free_ports(2)
+    # two workers of node A, one (of two) workers of node B
+    worker_a0, _ = _make_node(UDPTransport(("127.0.0.1", node_a), [("127.0.0.1", node_b)], workers=2,
+                                           worker_index=lambda: 0))
+    worker_a1, _ = _make_node(UDPTransport(("127.0.0.1", node_a), [("127.0.0.1", node_b)], workers=2,
+                                           worker_index=lambda: 1))
+    worker_b0, _ = _make_node(UDPTransport(("127.0.0.1", node_b), [("127.0.0.1", node_a)], workers=2,
+                                           worker_index=lambda: 0))
+
+    # a peer update reaches every worker of the node
+    worker_b0.update(UID1, 10)
+    assert _wait_for(worker_a0, UID1, 10)
+    assert _wait_for(worker_a1, UID1, 10)
+
+    # and a local one the other workers of the same node as well as the peer
+    worker_a1.update(UID2, 20)
+    assert _wait_for(worker_a0, UID2, 20)
+    assert _wait_for(worker_b0, UID2, 20)
+
+
+def test_udp_worker_port_taken():
+    port = _free_ports(1)
+    _make_node(UDPTransport(("127.0.0.1", port), [], workers=2, worker_index=lambda: 0))
+    sync = CounterSync(CounterStore(), UDPTransport(("127.0.0.1", port), [], workers=2, worker_index=lambda: 0),
+                       KEY, retry_base=0.05)
+
+    # the port belongs to the other worker, the start is retried in the background
+    sync.ensure_started()
+    assert not sync.started.wait(0.5)
+    assert sync.stats()["start_failures"] >= 2
+    sync.stop()
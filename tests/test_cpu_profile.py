@@ -0,0 +1,81 @@
+import os
+import pstats
+
+from server.cpu_profile import CPUProfileMiddleware, SampledProfiler, collapsed_stacks
+
+
+def _leaf(n):
+    return sum(i * i for i in range(n))
+
+
+def _work():
+    return _leaf(20000) + _leaf(10000)
+
+
+def _app(environ, start_response):  # pylint: disable=unused-argument
+    _work()
+    start_response("200 OK", [])
+    return [b"ok"]
+
+
+def test_sample_every_nth_request(tmp_path):
+    profiler = SampledProfiler(every=3, paths=["/tag"], directory=str(tmp_path))
+    assert [profiler.should_sample(path) for path in ("/tag", "/", "/tag", "/tag", "/tag")] \
+        == [False, False, False, True, False]
+
+
+def test_profile_and_write(tmp_path):
+    ticks = iter([0.0, 1.0, 100.0, 100.0])
+    profiler = SampledProfiler(every=1, paths=["/api/tag"], directory=str(tmp_path), interval=60.0,
+                               clock=lambda: next(ticks, 100.0))
+    app = CPUProfileMiddleware(_app, profiler)
+
+    assert app({"PATH_INFO": "/api/tag"}, lambda status, headers, exc_info=None: None) == [b"ok"]
+    # interval not elapsed yet
+    assert os.listdir(tmp_path) == []
+
+    assert app({"PATH_INFO": "/api/tag"}, lambda status, headers, exc_info=None: None) == [b"ok"]
+    assert app({"PATH_INFO": "/"}, lambda status, headers, exc_info=None: None) == [b"ok"]
+    assert profiler.sampled == {"/api/tag": 2}
+
+    # written in the background, not by the request
+    assert profiler.writer.name == "cpu-profile-writer"
+    profiler.writer.join()
+
+    base = os.path.join(tmp_path, f"api_tag.{os.getpid()}")
+    assert sorted(os.listdir(tmp_path)) == [f"api_tag.{os.getpid()}.collapsed", f"api_tag.{os.getpid()}.pstats"]
+
+    # merged statistics of both requests
+    stats = pstats.Stats(base + ".pstats")
+    leaf = [value for func, value in stats.stats.items() if func[2] == "_leaf"][0]  # pylint: disable=no-member
+    assert leaf[1] == 4
+
+    with open(base + ".collapsed", "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+
+    stacks = {line.rsplit(" ", 1)[0]: int(line.rsplit(" ", 1)[1]) for line in lines}
+    assert all(value > 0 for value in stacks.values())
+    leaf_stacks = [stack for stack in stacks if stack.split(";")[-1].startswith("<genexpr> ")]
+    assert leaf_stacks
+    assert all("_app (test_cpu_profile.py:" in stack and ";_work (" in stack and ";_leaf (" in stack
+               for stack in leaf_stacks)
+
+
+def test_collapsed_stacks_split_by_caller():
+    class Stats:  # pylint: disable=too-few-public-methods
+        # func -> (primitive calls, calls, total time, cumulative time, callers)
+        stats = {
+            ("a.py", 1, "a"): (1, 1, 0.1, 1.0, {}),
+            ("b.py", 1, "b"): (1, 1, 0.1, 0.4, {("a.py", 1, "a"): (1, 1, 0.1, 0.4)}),
+            ("c.py", 1, "c"): (2, 2, 0.8, 0.8, {("a.py", 1, "a"): (1, 1, 0.5, 0.5),
+                                                ("b.py", 1, "b"): (1, 1, 0.3, 0.3)}),
+            # not reachable from any root
+            ("d.py", 1, "d"): (1, 2, 0.0, 0.0, {("d.py", 1, "d"): (1, 1, 0.0, 0.0)}),
+        }
+
+    result = collapsed_stacks(Stats())
+    assert set(result) == {"a (a.py:1)", "a (a.py:1);b (b.py:1)", "a (a.py:1);c (c.py:1)",
+                           "a (a.py:1);b (b.py:1);c (c.py:1)"}
+    assert abs(result["a (a.py:1);c (c.py:1)"] - 0.5) < 1e-9
+    assert abs(result["a (a.py:1);b (b.py:1);c (c.py:1)"] - 0.3) < 1e-9
+    assert abs(sum(result.values()) - 1.0) < 1e-9
@@ -0,0 +1,100 @@
+# pylint: disable=line-too-long
+
+import binascii
+
+from Crypto.Cipher import AES
+
+from libsdm import derive, legacy_derive
+from libsdm.encoder import (
+    TagSimulator,
+    encode_sun_message,
+    encrypt_file_data,
+    encrypt_picc_data,
+    format_query,
+    generate_sun_messages,
+)
+from libsdm.lrp import LRP
+from libsdm.sdm import EncMode, ParamMode, decrypt_sun_message, validate_plain_sun
+
+ZERO_KEY = b"\x00" * 16
+MASTER_KEY = binascii.unhexlify("C9EB67DF090AFF47C3B19A2516680B9D")
+
+
+def _verify(message, param_mode, master_key=MASTER_KEY, derive_module=derive):
+    return decrypt_sun_message(param_mode=param_mode,
+                               sdm_meta_read_key=derive_module.derive_undiversified_key(master_key, 1),
+                               sdm_file_read_key=lambda uid: derive_module.derive_tag_key(master_key, uid, 2),
+                               picc_enc_data=message['picc_enc_data'],
+                               sdmmac=message['sdmmac'],
+                               enc_file_data=message['enc_file_data'],
+                               sdmmac_param="cmac")
+
+
+def test_picc_data_vectors():
+    # AN12196 page 12 (AES), PICCRand and padding taken from the vectors
+    picc_enc_data = binascii.unhexlify("EF963FF7828658A599F3041510671E88")
+    padding = AES.new(ZERO_KEY, AES.MODE_CBC, IV=b"\x00" * 16).decrypt(picc_enc_data)[11:]
+    assert encrypt_picc_data(EncMode.AES, ZERO_KEY, binascii.unhexlify("04DE5F1EACC040"), 61,
+                             rand=lambda _: padding) == picc_enc_data
+
+    picc_enc_data = binascii.unhexlify("1FCBE61B3E4CAD980CBFDD333E7A4AC4A579569BAFD22C5F")
+    padding = LRP(ZERO_KEY, 0, picc_enc_data[:8], pad=False).decrypt(picc_enc_data[8:])[11:]
+    rand = iter([padding, picc_enc_data[:8]])
+    assert encrypt_picc_data(EncMode.LRP, ZERO_KEY, binascii.unhexlify("04940E2A2F7080"), 3,
+                             rand=lambda _: next(rand)) == picc_enc_data
+
+
+def test_file_data_vectors():
+    assert encrypt_file_data(EncMode.AES, ZERO_KEY, binascii.unhexlify("04958CAA5C5E80"), 8, b"xxxxxxxxxxxxxxxx") \
+        == binascii.unhexlify("CEE9A53E3E463EF1F459635736738962")
+    assert encrypt_file_data(EncMode.LRP, ZERO_KEY, binascii.unhexlify("049B112A2F7080"), 4, b"NTXXb7dz3PsYYBlU") \
+        == binascii.unhexlify("D6E921C47DB4C17C56F979F81559BB83")
+
+
+def test_roundtrip():
+    uid = binascii.unhexlify("04A1B2C3D4E5F6")
+
+    for derive_mode, derive_module in (("standard", derive), ("legacy", legacy_derive)):
+        for mode in (EncMode.AES, EncMode.LRP):
+            tag = TagSimulator(MASTER_KEY, uid, derive_mode=derive_mode, read_ctr=99, mode=mode, sdmmac_param="cmac")
+
+            for param_mode in (ParamMode.SEPARATED, ParamMode.BULK):
+                for file_data in (None, b"CC\x04aaaaEEEEEEEEE" * 2):
+                    res = _verify(tag.tap(param_mode, file_data), param_mode, derive_module=derive_module)
+                    assert res['uid'] == uid
+                    assert res['read_ctr'] == tag.read_ctr
+                    assert res['encryption_mode'] == mode
+                    assert res['file_data'] == file_data
+
+    tag = TagSimulator(MASTER_KEY, uid)
+    message = tag.tap_plain()
+    assert format_query(message) == f"uid=04A1B2C3D4E5F6&ctr=000001&cmac={message['sdmmac'].hex().upper()}"
+    assert validate_plain_sun(uid, message['read_ctr'], message['sdmmac'],
+                              derive.derive_tag_key(MASTER_KEY, uid, 2))['read_ctr'] == 1
+
+
+def test_format_query():
+    message = encode_sun_message(ParamMode.SEPARATED, ZERO_KEY, ZERO_KEY, binascii.unhexlify("04958CAA5C5E80"), 8,
+                                 file_data=b"xxxxxxxxxxxxxxxx", sdmmac_param="cmac")
+    query = format_query(message, enc_picc_data_param="picc_data", enc_file_data_param="enc", sdmmac_param="cmac")
+    assert query.startswith(f"picc_data={message['picc_enc_data'].hex().upper()}&enc=CEE9A53E3E463EF1F459635736738962&cmac=")
+    assert query.endswith("cmac=ECC1E7F6C6C73BF6")
+
+    message = encode_sun_message(ParamMode.BULK, ZERO_KEY, ZERO_KEY, binascii.unhexlify("04958CAA5C5E80"), 8)
+    assert format_query(message, ParamMode.BULK) == "e=" + (message['picc_enc_data'] + message['sdmmac']).hex().upper()
+
+
+def test_generate_sun_messages():
+    uids = [bytes([4, 0, 0, 0, 0, 0, i]) for i in range(5)]
+
+    for processes in (1, 2):
+        messages = list(generate_sun_messages(MASTER_KEY, uids, taps=3, start_ctr=10, param_mode=ParamMode.BULK,
+                                              sdmmac_param="cmac", processes=processes))
+        assert [(message['uid'], message['read_ctr']) for message in messages] \
+            == [(uid, ctr) for uid in uids for ctr in (10, 11, 12)]
+
+        for message in messages:
+            assert _verify(message, ParamMode.BULK)['read_ctr'] == message['read_ctr']
+
+    plain = list(generate_sun_messages(MASTER_KEY, uids[:1], taps=2, plain=True, processes=1))
+    assert [message['read_ctr'] for message in plain] == [b"\x00\x00\x01", b"\x00\x00\x02"]
@@ -0,0 +1,68 @@
+import csv
+import io
+import json
+import os
+
+from server.event_log import HEADER, RECORD, EventLog, EventLogReader, export, main
+
+UID = bytes.fromhex("04A1B2C3D4E5F6")
+
+
+def test_write_and_scan(tmp_path):
+    log = EventLog(str(tmp_path), segment_records=4, batch_records=3, flush_interval=3600.0)
+
+    for i in range(10):
+        log.record("tagtt" if i % 2 else "tag", "ok", uid=UID, read_ctr=i, encryption_mode="AES",
+                   tt_status="secure" if i % 2 else "", timestamp=1700000000000000 + i)
+
+    # 9 records were flushed in batches of 3 into segments of 4 records
+    reader = EventLogReader(str(tmp_path))
+    assert reader.count() == 9
+    assert [os.path.getsize(path) for path in reader.segments()] == [HEADER.size + 4 * RECORD.size] * 2 \
+        + [HEADER.size + RECORD.size]
+
+    log.record("tagpt", "invalid", uid=UID[:4], read_ctr=None, timestamp=1700000000000010)
+    log.record("tag", "replayed", timestamp=1700000000000011)
+    log.flush()
+
+    events = list(reader.scan())
+    assert [event.read_ctr for event in events] == list(range(10)) + [None, None]
+    assert events[1].route == "tagtt" and events[1].tt_status == "secure" and events[1].encryption_mode == "AES"
+    assert events[10].uid == UID[:4] and events[10].outcome == "invalid" and events[10].encryption_mode == ""
+    assert events[11].uid == b""
+
+    assert [event.read_ctr for event in reader.scan(since=1700000000000003, until=1700000000000006)] == [3, 4, 5]
+    assert [event.read_ctr for event in reader.scan(routes=["tagtt"])] == [1, 3, 5, 7, 9]
+    assert [event.outcome for event in reader.scan(outcomes=["invalid", "replayed"])] == ["invalid", "replayed"]
+    assert len(list(reader.scan(uid=UID))) == 10
+
+    # stopping early releases the mapping
+    assert next(reader.scan()).read_ctr == 0
+
+
+def test_partial_record_ignored(tmp_path):
+    log = EventLog(str(tmp_path), batch_records=1)
+    log.record("tag", "ok", uid=UID, read_ctr=1)
+    path = EventLogReader(str(tmp_path)).segments()[0]
+
+    with open(path, "ab") as f:
+        f.write(b"\x01\x02\x03")
+
+    assert [event.read_ctr for event in EventLogReader(str(tmp_path)).scan()] == [1]
+
+
+def test_export(tmp_path, capsys):
+    log = EventLog(str(tmp_path), batch_records=1)
+    log.record("tag", "ok", uid=UID, read_ctr=5, encryption_mode="LRP", timestamp=1700000000000000)
+
+    out = io.StringIO()
+    export(EventLogReader(str(tmp_path)).scan(), out, "csv")
+    rows = list(csv.DictReader(io.StringIO(out.getvalue())))
+    assert rows == [{"timestamp": "2023-11-14T22:13:20.000000+00:00", "read_ctr": "5", "uid": UID.hex().upper(),
+                     "encryption_mode": "LRP", "route": "tag", "tt_status": "", "outcome": "ok"}]
+
+    assert main([str(tmp_path), "--since", "2023-11-14T22:13:20", "--uid", UID.hex()]) == 0
+    assert json.loads(capsys.readouterr().out)["read_ctr"] == 5
+
+    assert main([str(tmp_path), "--since", "2023-11-15", "--count"]) == 0
+    assert capsys.readouterr().out == "0\n"
@@ -0,0 +1,218 @@
+import json
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from server.event_sink import EventSink, HTTPTransport, SinkStats, UnixSocketTransport
+
+
+def _wait_for(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+
+        time.sleep(0.02)
+
+    return False
+
+
+def _unix_server(path, received):
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def serve():
+        conn, _ = server.accept()
+
+        with conn:
+            buffer = b""
+
+            while True:
+                data = conn.recv(65536)
+
+                if not data:
+                    return
+
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                received.extend(json.loads(line) for line in lines)
+
+    threading.Thread(target=serve, daemon=True).start()
+    return server
+
+
+def test_unix_socket_delivery(tmp_path):
+    path = str(tmp_path / "events.sock")
+    received = []
+    server = _unix_server(path, received)
+    stats = SinkStats(str(tmp_path / "stats"))
+    sink = EventSink(UnixSocketTransport(path), batch_size=2, flush_interval=0.05, stats=stats)
+
+    for read_ctr in range(1, 6):
+        sink.enqueue({"uid": "04DE5F1EACC040", "read_ctr": read_ctr})
+
+    assert _wait_for(lambda: len(received) == 5)
+    assert [event["read_ctr"] for event in received] == [1, 2, 3, 4, 5]
+    assert all("timestamp" in event for event in received)
+
+    assert _wait_for(lambda: stats.collect()["delivered"] == 5)
+    values = stats.collect()
+    assert values["enqueued"] == 5
+    assert values["lag_count"] == 5
+    assert values["dropped"] == 0
+    assert 'sdm_event_sink_events_total{state="delivered"} 5' in stats.render()
+    server.close()
+
+
+def test_drop_when_full(tmp_path):
+    stats = SinkStats(str(tmp_path / "stats"))
+    sink = EventSink(UnixSocketTransport(str(tmp_path / "missing.sock")), max_queue=2, batch_size=100,
+                     flush_interval=10.0, max_retries=0, stats=stats)
+
+    for read_ctr in range(10):
+        sink.enqueue({"read_ctr": read_ctr})
+
+    values = stats.collect()
+    assert values["enqueued"] == 2
+    assert values["dropped"] == 8
+    assert values["queue_depth"] == 2
+
+    sink.flush()
+    values = stats.collect()
+    assert values["dropped"] == 10
+    assert values["failed_batches"] == 1
+    assert values["queue_depth"] == 0
+
+
+def test_spill_and_replay(tmp_path):
+    path = str(tmp_path / "events.sock")
+    stats = SinkStats(str(tmp_path / "stats"))
+    delays = []
+    sink = EventSink(UnixSocketTransport(path), batch_size=2, flush_interval=0.05, overflow="spill",
+                     spill_dir=str(tmp_path / "spill"), max_retries=3, retry_base=0.1, retry_max=0.25,
+                     stats=stats, rand=lambda: 1.0, sleep=delays.append)
+
+    for read_ctr in range(1, 4):
+        sink.enqueue({"read_ctr": read_ctr})
+
+    assert _wait_for(lambda: stats.collect()["spilled"] == 3)
+    assert delays[:3] == [0.1, 0.2, 0.25]
+
+    received = []
+    server = _unix_server(path, received)
+    sink.enqueue({"read_ctr": 4})
+
+    assert _wait_for(lambda: len(received) == 4)
+    assert sorted(event["read_ctr"] for event in received) == [1, 2, 3, 4]
+    assert not list((tmp_path / "spill").iterdir())
+    server.close()
+
+
+def test_replay_without_new_events(tmp_path):
+    path = str(tmp_path / "events.sock")
+    stats = SinkStats(str(tmp_path / "stats"))
+    sink = EventSink(UnixSocketTransport(path), batch_size=2, flush_interval=0.05, overflow="spill",
+                     spill_dir=str(tmp_path / "spill"), max_retries=1, retry_base=0.05, retry_max=0.2,
+                     stats=stats, sleep=lambda delay: None)
+
+    for read_ctr in range(1, 4):
+        sink.enqueue({"read_ctr": read_ctr})
+
+    assert _wait_for(lambda: stats.collect()["spilled"] == 3)
+    assert not sink.healthy
+
+    # the sink recovers, but there are no more scans
+    received = []
+    server = _unix_server(path, received)
+
+    assert _wait_for(lambda: len(received) == 3)
+    assert sorted(event["read_ctr"] for event in received) == [1, 2, 3]
+    assert _wait_for(lambda: not list((tmp_path / "spill").iterdir()))
+    assert sink.healthy
+    server.close()
+
+
+def test_http_retry(tmp_path):
+    received = []
+    statuses = [503]
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):  # pylint: disable=invalid-name
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            status = statuses.pop() if statuses else 204
+
+            if status == 204:
+                received.extend(json.loads(line) for line in body.splitlines())
+
+            self.send_response(status)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = HTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    stats = SinkStats(str(tmp_path / "stats"))
+    sink = EventSink(HTTPTransport(f"http://127.0.0.1:{server.server_port}/events"), batch_size=1,
+                     flush_interval=0.05, stats=stats, sleep=lambda delay: None)
+
+    sink.enqueue({"read_ctr": 1})
+
+    assert _wait_for(lambda: len(received) == 1)
+    assert _wait_for(lambda: stats.collect()["delivered"] == 1)
+    assert stats.collect()["retries"] == 1
+    server.shutdown()
+
+
+def test_http_garbage_response(tmp_path):
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(8)
+
+    def serve():
+        while True:
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return
+
+            with conn:
+                conn.recv(65536)
+                conn.sendall(b"garbage\r\n\r\n")
+
+    threading.Thread(target=serve, daemon=True).start()
+    stats = SinkStats(str(tmp_path / "stats"))
+    sink = EventSink(HTTPTransport(f"http://127.0.0.1:{server.getsockname()[1]}/events"), batch_size=1,
+                     flush_interval=0.05, max_retries=1, stats=stats, sleep=lambda delay: None)
+
+    sink.enqueue({"read_ctr": 1})
+    assert _wait_for(lambda: stats.collect()["failed_batches"] == 1)
+
+    # the delivery thread is still running
+    sink.enqueue({"read_ctr": 2})
+    assert _wait_for(lambda: stats.collect()["failed_batches"] == 2)
+    assert stats.collect()["dropped"] == 2
+    server.close()
+
+
+class _BrokenTransport:
+    def send(self, payload):
+        raise ValueError("unexpected")
+
+    def close(self):
+        pass
+
+
+def test_unexpected_error(tmp_path):
+    stats = SinkStats(str(tmp_path / "stats"))
+    sink = EventSink(_BrokenTransport(), batch_size=1, flush_interval=0.05, stats=stats, sleep=lambda delay: None)
+
+    sink.enqueue({"read_ctr": 1})
+    assert _wait_for(lambda: stats.collect()["failed_batches"] == 1)
+    sink.enqueue({"read_ctr": 2})
+    assert _wait_for(lambda: stats.collect()["failed_batches"] == 2)
+    assert stats.collect()["dropped"] == 2
@@ -0,0 +1,63 @@
+import random
+
+from server.heavy_hitters import CountMinSketch, HeavyHitters, TopK
+from tests.clock import FakeClock
+
+
+def _uid(i):
+    return b"\x04" + i.to_bytes(6, 'big')
+
+
+def test_count_min_sketch_overestimates():
+    sketch = CountMinSketch(width=256, depth=4)
+    counts = {}
+    rand = random.Random(1)
+
+    for _ in range(5000):
+        uid = _uid(rand.randrange(2000))
+        counts[uid] = counts.get(uid, 0) + 1
+        sketch.add(sketch.indexes(uid))
+
+    for uid, count in counts.items():
+        estimate = sketch.estimate(sketch.indexes(uid))
+        assert count <= estimate <= count + 2 * 5000 / 256
+
+
+def test_top_k():
+    top = TopK(2)
+
+    for uid, count in ((b"a", 1), (b"b", 2), (b"c", 3), (b"a", 4), (b"d", 1)):
+        top.offer(uid, count)
+
+    assert top.items() == [(b"a", 4), (b"c", 3)]
+
+
+def test_heavy_hitters():
+    clock = FakeClock(1700000000.0)
+    hitters = HeavyHitters(k=5, width=1024, depth=4, half_life=60.0, slots=1024, clock=clock)
+    rand = random.Random(2)
+
+    # steady background, one frequently scanned tag
+    for i in range(3000):
+        hitters.observe(_uid(rand.randrange(1000)), i)
+        hitters.observe(_uid(5000), i)
+
+    report = hitters.report(top=3)
+    assert report["scans"] == 6000
+    assert report["top"][0]["uid"] == _uid(5000).hex().upper()
+    assert report["top"][0]["scans"] >= 3000
+    assert report["top"][0]["last_read_ctr"] == 2999
+    assert len(report["top"]) == 3
+
+    # an hour later, another tag suddenly gets a burst of scans
+    clock.now += 3600
+
+    for i in range(200):
+        hitters.observe(_uid(6000), 10 + i)
+
+    report = hitters.report(top=3)
+    assert report["top"][0]["uid"] == _uid(5000).hex().upper()
+    assert report["hot"][0]["uid"] == _uid(6000).hex().upper()
+    assert report["hot"][0]["recent_scans"] >= 200
+    assert report["hot"][0]["last_read_ctr"] == 209
+    assert report["hot"][0]["last_seen"].startswith("2023-11-14T23:13:20")
@@ -0,0 +1,75 @@
+from libsdm.stages import StageRecorder, stage
+from server.instrument import Instrumentation, InstrumentMiddleware, server_timing
+
+
+def _app(environ, start_response):  # pylint: disable=unused-argument
+    with stage("mac"):
+        pass
+
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"ok"]
+
+
+def _get(app, path):
+    seen = {}
+
+    def start_response(status, headers, exc_info=None):  # pylint: disable=unused-argument
+        seen.update(headers)
+
+    body = b"".join(app({"PATH_INFO": path}, start_response))
+    return body, seen
+
+
+def test_server_timing_format():
+    ticks = iter(range(100))
+    recorder = StageRecorder(clock=lambda: next(ticks) / 1000)
+
+    with recorder.stage("derive"):
+        pass
+
+    with recorder.stage("derive"):
+        pass
+
+    assert server_timing(recorder, "/tag") == [("Server-Timing", "derive;dur=2.000, total;dur=5.000")]
+
+
+def test_middleware():
+    instrumentation = Instrumentation(paths=["/tag"])
+    app = InstrumentMiddleware(_app, instrumentation)
+
+    # no observers, nothing recorded
+    assert "Server-Timing" not in _get(app, "/tag")[1]
+
+    instrumentation.add_observer(server_timing)
+    body, headers = _get(app, "/tag")
+    assert body == b"ok"
+    assert headers["Server-Timing"].startswith("mac;dur=")
+    assert "Server-Timing" not in _get(app, "/")[1]
+
+
+def test_error_outcome():
+    labels = []
+    instrumentation = Instrumentation(paths=["/tag"])
+    instrumentation.add_observer(lambda recorder, path: labels.append(dict(recorder.labels)) or [])
+
+    def failing_app(environ, start_response):  # pylint: disable=unused-argument
+        with stage("mac"):
+            raise RuntimeError("Failed")
+
+    def unavailable_app(environ, start_response):  # pylint: disable=unused-argument
+        start_response("503 SERVICE UNAVAILABLE", [("Content-Type", "text/plain")])
+        return [b"busy"]
+
+    _get(InstrumentMiddleware(_app, instrumentation), "/tag")
+    _get(InstrumentMiddleware(unavailable_app, instrumentation), "/tag")
+
+    try:
+        _get(InstrumentMiddleware(failing_app, instrumentation), "/tag")
+    except RuntimeError:
+        # this is expected
+        pass
+    else:
+        raise RuntimeError("RuntimeError was not thrown as expected")
+
+    assert [item.get("outcome") for item in labels] == [None, "error", "error"]
+    assert labels[1]["status"] == "503"
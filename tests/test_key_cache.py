@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+from server.key_cache import STRIPE_SLOTS, SharedKeyCache
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def _key(i):
+    return b"key" + i.to_bytes(4, 'big')
+
+
+def _value(i):
+    return i.to_bytes(16, 'big')
+
+
+def test_get_put(tmp_path):
+    cache = SharedKeyCache("test", slots=1024, directory=str(tmp_path))
+
+    assert cache.get(_key(1)) is None
+    cache.put(_key(1), _value(1))
+    cache.put(_key(2), _value(2))
+    assert cache.get(_key(1)) == _value(1)
+    assert cache.get(_key(2)) == _value(2)
+
+    cache.put(_key(1), _value(3))
+    assert cache.get(_key(1)) == _value(3)
+
+    # same file, e.g. after a restart
+    assert SharedKeyCache("test", slots=1024, directory=str(tmp_path)).get(_key(2)) == _value(2)
+    # different layout, starts empty
+    assert SharedKeyCache("test", slots=2048, directory=str(tmp_path)).get(_key(2)) is None
+
+
+def test_clock_eviction(tmp_path):
+    # a single stripe
+    cache = SharedKeyCache("test", slots=STRIPE_SLOTS, directory=str(tmp_path))
+    cache.put(b"hot", _value(0))
+
+    for i in range(1, 1000):
+        cache.put(_key(i), _value(i))
+        # recently used entries survive the clock sweeps
+        assert cache.get(b"hot") == _value(0)
+
+    found = 0
+
+    for i in range(1, 1000):
+        value = cache.get(_key(i))
+
+        if value is not None:
+            assert value == _value(i)
+            found += 1
+
+    assert 0 < found < STRIPE_SLOTS
+    assert cache.get(_key(999)) == _value(999)
+
+
+def _fill(cache, start, count):
+    for i in range(start, start + count):
+        cache.put(_key(i), _value(i))
+
+
+def test_shared_between_processes(tmp_path):
+    cache = SharedKeyCache("test", slots=4096, directory=str(tmp_path))
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_fill, args=(cache, index * 100, 100)) for index in range(4)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    assert all(cache.get(_key(i)) == _value(i) for i in range(400))
+
+
+def test_temporary_directory_removed():
+    # the forked child exits first, the directory is removed only by the process which created it
+    script = ("import os, sys\n"
+              "from server.key_cache import SharedKeyCache\n"
+              "cache = SharedKeyCache('test', slots=64)\n"
+              "print(cache.directory)\n"
+              "sys.stdout.flush()\n"
+              "pid = os.fork()\n"
+              "if pid == 0:\n"
+              "    sys.exit(0)\n"
+              "os.waitpid(pid, 0)\n"
+              "assert os.path.isdir(cache.directory)\n")
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, check=True, capture_output=True, text=True)
+    directory = output.stdout.strip()
+
+    assert directory and not os.path.exists(directory)
@@ -0,0 +1,149 @@
+import binascii
+import time
+
+from Crypto.Cipher import AES
+
+from libsdm import derive
+from libsdm.sdm import (
+    ImplausiblePICCData,
+    InvalidMessage,
+    ParamMode,
+    calculate_plain_sdmmac,
+    calculate_sdmmac,
+    decrypt_sun_message,
+    picc_data_plausible,
+)
+from server.key_cache import SharedKeyCache
+from server.key_ring import KeyRing
+
+OLD_KEY = binascii.unhexlify("00112233445566778899AABBCCDDEEFF")
+NEW_KEY = binascii.unhexlify("FFEEDDCCBBAA99887766554433221100")
+UID = binascii.unhexlify("04DE5F1EACC040")
+DUMMY_UID = b"\x00" * 7
+
+
+def _counting_derive():
+    calls = []
+
+    def derive_tag_key(master_key, uid, key_no):
+        calls.append((master_key, uid))
+        return derive.derive_tag_key(master_key, uid, key_no)
+
+    return derive_tag_key, calls
+
+
+def _wait_for_key(ring, index, uid, timeout=10.0):
+    deadline = time.monotonic() + timeout
+
+    while (index, uid) not in ring.file_keys:
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def _sun_message(master_key, read_ctr):
+    picc_data = UID + read_ctr.to_bytes(3, 'little')
+    cipher = AES.new(derive.derive_undiversified_key(master_key, 1), AES.MODE_CBC, IV=b"\x00" * 16)
+    picc_enc_data = cipher.encrypt(b"\xC7" + picc_data + b"\x00" * 5)
+    sdmmac = calculate_sdmmac(ParamMode.SEPARATED, derive.derive_tag_key(master_key, UID, 2), picc_data)
+    return {"param_mode": ParamMode.SEPARATED, "picc_enc_data": picc_enc_data, "sdmmac": sdmmac}
+
+
+def test_picc_data_plausible():
+    assert picc_data_plausible(0xC7)
+    assert picc_data_plausible(0x87)
+    assert not picc_data_plausible(0x47)
+    assert not picc_data_plausible(0xE7)
+    assert not picc_data_plausible(0xC4)
+    assert sum(picc_data_plausible(tag) for tag in range(256)) == 2
+
+
+def test_rotation_sun():
+    derive_tag_key, calls = _counting_derive()
+    ring = KeyRing([NEW_KEY, OLD_KEY], derive_tag_key, derive.derive_undiversified_key)
+
+    res = ring.decrypt_sun_message(**_sun_message(OLD_KEY, 10))
+    assert res['uid'] == UID and res['read_ctr'] == 10
+    # the old key is tried first from now on
+    assert ring.order() == [1, 0]
+    assert ring.order(UID) == [1, 0]
+    # the key for the new master key is derived in the background
+    _wait_for_key(ring, 0, UID)
+
+    res = ring.decrypt_sun_message(**_sun_message(NEW_KEY, 11))
+    assert res['read_ctr'] == 11
+    assert ring.order() == [0, 1]
+
+    try:
+        ring.decrypt_sun_message(**dict(_sun_message(NEW_KEY, 12), sdmmac=b"\x00" * 8))
+    except InvalidMessage as err:
+        assert "invalid MAC" in str(err)
+    else:
+        raise RuntimeError("Expected exception.")
+
+    # each UID-diversified key was derived only once (including the keys of the dummy UID of the fake MAC calculation)
+    assert sorted(calls) == sorted([(OLD_KEY, UID), (NEW_KEY, UID), (OLD_KEY, DUMMY_UID), (NEW_KEY, DUMMY_UID)])
+
+
+def test_implausible_picc_data_constant_work():
+    message = _sun_message(OLD_KEY, 10)
+    derived = []
+
+    def sdm_file_read_key(uid):
+        derived.append(uid)
+        return derive.derive_tag_key(NEW_KEY, uid, 2)
+
+    try:
+        decrypt_sun_message(sdm_meta_read_key=derive.derive_undiversified_key(NEW_KEY, 1),
+                            sdm_file_read_key=sdm_file_read_key,
+                            check_picc_data_tag=True,
+                            **message)
+    except ImplausiblePICCData:
+        # this is expected
+        pass
+    else:
+        raise RuntimeError("ImplausiblePICCData was not thrown as expected")
+
+    # the wrong key is rejected after the same fake MAC calculation as a message with unsupported UID length
+    assert derived == [DUMMY_UID]
+
+
+def test_rotation_plain():
+    derive_tag_key, calls = _counting_derive()
+    ring = KeyRing([NEW_KEY, OLD_KEY], derive_tag_key, derive.derive_undiversified_key)
+    read_ctr = (5).to_bytes(3, 'big')
+    sdmmac = calculate_plain_sdmmac(UID, read_ctr, derive.derive_tag_key(OLD_KEY, UID, 2))
+
+    assert ring.validate_plain_sun(UID, read_ctr, sdmmac)['read_ctr'] == 5
+    assert ring.order(UID) == [1, 0]
+    assert ring.preferred_file_key(UID) == derive.derive_tag_key(OLD_KEY, UID, 2)
+    _wait_for_key(ring, 0, UID)
+
+    try:
+        ring.validate_plain_sun(UID, read_ctr, b"\x00" * 8)
+    except InvalidMessage:
+        pass
+    else:
+        raise RuntimeError("Expected exception.")
+
+    assert len(calls) == 2
+
+
+def test_shared_cache(tmp_path):
+    derive_tag_key, calls = _counting_derive()
+    cache = SharedKeyCache("test", slots=1024, directory=str(tmp_path))
+    # e.g. two worker processes
+    first = KeyRing([NEW_KEY, OLD_KEY], derive_tag_key, derive.derive_undiversified_key, shared_cache=cache,
+                    namespace=b"standard")
+    second = KeyRing([OLD_KEY], derive_tag_key, derive.derive_undiversified_key, shared_cache=cache,
+                     namespace=b"standard")
+
+    assert first.file_key(1, UID) == derive.derive_tag_key(OLD_KEY, UID, 2)
+    assert second.file_key(0, UID) == derive.derive_tag_key(OLD_KEY, UID, 2)
+    assert len(calls) == 1
+    assert second.stats()["shared_cache_hits"] == 1
+
+    # other derivation method with the same master key
+    legacy = KeyRing([OLD_KEY], derive_tag_key, derive.derive_undiversified_key, shared_cache=cache,
+                     namespace=b"legacy")
+    legacy.file_key(0, UID)
+    assert len(calls) == 2
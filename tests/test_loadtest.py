@@ -0,0 +1,86 @@
+import argparse
+import binascii
+import random
+import struct
+from urllib.parse import parse_qs
+
+from benchmarks.loadtest import FILE_DATA, _run_threads, _Tags, parse_mix
+from libsdm import derive
+from libsdm.sdm import EncMode, ParamMode, decrypt_sun_message, validate_plain_sun
+
+MASTER_KEY = binascii.unhexlify("00112233445566778899AABBCCDDEEFF")
+PARAMS = {"picc_data": "picc_data", "enc": "enc", "sdmmac": "cmac", "uid": "uid", "ctr": "ctr"}
+
+
+def _decrypt(query, param_mode):
+    args = {key: binascii.unhexlify(value[0]) for key, value in parse_qs(query).items()}
+
+    if param_mode == ParamMode.BULK:
+        e = args["e"]
+        picc_len = 16 if (len(e) - 8) % 16 == 0 else 24
+        picc_enc_data, enc_file_data, sdmmac = e[:picc_len], e[picc_len:-8] or None, e[-8:]
+    else:
+        picc_enc_data, enc_file_data, sdmmac = args["picc_data"], args.get("enc"), args["cmac"]
+
+    return decrypt_sun_message(param_mode=param_mode,
+                               sdm_meta_read_key=derive.derive_undiversified_key(MASTER_KEY, 1),
+                               sdm_file_read_key=lambda uid: derive.derive_tag_key(MASTER_KEY, uid, 2),
+                               picc_enc_data=picc_enc_data,
+                               sdmmac=sdmmac,
+                               enc_file_data=enc_file_data,
+                               sdmmac_param="cmac")
+
+
+def test_messages_verify():
+    uid = binascii.unhexlify("04A1B2C3D4E5F6")
+    tags = _Tags(MASTER_KEY, "standard", [uid], "cmac")
+    rand = random.Random(1)
+    expected_ctr = 0
+
+    for mode in (EncMode.AES, EncMode.LRP):
+        for param_mode in (ParamMode.SEPARATED, ParamMode.BULK):
+            for route in ("tag", "tagtt"):
+                expected_ctr += 1
+                res = _decrypt(tags.message(route, mode, param_mode, rand, PARAMS), param_mode)
+                assert res["uid"] == uid
+                assert res["read_ctr"] == expected_ctr
+                assert res["encryption_mode"] == mode
+                assert res["file_data"] == (FILE_DATA if route == "tagtt" else None)
+
+    args = parse_qs(tags.message("tagpt", EncMode.AES, ParamMode.SEPARATED, rand, PARAMS))
+    res = validate_plain_sun(uid=binascii.unhexlify(args["uid"][0]),
+                             read_ctr=binascii.unhexlify(args["ctr"][0]),
+                             sdmmac=binascii.unhexlify(args["cmac"][0]),
+                             sdm_file_read_key=derive.derive_tag_key(MASTER_KEY, uid, 2))
+    assert res["read_ctr"] == expected_ctr + 1
+    assert struct.pack(">I", res["read_ctr"])[1:] == binascii.unhexlify(args["ctr"][0])
+
+
+def test_parse_mix():
+    assert parse_mix("tag=5,tagtt=2,tagpt") == {"tag": 5.0, "tagtt": 2.0, "tagpt": 1.0}
+
+    try:
+        parse_mix("tag=1,unknown=2")
+    except argparse.ArgumentTypeError:
+        # this is expected
+        pass
+    else:
+        raise RuntimeError("ArgumentTypeError was not thrown as expected")
+
+
+def test_error_responses_counted():
+    responses = {
+        "/api/ok": ("200 OK", b'{"uid": "04A1B2C3D4E5F6"}'),
+        "/api/rejected": ("200 OK", b'{"error": "Message is not properly signed - invalid MAC"}'),
+        "/api/missing": ("404 NOT FOUND", b'{"error": "Not found"}'),
+    }
+
+    def application(environ, start_response):
+        status, body = responses[environ["PATH_INFO"]]
+        start_response(status, [("Content-Type", "application/json")])
+        return [body]
+
+    result = _run_threads(application, [[("/api/ok", ""), ("/api/rejected", "")],
+                                        [("/api/missing", ""), ("/api/rejected", ""), ("/api/ok", "")]])
+    assert len(result["latencies"]) == 5
+    assert result["errors"] == {"Message is not properly signed - invalid MAC": 2, "404 NOT FOUND": 1}
@@ -0,0 +1,82 @@
+import binascii
+
+from libsdm import derive
+from libsdm.sdm import calculate_plain_sdmmac
+from server.key_ring import KeyRing
+from server.mac_precompute import MacPrecomputer
+from server.metrics import ProcessValues
+
+UID = binascii.unhexlify('041E3C8A2D6B80')
+
+
+def _precomputer(**kwargs):
+    return MacPrecomputer(derive_key=lambda uid, key_index: b"\x00" * 16,
+                          calculate_mac=calculate_plain_sdmmac,
+                          **kwargs)
+
+
+def test_plain_sdmmac():
+    assert calculate_plain_sdmmac(UID, binascii.unhexlify('000006'), b"\x00" * 16) \
+           == binascii.unhexlify('4B00064004B0B3D3')
+
+
+def test_precompute_hit():
+    precomputer = _precomputer(depth=4)
+    precomputer.precompute(UID, 5)
+
+    assert precomputer.verify(UID, binascii.unhexlify('000006'), binascii.unhexlify('4B00064004B0B3D3')) == 0
+    # consumed by the previous lookup
+    assert precomputer.verify(UID, binascii.unhexlify('000006'), binascii.unhexlify('4B00064004B0B3D3')) is None
+    # doesn't match, left to the live verification (the entry may be stale)
+    assert precomputer.verify(UID, binascii.unhexlify('000007'), binascii.unhexlify('4B00064004B0B3D3')) is None
+    assert precomputer.verify(UID, binascii.unhexlify('00000A'), binascii.unhexlify('4B00064004B0B3D3')) is None
+
+    stats = precomputer.stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 2
+    assert stats['mismatches'] == 1
+    assert stats['size'] == 3
+
+
+def test_precompute_bounded():
+    precomputer = _precomputer(depth=4, max_entries=6)
+    precomputer.precompute(UID, 0)
+    precomputer.precompute(UID, 100)
+
+    assert precomputer.stats()['size'] == 6
+    assert precomputer.verify(UID, (101).to_bytes(3, 'big'), b"\x00" * 8) is None
+    assert precomputer.stats()['mismatches'] == 1
+
+
+def test_precompute_counters(tmp_path):
+    precomputer = _precomputer(depth=4)
+    precomputer.counters = ProcessValues("mac_precompute_0", ("hits", "misses", "mismatches"), directory=str(tmp_path))
+    precomputer.precompute(UID, 5)
+
+    precomputer.verify(UID, binascii.unhexlify('000006'), binascii.unhexlify('4B00064004B0B3D3'))
+    precomputer.verify(UID, binascii.unhexlify('000007'), b"\x00" * 8)
+    precomputer.verify(UID, binascii.unhexlify('000020'), b"\x00" * 8)
+
+    assert precomputer.counters.collect() == {"hits": 1.0, "misses": 1.0, "mismatches": 1.0}
+
+
+def test_precompute_key_of_the_tag():
+    old_key = binascii.unhexlify("00112233445566778899AABBCCDDEEFF")
+    new_key = binascii.unhexlify("FFEEDDCCBBAA99887766554433221100")
+    new_uid = binascii.unhexlify('04DE5F1EACC040')
+    # a single bucket, shared by the tags of both keys
+    ring = KeyRing([new_key, old_key], derive.derive_tag_key, derive.derive_undiversified_key, buckets=1)
+    precomputer = MacPrecomputer(derive_key=lambda uid, key_index: ring.file_key(key_index, uid),
+                                 calculate_mac=calculate_plain_sdmmac)
+
+    def message(master_key, uid, read_ctr):
+        ctr_b = read_ctr.to_bytes(3, 'big')
+        return uid, ctr_b, calculate_plain_sdmmac(uid, ctr_b, derive.derive_tag_key(master_key, uid, 2))
+
+    res = ring.validate_plain_sun(*message(old_key, UID, 5))
+    assert res['key_index'] == 1
+    # the bucket now prefers the new key
+    assert ring.validate_plain_sun(*message(new_key, new_uid, 1))['key_index'] == 0
+
+    precomputer.precompute(UID, 5, res['key_index'])
+    assert precomputer.verify(*message(old_key, UID, 6)) == 1
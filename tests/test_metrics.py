@@ -0,0 +1,95 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+from libsdm.stages import StageRecorder, activate, annotate, deactivate, stage
+from server.metrics import MetricsStore
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def _record(recorder):
+    token = activate(recorder)
+
+    try:
+        annotate("encryption_mode", "LRP")
+        annotate("derive_mode", "standard")
+        annotate("outcome", "ok")
+
+        with stage("verify"):
+            with stage("derive"):
+                pass
+
+            with stage("mac"):
+                pass
+    finally:
+        deactivate(token)
+
+
+def test_stage_recorder():
+    ticks = iter(range(100))
+    recorder = StageRecorder(clock=lambda: float(next(ticks)))
+    _record(recorder)
+
+    assert [item.name for item in recorder.stages] == ["verify", "derive", "mac"]
+    assert [item.parent for item in recorder.stages] == [None, 0, 0]
+    assert recorder.durations() == {"verify": 5.0, "derive": 1.0, "mac": 1.0}
+    assert recorder.labels == {"encryption_mode": "LRP", "derive_mode": "standard", "outcome": "ok"}
+
+    # no recorder, no effect
+    with stage("verify"):
+        annotate("outcome", "invalid")
+
+    assert len(recorder.stages) == 3
+
+
+def _observe_in_child(directory):
+    store = MetricsStore(directory)
+    recorder = StageRecorder()
+    _record(recorder)
+    store.observe_request(recorder)
+
+
+def test_aggregate_processes(tmp_path):
+    store = MetricsStore(str(tmp_path))
+    store.observe("request", 0.003, "AES", "legacy", "invalid")
+
+    ctx = multiprocessing.get_context("spawn")
+
+    for _ in range(2):
+        child = ctx.Process(target=_observe_in_child, args=(str(tmp_path),))
+        child.start()
+        child.join(timeout=20)
+        assert child.exitcode == 0
+
+    text = store.render()
+    labels = 'encryption_mode="LRP",derive_mode="standard",outcome="ok"'
+    assert f'sdm_stage_duration_seconds_count{{stage="mac",{labels}}} 2' in text
+    assert f'sdm_requests_total{{{labels}}} 2' in text
+
+    labels = 'stage="request",encryption_mode="AES",derive_mode="legacy",outcome="invalid"'
+    assert f'sdm_stage_duration_seconds_bucket{{{labels},le="0.0025"}} 0' in text
+    assert f'sdm_stage_duration_seconds_bucket{{{labels},le="0.005"}} 1' in text
+    assert f'sdm_stage_duration_seconds_bucket{{{labels},le="+Inf"}} 1' in text
+
+
+def test_temporary_directories_removed():
+    # the forked child exits first, the directories are removed only by the process which created them
+    script = ("import os, sys\n"
+              "from server.metrics import MetricsStore, ProcessValues\n"
+              "from server.rate_limit import TokenBuckets\n"
+              "directories = [MetricsStore().directory, ProcessValues('test', ('a',)).directory,\n"
+              "               TokenBuckets('test', rate=1.0, burst=1, slots=64).directory]\n"
+              "print(' '.join(directories))\n"
+              "sys.stdout.flush()\n"
+              "pid = os.fork()\n"
+              "if pid == 0:\n"
+              "    sys.exit(0)\n"
+              "os.waitpid(pid, 0)\n"
+              "assert all(os.path.isdir(directory) for directory in directories)\n")
+    output = subprocess.run([sys.executable, "-c", script], cwd=ROOT, check=True, capture_output=True, text=True)
+    directories = output.stdout.split()
+
+    assert len(directories) == 3
+    assert not any(os.path.exists(directory) for directory in directories)
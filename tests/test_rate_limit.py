@@ -0,0 +1,90 @@
+import json
+import multiprocessing
+
+from werkzeug.exceptions import TooManyRequests
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from server.rate_limit import RateLimitMiddleware, TokenBuckets
+from tests.clock import FakeClock
+
+
+def test_token_bucket_refill(tmp_path):
+    clock = FakeClock(1700000000.0)
+    buckets = TokenBuckets("test", rate=2.0, burst=3, directory=str(tmp_path), clock=clock)
+
+    assert [buckets.acquire(b"a") for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert buckets.acquire(b"a") == 0.5
+    # independent bucket
+    assert buckets.acquire(b"b") == 0.0
+
+    clock.now += 0.5
+    assert buckets.acquire(b"a") == 0.0
+    assert buckets.acquire(b"a") == 0.5
+
+    clock.now += 100
+    assert [buckets.acquire(b"a") for _ in range(4)] == [0.0, 0.0, 0.0, 0.5]
+
+    try:
+        buckets.check(b"a")
+    except TooManyRequests as err:
+        assert err.retry_after == 1
+    else:
+        raise RuntimeError("Expected TooManyRequests.")
+
+
+def test_least_recently_updated_evicted(tmp_path):
+    clock = FakeClock(1700000000.0)
+    # a single set of 4 entries
+    buckets = TokenBuckets("test", rate=1.0, burst=1, slots=4, directory=str(tmp_path), clock=clock)
+
+    for key in (b"a", b"b", b"c", b"d"):
+        assert buckets.acquire(key) == 0.0
+        clock.now += 0.01
+
+    assert buckets.acquire(b"a") > 0
+    # replaces "b", the least recently updated
+    assert buckets.acquire(b"e") == 0.0
+    assert buckets.acquire(b"a") > 0
+    assert buckets.acquire(b"b") == 0.0
+
+
+def _consume(buckets, count):
+    for _ in range(count):
+        buckets.acquire(b"shared")
+
+
+def test_shared_between_processes(tmp_path):
+    buckets = TokenBuckets("test", rate=0.001, burst=10, directory=str(tmp_path))
+    context = multiprocessing.get_context("fork")
+    processes = [context.Process(target=_consume, args=(buckets, 4)) for _ in range(2)]
+
+    for process in processes:
+        process.start()
+
+    for process in processes:
+        process.join()
+
+    assert buckets.acquire(b"shared") == 0.0
+    assert buckets.acquire(b"shared") == 0.0
+    assert buckets.acquire(b"shared") > 0
+
+
+def test_middleware(tmp_path):
+    def application(environ, start_response):
+        start_response("200 OK", [("Content-Type", "text/plain")])
+        return [b"verified"]
+
+    buckets = TokenBuckets("ip", rate=0.001, burst=1, directory=str(tmp_path))
+    client = Client(RateLimitMiddleware(application, buckets, ["/tag", "/api/tag"]), Response)
+
+    assert client.get("/api/tag").status_code == 200
+    response = client.get("/api/tag")
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "1000"
+    assert json.loads(response.data) == {"error": "429 Too Many Requests: Rate limit exceeded, try again later."}
+
+    assert client.get("/tag").status_code == 429
+    assert client.get("/tag", environ_base={"REMOTE_ADDR": "192.0.2.1"}).status_code == 200
+    # other paths are not limited
+    assert client.get("/").status_code == 200
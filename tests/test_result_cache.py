@@ -0,0 +1,67 @@
+from server.metrics import ProcessValues
+from server.result_cache import ResultCache
+from tests.clock import FakeClock
+
+
+class Rejected(Exception):
+    pass
+
+
+def test_cache_hit_and_expiry():
+    clock = FakeClock()
+    cache = ResultCache(max_size=10, ttl=5.0, clock=clock)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"read_ctr": 1}
+
+    assert cache.lookup(b"a", compute) == {"read_ctr": 1}
+    assert cache.lookup(b"a", compute) == {"read_ctr": 1}
+    assert len(calls) == 1
+
+    clock.now = 5.0
+    cache.lookup(b"a", compute)
+    assert len(calls) == 2
+
+    assert cache.stats() == {"size": 1, "cached": 1, "computed": 2}
+    assert cache.fetch(b"a", compute) == ({"read_ctr": 1}, True)
+    assert cache.fetch(b"b", compute) == ({"read_ctr": 1}, False)
+
+
+def test_cache_counters(tmp_path):
+    cache = ResultCache(max_size=10, ttl=5.0)
+    cache.counters = ProcessValues("result_cache_0", ("cached", "computed"), directory=str(tmp_path))
+
+    for _ in range(3):
+        cache.lookup(b"a", lambda: 1)
+
+    assert cache.counters.collect() == {"cached": 2.0, "computed": 1.0}
+
+
+def test_cache_bounded():
+    cache = ResultCache(max_size=2, ttl=60.0)
+
+    for key in (b"a", b"b", b"c"):
+        cache.lookup(key, lambda: 1)
+
+    assert cache.stats()["size"] == 2
+    assert b"a" not in cache.entries
+
+
+def test_cache_rejections():
+    def compute():
+        raise Rejected("invalid MAC")
+
+    for cache_rejections, expected_computed in ((False, 2), (True, 1)):
+        cache = ResultCache(max_size=10, ttl=60.0, cache_rejections=cache_rejections, rejection=Rejected)
+
+        for _ in range(2):
+            try:
+                cache.lookup(b"a", compute)
+            except Rejected:
+                pass
+            else:
+                raise RuntimeError("Rejected was not thrown as expected")
+
+        assert cache.stats()["computed"] == expected_computed
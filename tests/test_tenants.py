@@ -0,0 +1,87 @@
+import binascii
+import json
+
+from server.tenants import ENVIRON_KEY, Tenant, TenantMiddleware, TenantRegistry, load_tenants
+
+
+def _default_tenant():
+    return Tenant(name="default",
+                  master_key=b"\x00" * 16,
+                  derive_mode="legacy",
+                  enc_picc_data_param="picc_data",
+                  enc_file_data_param="enc",
+                  uid_param="uid",
+                  ctr_param="ctr",
+                  sdmmac_param="cmac",
+                  require_lrp=False)
+
+
+def _registry(tmp_path):
+    path = tmp_path / "tenants.json"
+    path.write_text(json.dumps({
+        "acme": {
+            "master_key": "00112233445566778899AABBCCDDEEFF",
+            "derive_mode": "standard",
+            "path_prefix": "/acme",
+            "hosts": ["sdm.acme.example"],
+            "sdmmac_param": "mac",
+            "require_lrp": True
+        }
+    }))
+    return load_tenants(str(path), _default_tenant())
+
+
+def test_load_tenants_defaults(tmp_path):
+    acme = _registry(tmp_path).tenants["acme"]
+    assert acme.master_key == binascii.unhexlify("00112233445566778899AABBCCDDEEFF")
+    assert acme.sdmmac_param == "mac"
+    assert acme.require_lrp
+    assert not acme.demo_mode
+    # not specified in the file, taken from the default tenant
+    assert acme.enc_picc_data_param == "picc_data"
+    assert acme.uid_param == "uid"
+    assert acme.keys.master_keys == [acme.master_key]
+
+
+def test_resolve(tmp_path):
+    registry = _registry(tmp_path)
+    acme = registry.tenants["acme"]
+
+    assert registry.resolve("localhost", "/acme/api/tag") == (acme, "/acme", "/api/tag")
+    assert registry.resolve("localhost", "/acme") == (acme, "/acme", "/")
+    assert registry.resolve("SDM.acme.example:8080", "/api/tag") == (acme, "", "/api/tag")
+    assert registry.resolve("localhost", "/acmex/api/tag") == (registry.default, "", "/acmex/api/tag")
+    assert registry.resolve("localhost", "/api/tag") == (registry.default, "", "/api/tag")
+
+
+def test_middleware(tmp_path):
+    registry = _registry(tmp_path)
+    seen = {}
+
+    def app(environ, start_response):  # pylint: disable=unused-argument
+        seen.update(environ)
+        return []
+
+    TenantMiddleware(app, registry)({"PATH_INFO": "/acme/tag", "SCRIPT_NAME": "", "HTTP_HOST": "localhost"}, None)
+    assert seen[ENVIRON_KEY] is registry.tenants["acme"]
+    assert seen["SCRIPT_NAME"] == "/acme"
+    assert seen["PATH_INFO"] == "/tag"
+
+
+def test_invalid_tenant():
+    try:
+        Tenant(name="bad", master_key=b"\x00" * 16, derive_mode="unknown", enc_picc_data_param="picc_data",
+               enc_file_data_param="enc", uid_param="uid", ctr_param="ctr", sdmmac_param="cmac", require_lrp=False)
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError("Expected exception.")
+
+    registry = TenantRegistry(_default_tenant())
+
+    try:
+        registry.add(_default_tenant())
+    except RuntimeError:
+        pass
+    else:
+        raise RuntimeError("Expected exception.")
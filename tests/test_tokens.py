@@ -0,0 +1,42 @@
+import binascii
+
+from libsdm.sdm import EncMode
+from server.tokens import InvalidToken, TokenSigner
+
+
+def _expect_invalid(signer, token):
+    try:
+        signer.verify(token)
+    except InvalidToken:
+        # this is expected
+        pass
+    else:
+        raise RuntimeError("InvalidToken was not thrown as expected")
+
+
+def test_token_roundtrip():
+    signer = TokenSigner(key=b"\x01" * 32, ttl=300, clock=lambda: 1700000000)
+    token = signer.issue(binascii.unhexlify("04DE5F1EACC040"), 61, EncMode.LRP, "tampered_open")
+    res = signer.verify(token)
+
+    assert res['uid'] == binascii.unhexlify("04DE5F1EACC040")
+    assert res['read_ctr'] == 61
+    assert res['encryption_mode'] == EncMode.LRP
+    assert res['tt_status'] == "tampered_open"
+    assert res['expires'] == 1700000300
+
+
+def test_token_no_read_ctr():
+    signer = TokenSigner(key=b"\x01" * 32, ttl=300)
+    token = signer.issue(binascii.unhexlify("04DE5F1EACC040"), None, EncMode.AES)
+    assert signer.verify(token)['read_ctr'] is None
+
+
+def test_token_invalid():
+    signer = TokenSigner(key=b"\x01" * 32, ttl=300, clock=lambda: 1700000000)
+    token = signer.issue(binascii.unhexlify("04DE5F1EACC040"), 61, EncMode.AES)
+
+    _expect_invalid(TokenSigner(key=b"\x02" * 32, ttl=300, clock=lambda: 1700000000), token)
+    _expect_invalid(signer, token[:-2])
+    _expect_invalid(signer, "!!!")
+    _expect_invalid(TokenSigner(key=b"\x01" * 32, ttl=300, clock=lambda: 1700000300), token)
@@ -0,0 +1,56 @@
+import glob
+import json
+import os
+
+from libsdm.stages import StageRecorder
+from server.tracing import Tracer
+
+
+def _recorder(duration=0.001):
+    ticks = iter([0.0, 0.0001, 0.0002, 0.0003, 0.0004])
+    recorder = StageRecorder(clock=lambda: next(ticks, duration))
+    recorder.labels["outcome"] = "ok"
+
+    with recorder.stage("verify"):
+        with recorder.stage("mac"):
+            pass
+
+    recorder.finish()
+    return recorder
+
+
+def test_spans():
+    spans = Tracer.spans(_recorder(), "/tag", now_ns=10 ** 18, now_clock=0.001)
+    root, verify, mac = spans
+
+    assert root["name"] == "GET /tag" and root["parentSpanId"] == ""
+    assert verify["parentSpanId"] == root["spanId"]
+    assert mac["parentSpanId"] == verify["spanId"]
+    assert len({span["traceId"] for span in spans}) == 1
+    assert int(root["endTimeUnixNano"]) == 10 ** 18
+    assert int(mac["endTimeUnixNano"]) - int(mac["startTimeUnixNano"]) == 100000
+    assert {"key": "outcome", "value": {"stringValue": "ok"}} in root["attributes"]
+
+
+def test_sampling_and_rotation(tmp_path):
+    tracer = Tracer(str(tmp_path), sample_rate=0.0, slow_threshold=0.5, max_bytes=2000, backup_count=2)
+
+    # fast requests are not sampled
+    tracer.observe(_recorder(), "/tag")
+    assert tracer.sampled == 0
+
+    for _ in range(10):
+        tracer.observe(_recorder(duration=1.0), "/tag")
+
+    tracer.flush()
+    assert tracer.sampled == 10
+
+    files = sorted(glob.glob(os.path.join(str(tmp_path), "spans.*")))
+    assert len(files) == 3
+
+    for path in files:
+        assert os.path.getsize(path) <= 2000
+
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                assert json.loads(line)["traceId"]
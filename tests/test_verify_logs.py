@@ -0,0 +1,66 @@
+import gzip
+import io
+import json
+import os
+import subprocess
+import sys
+
+from libsdm.encoder import TagSimulator, format_query
+from libsdm.sdm import ParamMode
+from verify_logs import extract_url, run
+
+MASTER_KEY = b"\x00" * 16
+UID = bytes.fromhex("04A1B2C3D4E5F6")
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def test_extract_url():
+    assert extract_url('1.2.3.4 - - [10/Oct/2024:13:55:36 +0000] "GET /tag?e=00 HTTP/1.1" 200 12 "-" "curl"') \
+        == "/tag?e=00"
+    assert extract_url("https://sdm.example.com/tagpt?uid=00\n") == "https://sdm.example.com/tagpt?uid=00"
+    assert extract_url("garbage") is None
+
+
+def test_run(tmp_path):
+    tag = TagSimulator(MASTER_KEY, UID, derive_mode="legacy", sdmmac_param="cmac")
+    lines = [
+        f'1.2.3.4 - - [10/Oct/2024:13:55:36 +0000] "GET /tag?{format_query(tag.tap())} HTTP/1.1" 200 12 "-" "-"',
+        "not an url",
+        "/static/style.css",
+        f"/api/tagtt?{format_query(tag.tap(ParamMode.BULK, b'OC' + b'x' * 14), ParamMode.BULK)}",
+        f"/tagpt?{format_query(tag.tap_plain())}",
+        "/tag?picc_data=EF963FF7828658A599F3041510671E88&cmac=0000000000000000",
+        "/tagpt?uid=04A1B2C3D4E5F6",
+    ]
+    path = str(tmp_path / "access.log.gz")
+
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        f.write(("\n".join(lines) + "\n") * 3)
+
+    outputs = []
+
+    for processes in (1, 2):
+        out = io.StringIO()
+        run([path], out, processes=processes, chunk_size=2)
+        outputs.append(out.getvalue())
+
+    assert outputs[0] == outputs[1]
+    results = [json.loads(line) for line in outputs[0].splitlines()]
+    assert [result["line"] for result in results] == [1, 4, 5, 6, 7, 8, 11, 12, 13, 14, 15, 18, 19, 20, 21]
+    assert [result["outcome"] for result in results[:5]] == ["ok", "ok", "ok", "invalid", "bad_request"]
+    assert results[0]["uid"] == UID.hex().upper() and results[0]["read_ctr"] == 1
+    assert results[1]["tt_status"] == "tampered_closed"
+    assert results[2]["read_ctr"] == 3
+    assert results[4]["error"] == "Parameter ctr is required"
+
+
+def test_application_not_loaded(tmp_path):
+    tag = TagSimulator(MASTER_KEY, UID, derive_mode="legacy", sdmmac_param="cmac")
+    path = tmp_path / "access.log"
+    path.write_text(f"/tag?{format_query(tag.tap())}\n")
+    # the application starts the counter store, background threads etc. on import
+    script = ("import io, sys, verify_logs\n"
+              f"verify_logs.run([{str(path)!r}], io.StringIO(), processes=2)\n"
+              "assert 'app' not in sys.modules\n")
+
+    subprocess.run([sys.executable, "-c", script], cwd=ROOT, check=True)
@@ -0,0 +1,57 @@
+import binascii
+import os
+
+from flask import Flask
+
+from libsdm.lrp import LRP
+from server.tenants import Tenant
+from server.warmup import warmup
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+
+
+def _tenant(previous_master_keys=()):
+    return Tenant(name="default",
+                  master_key=binascii.unhexlify("00112233445566778899AABBCCDDEEFF"),
+                  derive_mode="standard",
+                  enc_picc_data_param="picc_data",
+                  enc_file_data_param="enc",
+                  uid_param="uid",
+                  ctr_param="ctr",
+                  sdmmac_param="cmac",
+                  require_lrp=False,
+                  previous_master_keys=previous_master_keys)
+
+
+def test_remembered_lrp_tables():
+    key = binascii.unhexlify("E2F84A0B0AF40EFEB3EEA215A436605C")
+    cmac = LRP(key, 0).cmac(b"\x8B\xB1\x91")
+    ciphertext = LRP(key, 1, b"\x00" * 8, pad=False).encrypt(b"\x11" * 16)
+
+    LRP.remember(key)
+
+    try:
+        assert LRP(key, 0).p is LRP.remembered[key][0]
+        assert LRP(key, 0).cmac(b"\x8B\xB1\x91") == cmac
+        assert LRP(key, 1, b"\x00" * 8, pad=False).encrypt(b"\x11" * 16) == ciphertext
+    finally:
+        del LRP.remembered[key]
+
+
+def test_warmup():
+    app = Flask("app", root_path=ROOT)
+    tenant = _tenant(previous_master_keys=[binascii.unhexlify("FFEEDDCCBBAA99887766554433221100")])
+    uids = [binascii.unhexlify("04A1B2C3D4E5F6"), binascii.unhexlify("04112233445566")]
+
+    try:
+        summary = warmup(app, [tenant], preload_uids=uids, freeze=False)
+    finally:
+        for meta_read_key in tenant.keys.meta_read_keys:
+            LRP.remembered.pop(meta_read_key, None)
+
+    assert summary["templates"] == len(os.listdir(os.path.join(ROOT, "templates")))
+    # both tags for both master keys
+    assert summary["preloaded_keys"] == 4
+    assert tenant.keys.stats()["cached_keys"] == 4
+    # the synthetic messages don't affect the key ring
+    assert tenant.keys.stats()["verified"] == 0
@@ -0,0 +1,257 @@
+"""
+Offline verification of SUN URLs, e.g. from web server access logs.
+
+Reads log lines (the request line "GET /tag?... HTTP/1.1" is extracted) or raw URLs from files
+(plain or gzip-compressed) or stdin, verifies the /tag, /tagtt and /tagpt messages (and their /api/
+variants, including the tenant path prefixes) with the keys from config.py and writes one JSON object
+per message to stdout, in the order of the input. Lines without any SUN URL are skipped.
+
+The verification runs in a pool of worker processes, with a bounded number of chunks in flight,
+so the memory usage doesn't depend on the size of the input. Replay protection is not applied
+(the read counters are reported instead) and the counter store is never updated.
+
+Usage:
+    python3 verify_logs.py access.log access.log.1.gz > results.ndjson
+    zcat access.log.*.gz | python3 verify_logs.py --processes 8 > results.ndjson
+"""
+
+import argparse
+import collections
+import gzip
+import itertools
+import json
+import multiprocessing
+import re
+import sys
+import time
+from typing import IO, Iterable, Iterator, List, Optional, Tuple
+from urllib.parse import urlsplit
+
+from werkzeug.exceptions import BadRequest, BadRequestKeyError
+
+REQUEST_LINE = re.compile(r'"[A-Z]+ (\S+) HTTP/[0-9.]+"')
+SUN_ROUTES = {'/tag': False, '/tagtt': True, '/api/tag': False, '/api/tagtt': True}
+PLAIN_ROUTES = {'/tagpt', '/api/tagpt'}
+
+# (source name, line number, line)
+Line = Tuple[str, int, str]
+
+_tenants = None
+
+
+def load_tenants():
+    """
+    Build the tenants from config.py, without importing the application (and starting its
+    counter store, background threads etc.)
+    :return: TenantRegistry
+    """
+    # pylint: disable=import-outside-toplevel, global-statement
+    global _tenants
+
+    if _tenants is None:
+        import config
+        from server.tenants import config_tenants
+
+        _tenants = config_tenants(config)
+
+    return _tenants
+
+
+def extract_url(line: str) -> Optional[str]:
+    """
+    :return: request target from an access log line, the line itself if it's an URL, None otherwise
+    """
+    match = REQUEST_LINE.search(line)
+
+    if match:
+        return match.group(1)
+
+    line = line.strip()
+
+    if line.startswith(("/", "http://", "https://")):
+        return line
+
+    return None
+
+
+def verify_url(url: str, host: str = "") -> Optional[dict]:
+    """
+    Verify SUN message in the URL
+    :return: result (outcome: ok, invalid or bad_request) or None if it's not a SUN URL
+    """
+    # pylint: disable=import-outside-toplevel
+    from api_wsgi import parse_query_string
+    from libsdm.sdm import EncMode, InvalidMessage
+    from server.sun_params import parse_parameters, parse_plain_parameters, tag_tamper_status
+
+    parts = urlsplit(url)
+    tenant, _, route = load_tenants().resolve(parts.netloc or host, parts.path)
+
+    if route not in SUN_ROUTES and route not in PLAIN_ROUTES:
+        return None
+
+    result = {"path": parts.path, "tenant": tenant.name}
+    args = parse_query_string(parts.query)
+
+    try:
+        if route in PLAIN_ROUTES:
+            uid, read_ctr, sdmmac = parse_plain_parameters(args, tenant)
+            res = tenant.keys.validate_plain_sun(uid=uid, read_ctr=read_ctr, sdmmac=sdmmac)
+        else:
+            param_mode, enc_picc_data, enc_file_data, sdmmac = parse_parameters(args, tenant)
+            res = tenant.keys.decrypt_sun_message(param_mode=param_mode,
+                                                  picc_enc_data=enc_picc_data,
+                                                  sdmmac=sdmmac,
+                                                  enc_file_data=enc_file_data,
+                                                  sdmmac_param=tenant.sdmmac_param)
+
+            if tenant.require_lrp and res['encryption_mode'] != EncMode.LRP:
+                raise BadRequest("Invalid encryption mode, expected LRP.")
+    except InvalidMessage as err:
+        return dict(result, outcome="invalid", error=str(err))
+    except BadRequestKeyError as err:
+        return dict(result, outcome="bad_request", error=f"Parameter {err.args[0]} is required")
+    except BadRequest as err:
+        return dict(result, outcome="bad_request", error=err.description)
+
+    result.update(outcome="ok",
+                  encryption_mode=res['encryption_mode'].name,
+                  uid=res['uid'].hex().upper(),
+                  read_ctr=res['read_ctr'])
+
+    if res.get('file_data'):
+        result["file_data"] = res['file_data'].hex().upper()
+
+        if SUN_ROUTES.get(route):
+            result["tt_status"] = tag_tamper_status(res['file_data'])[0]
+
+    return result
+
+
+def verify_chunk(job: Tuple[List[Line], str]) -> Tuple[int, int, str]:
+    """
+    :return: number of lines, number of verified URLs, NDJSON output
+    """
+    lines, host = job
+    output = []
+
+    for source, line_no, line in lines:
+        url = extract_url(line)
+        result = verify_url(url, host) if url is not None else None
+
+        if result is not None:
+            output.append(json.dumps(dict({"source": source, "line": line_no}, **result)) + "\n")
+
+    return len(lines), len(output), "".join(output)
+
+
+def read_lines(paths: Iterable[str]) -> Iterator[Line]:
+    for path in paths:
+        if path == "-":
+            stream: IO[str] = sys.stdin
+        elif path.endswith(".gz"):
+            stream = gzip.open(path, "rt", encoding="utf-8", errors="replace")
+        else:
+            stream = open(path, "r", encoding="utf-8", errors="replace")  # pylint: disable=consider-using-with
+
+        try:
+            for line_no, line in enumerate(stream, start=1):
+                yield path, line_no, line
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+
+def chunks(lines: Iterator[Line], size: int) -> Iterator[List[Line]]:
+    while True:
+        chunk = list(itertools.islice(lines, size))
+
+        if not chunk:
+            return
+
+        yield chunk
+
+
+class Progress:
+    def __init__(self, stream: IO[str], interval: float = 5.0):
+        self.stream = stream
+        self.interval = interval
+        self.started = time.monotonic()
+        self.last_report = self.started
+        self.lines = 0
+        self.urls = 0
+
+    def update(self, lines: int, urls: int):
+        self.lines += lines
+        self.urls += urls
+        now = time.monotonic()
+
+        if self.interval and now - self.last_report >= self.interval:
+            self.last_report = now
+            self.report()
+
+    def report(self, final: bool = False):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        self.stream.write(f"{'done' if final else 'progress'}: {self.lines} lines, {self.urls} URLs verified "
+                          f"in {elapsed:.1f} s ({self.lines / elapsed:.0f} lines/s, {self.urls / elapsed:.0f} URLs/s)\n")
+        self.stream.flush()
+
+
+def run(paths: List[str], out: IO[str], processes: Optional[int] = None, chunk_size: int = 1000, host: str = "",
+        progress: Optional[Progress] = None):
+    jobs = ((chunk, host) for chunk in chunks(read_lines(paths), chunk_size))
+
+    def write(result: Tuple[int, int, str]):
+        lines, urls, output = result
+        out.write(output)
+
+        if progress is not None:
+            progress.update(lines, urls)
+
+    if processes == 1:
+        for job in jobs:
+            write(verify_chunk(job))
+
+        return
+
+    # loaded once before forking, so that the workers share the keys and caches
+    load_tenants()
+
+    # Pool.imap() would read the whole input ahead, keep a bounded window of chunks in flight instead
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else None)
+
+    with context.Pool(processes) as pool:
+        window = collections.deque()
+        max_in_flight = 2 * (processes or multiprocessing.cpu_count())
+
+        for job in jobs:
+            window.append(pool.apply_async(verify_chunk, (job,)))
+
+            if len(window) >= max_in_flight:
+                write(window.popleft().get())
+
+        while window:
+            write(window.popleft().get())
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Verify SUN URLs from access logs')
+    parser.add_argument('paths', nargs='*', default=["-"], help='log files (.gz supported), "-" = stdin')
+    parser.add_argument('--processes', type=int, help='worker processes (default: number of CPUs)')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='lines per job')
+    parser.add_argument('--host', type=str, default="", help='Host used to select the tenant of relative URLs')
+    parser.add_argument('--progress-interval', type=float, default=5.0,
+                        help='seconds between progress reports on stderr (0 = only the final one)')
+    args = parser.parse_args(argv)
+
+    progress = Progress(sys.stderr, interval=args.progress_interval)
+    run(args.paths, sys.stdout, processes=args.processes, chunk_size=args.chunk_size, host=args.host,
+        progress=progress)
+    sys.stdout.flush()
+    progress.report(final=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())